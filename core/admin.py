@@ -1,98 +1,52 @@
 from django.contrib import admin
-from django.http import HttpResponse
+from django.http import FileResponse
+from django.urls import reverse
+from django.utils.html import format_html
 from django_summernote.admin import SummernoteModelAdmin
-from weasyprint import HTML
 
-from .models import Post, AreaDoConhecimento, Dificuldade
-from .utils import process_content_for_pdf 
+from . import renderers
+from .models import Post, AreaDoConhecimento, Dificuldade, ExportJob, refresh_rendered_posts
+from .jobs import submit_export_job
+from .pdf_cache import spooled_pdf_file
+from .timing import export_timing, profile_path_for
 
 def export_posts_to_pdf(modeladmin, request, queryset):
-    
-    html_string = """
-    <!DOCTYPE html>
-    <html>
-    <head>
-        <meta charset="utf-8">
-        <style>
-            @page { 
-                size: A4; 
-                margin: 3cm 2cm 2cm 3cm; 
-            }
-
-            body { 
-                font-family: "Times New Roman", Times, serif; 
-                font-size: 12pt; 
-                line-height: 1.5;
-                text-align: justify;
-                color: #000;
-            }
-            
-            h1 { 
-                font-size: 14pt; 
-                font-weight: bold; 
-                text-align: center;
-                text-transform: uppercase;
-                margin-bottom: 1cm;
-            }
-
-            img { max-width: 100%; height: auto; }
-
-            /* --- INLINE LATEX ($$) --- */
-            /* Keeps the inline math locked to text height */
-            img.latex-inline {
-                height: 1.3em; 
-                vertical-align: -0.3em;
-                margin: 0 2px;
-                display: inline-block;
-            }
+    pdf_file = spooled_pdf_file()
+    with export_timing('abnt', profile_path_for(request, 'abnt'), 'admin_export_posts_to_pdf') as timer:
+        # WeasyPrint is loaded by the first export, not with the admin
+        renderers.pdf().build_abnt_pdf(queryset, pdf_file)
+    pdf_file.seek(0)
+    response = FileResponse(pdf_file, as_attachment=True, filename='posts_ABNT.pdf', content_type='application/pdf')
+    response['Server-Timing'] = timer.server_timing()
+    return response
 
-            /* --- BLOCK LATEX (\[ \]) --- */
-            /* Now that Python generates it smaller, we just center it */
-            img.latex-block {
-                display: block;
-                margin: 12px auto; /* Space above and below */
-                height: auto;      /* Let it flow naturally */
-                width: auto;       /* Prevent stretching */
-            }
-            
-            p { text-indent: 1.25cm; margin: 0 0 10px 0; }
-            .page-break { page-break-after: always; }
-        </style>
-    </head>
-    <body>
-    """
+export_posts_to_pdf.short_description = "Export PDF (ABNT Format)"
 
-    total = queryset.count()
-    for index, post in enumerate(queryset):
-        processed_content = process_content_for_pdf(post.content)
-        
-        html_string += f"""
-        <div class="post-wrapper">
-            <h1>{post.title}</h1>
-            <div style="text-align: right; font-size: 10pt; margin-bottom: 1cm;">
-                {post.created_at.strftime('%d de %B de %Y')}
-            </div>
-            <div class="content">
-                {processed_content}
-            </div>
-        </div>
-        """
-        if index < total - 1:
-            html_string += '<div class="page-break"></div>'
+def export_posts_to_pdf_in_background(modeladmin, request, queryset):
+    job = submit_export_job('abnt', list(queryset.values_list('id', flat=True)))
+    status_url = reverse('export_job_status', args=[job.pk])
+    modeladmin.message_user(request, format_html(
+        'PDF export #{} queued. Check <a href="{}">its status</a>; the download link appears there when it is done.',
+        job.pk, status_url,
+    ))
 
-    html_string += "</body></html>"
+export_posts_to_pdf_in_background.short_description = "Export PDF (ABNT Format) in background"
 
-    pdf_file = HTML(string=html_string).write_pdf()
-    response = HttpResponse(pdf_file, content_type='application/pdf')
-    response['Content-Disposition'] = 'attachment; filename="posts_ABNT.pdf"'
-    return response
+def rerender_posts_for_pdf(modeladmin, request, queryset):
+    posts = list(queryset)
+    refresh_rendered_posts(posts)
+    modeladmin.message_user(request, f"{len(posts)} question(s) re-rendered for PDF.")
 
-export_posts_to_pdf.short_description = "Export PDF (ABNT Format)"
+rerender_posts_for_pdf.short_description = "Re-render PDF content"
 
 class PostAdmin(SummernoteModelAdmin):
     summernote_fields = ('content',)
     list_display = ('title', 'created_at')
-    actions = [export_posts_to_pdf]
+    actions = [export_posts_to_pdf, export_posts_to_pdf_in_background, rerender_posts_for_pdf]
+
+    def save_model(self, request, obj, form, change):
+        super().save_model(request, obj, form, change)
+        obj.refresh_rendered_content()
 
 admin.site.register(Post, PostAdmin)
 
@@ -104,6 +58,13 @@ class AreaDoConhecimentoAdmin(admin.ModelAdmin):
     readonly_fields = ('created_at', 'updated_at')
 
 
+@admin.register(ExportJob)
+class ExportJobAdmin(admin.ModelAdmin):
+    list_display = ('id', 'kind', 'status', 'created_at', 'finished_at')
+    list_filter = ('kind', 'status')
+    readonly_fields = ('kind', 'post_ids', 'status', 'file', 'error', 'created_at', 'started_at', 'finished_at')
+
+
 @admin.register(Dificuldade)
 class DificuldadeAdmin(admin.ModelAdmin):
     list_display = ('name', 'color', 'created_at', 'updated_at')
@@ -0,0 +1,178 @@
+"""
+Portable archive of the question bank (`export_bank` / `import_bank`).
+
+The archive is a ZIP with:
+
+- questions.jsonl: one question per line (title, content, area and
+  difficulty names and colors, created_at, referenced media paths)
+- media/<path>: every file under MEDIA_ROOT the questions reference, once
+- manifest.json: format version, counts and the MEDIA_URL of the source
+
+Both directions run at constant memory: questions are read with
+iterator(chunk_size=...) and written line by line into the ZIP (which may be
+a non-seekable stream), files are copied in blocks, and the import feeds the
+lines to core.importer in batches.
+"""
+import io
+import json
+import re
+import shutil
+import zipfile
+from pathlib import Path, PurePosixPath
+
+from django.conf import settings
+from django.utils import timezone
+
+from .importer import QuestionImporter
+from .models import Post
+
+ARCHIVE_VERSION = 1
+QUESTIONS_NAME = 'questions.jsonl'
+MANIFEST_NAME = 'manifest.json'
+MEDIA_PREFIX = 'media/'
+
+# Fields read for the archive (the print-ready fragments are rebuilt on the other side)
+ARCHIVE_FIELDS = (
+    'title', 'content', 'created_at',
+    'area_do_conhecimento__name', 'area_do_conhecimento__color',
+    'dificuldade__name', 'dificuldade__color',
+)
+
+
+class ArchiveError(ValueError):
+    """ The file is not a question bank archive this version can read. """
+
+
+def _media_src_re(media_url):
+    return re.compile(r'src=(["\'])' + re.escape(media_url) + r'([^"\'#?\\]+)\1')
+
+
+def referenced_media(content, media_url=None):
+    """ Paths (relative to MEDIA_ROOT) of the media files a question's HTML references. """
+    return [match.group(2) for match in _media_src_re(media_url or settings.MEDIA_URL).finditer(content)]
+
+
+def _question_record(post):
+    area, level = post.area_do_conhecimento, post.dificuldade
+    return {
+        'title': post.title,
+        'content': post.content,
+        'created_at': post.created_at.isoformat() if post.created_at else None,
+        'area': area.name if area else None,
+        'area_color': area.color if area else None,
+        'dificuldade': level.name if level else None,
+        'dificuldade_color': level.color if level else None,
+        'media': referenced_media(post.content),
+    }
+
+
+def export_archive(file, queryset=None, chunk_size=500):
+    """
+    Writes the questions of `queryset` (default: all) and their media to
+    `file` (a path or a writable binary file, seekable or not). Returns the manifest.
+    """
+    if queryset is None:
+        queryset = Post.objects.all()
+    queryset = (
+        queryset.select_related('area_do_conhecimento', 'dificuldade')
+        .only(*ARCHIVE_FIELDS).order_by('created_at', 'id')
+    )
+    media_root = Path(settings.MEDIA_ROOT).resolve()
+
+    questions = 0
+    media = {}  # Path -> file, in order of first reference
+    with zipfile.ZipFile(file, 'w', compression=zipfile.ZIP_DEFLATED) as archive:
+        with archive.open(QUESTIONS_NAME, 'w') as raw, io.TextIOWrapper(raw, encoding='utf-8') as out:
+            for post in queryset.iterator(chunk_size=chunk_size):
+                record = _question_record(post)
+                out.write(json.dumps(record, ensure_ascii=False) + '\n')
+                questions += 1
+                for path in record['media']:
+                    if path not in media:
+                        media[path] = media_root / path
+
+        missing = []
+        for path, source in media.items():
+            # Only files inside MEDIA_ROOT: the content is user input
+            if not source.resolve().is_relative_to(media_root) or not source.is_file():
+                missing.append(path)
+                continue
+            # Images are already compressed
+            archive.write(source, MEDIA_PREFIX + path, compress_type=zipfile.ZIP_STORED)
+
+        manifest = {
+            'version': ARCHIVE_VERSION,
+            'created_at': timezone.now().isoformat(),
+            'media_url': settings.MEDIA_URL,
+            'questions': questions,
+            'media_files': len(media) - len(missing),
+            'missing_media': missing,
+        }
+        archive.writestr(MANIFEST_NAME, json.dumps(manifest, indent=2))
+    return manifest
+
+
+def _media_target(name, media_root):
+    """ Where an archive member under media/ goes, or None if its name escapes MEDIA_ROOT. """
+    relative = PurePosixPath(name[len(MEDIA_PREFIX):])
+    if relative.is_absolute() or '..' in relative.parts or not relative.parts:
+        return None
+    return media_root / Path(*relative.parts)
+
+
+def import_archive(file, batch_size=500, prerender=False, progress=None):
+    """
+    Restores an archive written by export_archive: media files first (files
+    already present are kept), then the questions in batches. Questions
+    already in the bank (same title and creation date) are skipped, so an
+    archive can be imported again, e.g. after an interrupted import.
+    Returns (manifest, importer, media files written).
+    """
+    try:
+        archive = zipfile.ZipFile(file)
+    except zipfile.BadZipFile as e:
+        raise ArchiveError(f"not a ZIP file ({e})")
+
+    with archive:
+        try:
+            manifest = json.loads(archive.read(MANIFEST_NAME))
+        except KeyError:
+            raise ArchiveError(f"no {MANIFEST_NAME}: not a question bank archive")
+        if manifest.get('version') != ARCHIVE_VERSION:
+            raise ArchiveError(f"unsupported archive version {manifest.get('version')!r}")
+
+        media_root = Path(settings.MEDIA_ROOT)
+        written = 0
+        for info in archive.infolist():
+            if not info.filename.startswith(MEDIA_PREFIX) or info.is_dir():
+                continue
+            target = _media_target(info.filename, media_root)
+            if target is None:
+                raise ArchiveError(f"unsafe file name in archive: {info.filename}")
+            if target.exists():
+                continue
+            target.parent.mkdir(parents=True, exist_ok=True)
+            with archive.open(info) as source, target.open('wb') as out:
+                shutil.copyfileobj(source, out)
+            written += 1
+
+        # Media URLs follow this instance's MEDIA_URL
+        source_src = _media_src_re(manifest.get('media_url') or settings.MEDIA_URL)
+
+        importer = QuestionImporter(batch_size, prerender, skip_existing=True)
+        with archive.open(QUESTIONS_NAME) as raw:
+            for line_number, line in enumerate(io.TextIOWrapper(raw, encoding='utf-8'), start=1):
+                if not line.strip():
+                    continue
+                try:
+                    record = json.loads(line)
+                    record['content'] = source_src.sub(
+                        lambda match: f'src={match.group(1)}{settings.MEDIA_URL}{match.group(2)}{match.group(1)}',
+                        record.get('content') or '',
+                    )
+                except (ValueError, TypeError, AttributeError):
+                    record = line  # Reported as invalid by the importer
+                if importer.add(line_number, record) and progress is not None:
+                    progress(importer)
+        importer.finish()
+    return manifest, importer, written
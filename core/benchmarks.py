@@ -0,0 +1,422 @@
+"""
+Benchmarks for the formula rendering and PDF export pipeline.
+
+Run one suite with:
+
+    python manage.py benchmark <suite>
+
+The `pipeline` suite times the whole path on a synthetic question bank
+(seeded, so two runs build the same bank) created inside a transaction that
+is rolled back at the end:
+
+    python manage.py benchmark pipeline --posts 200 --formulas 4 --images 0.25 --output before.json
+
+The `startup` suite starts fresh interpreters the way a web worker or a
+management command does, and reports how long they take and which heavy
+modules (matplotlib, NumPy, WeasyPrint) they load.
+"""
+import json
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+import django
+from django.conf import settings
+from django.db import transaction
+from django.test import RequestFactory
+
+from . import search, utils
+from .cache import RenderCache
+
+# A mix of short inline formulas and larger display formulas
+SAMPLE_FORMULAS = [
+    ('x^2 + y^2 = r^2', 'inline'),
+    (r'\alpha + \beta = \gamma', 'inline'),
+    (r'f(x) = 3x - 2', 'inline'),
+    (r'\sqrt{2}', 'inline'),
+    (r'\frac{-b \pm \sqrt{b^2 - 4ac}}{2a}', 'block'),
+    (r'\int_0^1 x^2 \, dx = \frac{1}{3}', 'block'),
+    (r'\sum_{n=1}^{\infty} \frac{1}{n^2} = \frac{\pi^2}{6}', 'block'),
+    (r'\lim_{x \to 0} \frac{\sin x}{x} = 1', 'block'),
+]
+
+# Same math sizing rules as the export templates
+SAMPLE_CSS = """
+@page { size: A4; margin: 2cm; }
+body { font-family: "Times New Roman", Times, serif; font-size: 12pt; line-height: 1.5; }
+img.latex-inline { height: 1.3em; vertical-align: -0.3em; margin: 0 2px; display: inline-block; }
+img.latex-block { display: block; margin: 12px auto; height: auto; width: auto; }
+"""
+
+
+def _timeit(func, repeat):
+    times = []
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        times.append(time.perf_counter() - start)
+    return result, times
+
+
+def _summary(times):
+    return {
+        'min_ms': round(min(times) * 1000, 2),
+        'median_ms': round(statistics.median(times) * 1000, 2),
+    }
+
+
+def _percentiles(times):
+    """ Distribution of a list of durations (seconds), in ms. """
+    ms = sorted(t * 1000 for t in times)
+    # quantiles() needs two points; a single run is its own percentile
+    cuts = statistics.quantiles(ms, n=100, method='inclusive') if len(ms) > 1 else ms * 99
+    return {
+        'runs': len(ms),
+        'min_ms': round(ms[0], 2),
+        'p50_ms': round(cuts[49], 2),
+        'p90_ms': round(cuts[89], 2),
+        'p95_ms': round(cuts[94], 2),
+        'p99_ms': round(cuts[98], 2),
+        'max_ms': round(ms[-1], 2),
+        'mean_ms': round(statistics.fmean(ms), 2),
+    }
+
+
+def bench_math_formats(repeat=3, questions=60):
+    """ PNG vs SVG: cold formula render time, PDF layout time and PDF size. """
+    from .pdf import write_pdf
+
+    results = {}
+    for fmt in utils.LATEX_FORMATS:
+        def render_all():
+            return [
+                utils.render_latex_image(utils.clean_latex(formula), *utils.LATEX_STYLES[style][:2], fmt)
+                for formula, style in SAMPLE_FORMULAS
+            ]
+        images, render_times = _timeit(render_all, repeat)
+
+        question = ''.join(
+            f'<p>Resolva: {utils.latex_to_base64(formula, style=style, fmt=fmt, embed=False)}</p>'
+            for formula, style in SAMPLE_FORMULAS
+        )
+        html_string = (
+            f'<html><head><meta charset="utf-8"><style>{SAMPLE_CSS}</style></head><body>'
+            + question * questions
+            + '</body></html>'
+        )
+        pdf_file, pdf_times = _timeit(lambda: write_pdf(html_string), repeat)
+
+        results[fmt] = {
+            'formulas': len(SAMPLE_FORMULAS),
+            'render': _summary(render_times),
+            'image_bytes': sum(len(image) for image in images),
+            'html_bytes': len(html_string),
+            'write_pdf': _summary(pdf_times),
+            'pdf_bytes': len(pdf_file),
+        }
+    return results
+
+
+def bench_rasterizers(repeat=3):
+    """ Per-formula PNG render time: pyplot figure + tight bbox vs direct mathtext. """
+    results = {}
+    for name, rasterizer in (('pyplot', utils.render_latex_png_pyplot), ('mathtext', utils.render_latex_png)):
+        times = []
+        for run in range(repeat):
+            for formula, style in SAMPLE_FORMULAS:
+                # A different trailing space per run defeats matplotlib's own parse cache
+                source = utils.clean_latex(formula) + ' ' * run
+                start = time.perf_counter()
+                rasterizer(source, *utils.LATEX_STYLES[style][:2])
+                times.append(time.perf_counter() - start)
+        results[name] = _summary(times)
+    results['speedup'] = round(results['pyplot']['median_ms'] / results['mathtext']['median_ms'], 2)
+    return results
+
+
+def bench_export_layer(repeat=3, questions=40):
+    """ Exam export: per-request CSS/fonts/images and += body vs the shared rendering layer. """
+    from django.template.loader import render_to_string
+    from weasyprint import HTML
+
+    from .pdf import PDF_BASE_URL, PdfUrlFetcher, render_export_html, write_pdf
+
+    question = ''.join(
+        f'<p>Resolva: {utils.latex_to_base64(formula, style=style, embed=False)}</p>'
+        for formula, style in SAMPLE_FORMULAS
+    )
+    fragments = [
+        f'<div class="question-item"><h1>QUESTÃO {index + 1:02d}</h1><div class="content">{question}</div></div>'
+        for index in range(questions)
+    ]
+    css = render_to_string('pdf/exam.css')
+
+    def legacy():
+        # What every request used to do: concatenate, re-parse the CSS, fresh fonts and images
+        html_string = f'<html><head><meta charset="utf-8"><style>{css}</style></head><body>'
+        for fragment in fragments:
+            html_string += fragment
+        html_string += '</body></html>'
+        return HTML(string=html_string, base_url=PDF_BASE_URL, url_fetcher=PdfUrlFetcher()).write_pdf()
+
+    def shared():
+        return write_pdf(render_export_html('pdf/exam.html', fragments), 'exam')
+
+    shared()  # Parse the stylesheet and load fonts/images once, as a running process would have
+    _, legacy_times = _timeit(legacy, repeat)
+    _, shared_times = _timeit(shared, repeat)
+
+    results = {'questions': questions, 'legacy': _summary(legacy_times), 'shared': _summary(shared_times)}
+    results['saved_ms'] = round(results['legacy']['median_ms'] - results['shared']['median_ms'], 2)
+    return results
+
+
+# --- Synthetic question bank ---
+
+IMAGE_EXTENSIONS = {'.png', '.jpg', '.jpeg', '.gif'}
+
+
+def media_images():
+    """ URLs of the uploaded images under MEDIA_ROOT, in a stable order. """
+    root = Path(settings.MEDIA_ROOT)
+    if not root.is_dir():
+        return []
+    return sorted(
+        settings.MEDIA_URL + path.relative_to(root).as_posix()
+        for path in root.rglob('*') if path.suffix.lower() in IMAGE_EXTENSIONS
+    )
+
+
+def synthetic_content(rng, index, formulas, image_url=None):
+    """ One question: some text, `formulas` formulas (inline or block) and optionally an image. """
+    parts = [f'<p>Questão sintética {index}: leia o enunciado e resolva os itens.</p>']
+    for item in range(formulas):
+        formula, style = rng.choice(SAMPLE_FORMULAS)
+        # A random term makes most formulas distinct, as in a real bank
+        formula = f'{formula} + {rng.randint(1, 999)}'
+        if style == 'block':
+            parts.append(f'<p>\\[{formula}\\]</p>')
+        else:
+            parts.append(f'<p>Item {item + 1}: calcule ##{formula}## para x = {rng.randint(1, 9)}.</p>')
+    if image_url:
+        parts.append(f'<p><img src="{image_url}" style="width: 50%;"></p>')
+    return ''.join(parts)
+
+
+def build_corpus(posts=200, formulas=4, images=0.25, seed=0):
+    """
+    Creates a reproducible synthetic bank: `posts` questions with `formulas`
+    formulas each, a share `images` of them with an image from media/.
+    Questions are bulk-created (no signals), so they are indexed for search here.
+    """
+    from .models import AreaDoConhecimento, Dificuldade, Post
+
+    rng = random.Random(seed)
+    image_urls = media_images()
+    areas = [AreaDoConhecimento.objects.create(name=f'Área sintética {i}') for i in range(5)]
+    levels = [Dificuldade.objects.create(name=name) for name in ('Fácil', 'Média', 'Difícil')]
+
+    created = []
+    for index in range(posts):
+        image_url = rng.choice(image_urls) if image_urls and rng.random() < images else None
+        created.append(Post(
+            title=f'Questão sintética {index}',
+            content=synthetic_content(rng, index, formulas, image_url),
+            area_do_conhecimento=rng.choice(areas),
+            dificuldade=rng.choice(levels),
+        ))
+    created = Post.objects.bulk_create(created, batch_size=500)
+    search.index_posts(created)
+    return created
+
+
+@contextmanager
+def _private_latex_cache():
+    """ A memory-only LaTeX cache, so runs start cold and the real cache is not touched. """
+    saved = utils._latex_cache
+    utils._latex_cache = RenderCache(memory_bytes=512 * 1024 * 1024)
+    try:
+        yield
+    finally:
+        utils._latex_cache = saved
+
+
+def _git_commit():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=settings.BASE_DIR,
+            capture_output=True, text=True, check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _time_each(func, items):
+    times = []
+    for item in items:
+        start = time.perf_counter()
+        func(item)
+        times.append(time.perf_counter() - start)
+    return times
+
+
+def _bench_formulas(corpus):
+    formulas = [(source, style) for post in corpus for source, style in _formula_sources(post.content)]
+    results = {}
+    with _private_latex_cache():
+        for phase in ('cold', 'warm'):
+            results[phase] = _percentiles(_time_each(lambda item: utils.latex_to_base64(item[0], style=item[1]), formulas))
+    return results
+
+
+def _formula_sources(html_content):
+    """ (source, style) of the top-level formulas of a question, as latex_to_base64 gets them. """
+    for kind, value in utils.tokenize_content(html_content):
+        if kind == utils.TOKEN_BLOCK:
+            yield value, 'block'
+        elif kind == utils.TOKEN_INLINE:
+            yield ''.join(sub_value for _, sub_value in value), 'inline'
+
+
+def _bench_process_content(corpus):
+    results = {}
+    with _private_latex_cache():
+        for phase in ('cold', 'warm'):
+            results[phase] = _percentiles(_time_each(utils.process_content_for_pdf, [post.content for post in corpus]))
+    return results
+
+
+def _bench_list_view(repeat):
+    from .views import PostListView
+
+    view = PostListView.as_view()
+    factory = RequestFactory()
+    results = {}
+    for name, params in (('first_page', {}), ('search', {'search': 'calcule'})):
+        def render():
+            view(factory.get('/', params)).render()
+        render()  # Facet counts and templates are cached in a running process
+        results[name] = _percentiles(_timeit(render, repeat)[1])
+    return results
+
+
+def _bench_exports(corpus, repeat):
+    try:
+        from . import pdf
+    except (ImportError, OSError) as e:
+        # OSError: WeasyPrint is installed but its system libraries are not
+        return {'skipped': str(e)}
+
+    from .models import Post, refresh_rendered_posts
+
+    # Formulas are timed above: the exports start from pre-rendered questions
+    refresh_rendered_posts(corpus)
+    queryset = Post.objects.filter(id__in=[post.pk for post in corpus])
+    saved = pdf._page_cache
+    results = {}
+    try:
+        for kind, builder in pdf.EXPORTS.items():
+            def export():
+                pdf._page_cache = None  # No laid-out pages from the previous run
+                return builder(queryset)
+            pdf_file, times = _timeit(export, repeat)
+            results[kind] = dict(_percentiles(times), pdf_bytes=len(pdf_file))
+    finally:
+        pdf._page_cache = saved
+    return results
+
+
+def bench_pipeline(repeat=3, posts=200, formulas=4, images=0.25, seed=0):
+    """
+    End to end timings on a synthetic bank: latex_to_base64 per formula and
+    process_content_for_pdf per question (cold and warm LaTeX cache), the
+    question list and every PDF export.
+    """
+    results = {
+        'environment': {
+            'commit': _git_commit(),
+            'python': platform.python_version(),
+            'django': django.get_version(),
+            'latex_format': utils.get_latex_format(),
+            'render_workers': utils.get_render_pool_size(),
+            'cpus': os.cpu_count(),
+        },
+    }
+    with transaction.atomic():
+        corpus = build_corpus(posts=posts, formulas=formulas, images=images, seed=seed)
+        results['corpus'] = {
+            'posts': posts, 'formulas_per_post': formulas, 'image_share': images, 'seed': seed,
+            'posts_with_images': sum('<img' in post.content for post in corpus),
+        }
+        with _private_latex_cache():
+            results['latex_to_base64'] = _bench_formulas(corpus)
+            results['process_content_for_pdf'] = _bench_process_content(corpus)
+            results['list_view'] = _bench_list_view(repeat)
+            results['exports'] = _bench_exports(corpus, repeat)
+        transaction.set_rollback(True)
+    return results
+
+
+# What a process does before its first request: settings, apps (and the
+# admin modules), then every view module through the URLconf
+STARTUP_SCRIPT = """
+import json, resource, sys, time
+start = time.perf_counter()
+import django
+django.setup()
+from django.urls import get_resolver
+get_resolver().url_patterns
+startup = time.perf_counter() - start
+from core import renderers
+warm_up = renderers.warm_up() if sys.argv[1:] == ['warm-up'] else None
+print(json.dumps({
+    'startup_s': startup,
+    'warm_up_s': warm_up,
+    'heavy_modules': renderers.loaded_modules(),
+    'max_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+}))
+"""
+
+
+def measure_startup(warm_up=False):
+    """ Runs STARTUP_SCRIPT in a new interpreter with the current settings and returns its report. """
+    env = dict(
+        os.environ,
+        DJANGO_SETTINGS_MODULE=settings.SETTINGS_MODULE,
+        PYTHONPATH=os.pathsep.join(path for path in sys.path if path),
+    )
+    args = [sys.executable, '-c', STARTUP_SCRIPT] + (['warm-up'] if warm_up else [])
+    completed = subprocess.run(args, env=env, cwd=settings.BASE_DIR, capture_output=True, text=True, check=True)
+    # The last line: WeasyPrint may print warnings before it
+    return json.loads(completed.stdout.strip().splitlines()[-1])
+
+
+def bench_startup(repeat=3):
+    """ Startup time and memory of a fresh process, with lazy renderers and after warm_up(). """
+    results = {}
+    for name, warm_up in (('lazy', False), ('warm_up', True)):
+        runs = [measure_startup(warm_up) for _ in range(repeat)]
+        results[name] = {
+            'startup': _summary([run['startup_s'] for run in runs]),
+            'max_rss_mb': statistics.median(run['max_rss_mb'] for run in runs),
+            'heavy_modules': runs[-1]['heavy_modules'],
+        }
+        if warm_up:
+            results[name]['warm_up'] = _summary([run['warm_up_s'] for run in runs])
+    return results
+
+
+SUITES = {
+    'math-formats': bench_math_formats,
+    'rasterizers': bench_rasterizers,
+    'export-layer': bench_export_layer,
+    'pipeline': bench_pipeline,
+    'startup': bench_startup,
+}
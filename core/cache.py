@@ -0,0 +1,299 @@
+import hashlib
+import io
+import logging
+import os
+import shutil
+import tempfile
+import threading
+from collections import OrderedDict
+from pathlib import Path
+
+logger = logging.getLogger('core.cache')
+
+
+def make_cache_key(*parts):
+    """ Stable content hash for a tuple of render parameters. """
+    digest = hashlib.sha256()
+    for part in parts:
+        digest.update(str(part).encode('utf-8'))
+        digest.update(b'\x00')
+    return digest.hexdigest()
+
+
+class RenderCache:
+    """
+    Two-level cache for rendered blobs (PNG bytes, etc.).
+
+    Level 1 is an in-process LRU bounded by total bytes.
+    Level 2 is a directory on disk, shared by every worker process and
+    bounded by total bytes as well (oldest files are evicted first).
+    """
+
+    def __init__(self, directory=None, memory_bytes=32 * 1024 * 1024, disk_bytes=512 * 1024 * 1024):
+        self.directory = Path(directory) if directory else None
+        self.memory_bytes = memory_bytes
+        self.disk_bytes = disk_bytes
+
+        self._memory = OrderedDict()
+        self._memory_size = 0
+        self._disk_size = None  # Computed lazily on first write
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    # --- Public API ---
+
+    def get(self, key):
+        with self._lock:
+            data = self._memory.get(key)
+            if data is not None:
+                self._memory.move_to_end(key)
+                self.hits += 1
+                self.memory_hits += 1
+                return data
+
+        data = self._disk_get(key)
+        with self._lock:
+            if data is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.disk_hits += 1
+            self._memory_set(key, data)
+        return data
+
+    def set(self, key, data):
+        with self._lock:
+            self._memory_set(key, data)
+        self._disk_set(key, data)
+
+    def open(self, key):
+        """
+        Like get(), as a binary file positioned at the start. Disk entries are
+        opened in place rather than read, so large blobs can be streamed.
+        """
+        with self._lock:
+            data = self._memory.get(key)
+            if data is not None:
+                self._memory.move_to_end(key)
+                self.hits += 1
+                self.memory_hits += 1
+                return io.BytesIO(data)
+
+        file = self._disk_open(key)
+        with self._lock:
+            if file is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self.disk_hits += 1
+        return file
+
+    def set_file(self, key, file, size):
+        """
+        Like set(), from a binary file of `size` bytes (read from its current
+        position). Only blobs up to 1/16 of the memory budget are kept in memory.
+        """
+        start = file.tell()
+        if size <= self.memory_bytes // 16:
+            data = file.read()
+            file.seek(start)
+            with self._lock:
+                self._memory_set(key, data)
+        self._disk_write(key, lambda tmp: shutil.copyfileobj(file, tmp), size)
+        file.seek(start)
+
+    def contains(self, key):
+        """ Checks both levels without touching the hit/miss counters. """
+        with self._lock:
+            if key in self._memory:
+                return True
+        path = self._path_for(key)
+        return path is not None and path.exists()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'memory_hits': self.memory_hits,
+                'disk_hits': self.disk_hits,
+                'misses': self.misses,
+                'hit_ratio': (self.hits / lookups) if lookups else 0.0,
+                'memory_entries': len(self._memory),
+                'memory_bytes': self._memory_size,
+            }
+
+    def clear(self, disk=False):
+        with self._lock:
+            self._memory.clear()
+            self._memory_size = 0
+            self.hits = self.memory_hits = self.disk_hits = self.misses = 0
+        if disk and self.directory and self.directory.exists():
+            for path in self._iter_disk_files():
+                path.unlink(missing_ok=True)
+            self._disk_size = 0
+
+    # --- Memory level ---
+
+    def _memory_set(self, key, data):
+        # Caller must hold the lock
+        if len(data) > self.memory_bytes:
+            return
+        old = self._memory.pop(key, None)
+        if old is not None:
+            self._memory_size -= len(old)
+        self._memory[key] = data
+        self._memory_size += len(data)
+        while self._memory_size > self.memory_bytes:
+            _, evicted = self._memory.popitem(last=False)
+            self._memory_size -= len(evicted)
+
+    # --- Disk level ---
+
+    def _path_for(self, key):
+        if not self.directory:
+            return None
+        return self.directory / key[:2] / key
+
+    def _iter_disk_files(self):
+        for sub in self.directory.iterdir():
+            if sub.is_dir():
+                yield from (p for p in sub.iterdir() if p.is_file())
+
+    def _disk_get(self, key):
+        file = self._disk_open(key)
+        if file is None:
+            return None
+        with file:
+            try:
+                return file.read()
+            except OSError:
+                return None
+
+    def _disk_open(self, key):
+        path = self._path_for(key)
+        if path is None:
+            return None
+        try:
+            file = path.open('rb')
+        except OSError:
+            return None
+        try:
+            # Refresh mtime so disk eviction behaves like an LRU
+            os.utime(path)
+        except OSError:
+            pass
+        return file
+
+    def _disk_set(self, key, data):
+        self._disk_write(key, lambda tmp: tmp.write(data), len(data))
+
+    def _disk_write(self, key, write, size):
+        path = self._path_for(key)
+        if path is None or self.disk_bytes <= 0:
+            return
+        try:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            # Write to a temp file first so other processes never see partial files
+            fd, tmp_name = tempfile.mkstemp(dir=path.parent, prefix='.tmp-')
+            with os.fdopen(fd, 'wb') as tmp:
+                write(tmp)
+            os.replace(tmp_name, path)
+        except OSError as e:
+            logger.warning("Render cache write failed: %s | Key: %s", e, key)
+            return
+
+        with self._lock:
+            if self._disk_size is None:
+                self._disk_size = sum(p.stat().st_size for p in self._iter_disk_files())
+            else:
+                self._disk_size += size
+            over_budget = self._disk_size > self.disk_bytes
+        if over_budget:
+            self._evict_disk()
+
+    def _evict_disk(self):
+        """ Removes the least recently used files until we are under 90% of the budget. """
+        entries = []
+        for path in self._iter_disk_files():
+            try:
+                st = path.stat()
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, path))
+        entries.sort()
+
+        total = sum(size for _, size, _ in entries)
+        target = int(self.disk_bytes * 0.9)
+        for _, size, path in entries:
+            if total <= target:
+                break
+            path.unlink(missing_ok=True)
+            total -= size
+
+        with self._lock:
+            self._disk_size = total
+
+
+class ObjectCache:
+    """
+    In-process LRU for objects that cannot be stored as bytes (e.g. laid-out
+    WeasyPrint documents). Bounded by number of entries and, with `max_bytes`,
+    by the total of the sizes given to set() (estimates: the objects are live).
+    """
+
+    def __init__(self, max_entries=256, max_bytes=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()  # key -> (value, size)
+        self._size = 0
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def set(self, key, value, size=0):
+        if self.max_entries <= 0 or (self.max_bytes is not None and size > self.max_bytes):
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._size -= old[1]
+            self._entries[key] = (value, size)
+            self._size += size
+            while len(self._entries) > self.max_entries or (
+                self.max_bytes is not None and self._size > self.max_bytes
+            ):
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self._size -= evicted_size
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': (self.hits / lookups) if lookups else 0.0,
+                'entries': len(self._entries),
+                'bytes': self._size,
+            }
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+            self.hits = self.misses = 0
@@ -0,0 +1,74 @@
+"""
+Area x difficulty filter counts for the question list.
+
+The counts of every (area, difficulty) pair come from one grouped query over
+Post and are kept in Django's cache, together with the names of the options,
+so the filter bar costs no query on a hit. The Post, area and difficulty
+signals in core.signals drop the entry; FACET_COUNTS_TIMEOUT bounds how long
+other processes (with a per-process cache backend) can show stale counts.
+
+The counts follow the area and difficulty filters, not the search text.
+"""
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Count
+
+from .models import AreaDoConhecimento, Dificuldade, Post
+
+FACET_CACHE_KEY = 'core:facet-counts:v1'
+
+
+def parse_facet_id(value):
+    """ Filter id from the query string, or None when missing or malformed. """
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _build_facets():
+    cells = (
+        Post.objects.order_by()
+        .values_list('area_do_conhecimento_id', 'dificuldade_id')
+        .annotate(count=Count('id'))
+    )
+    return {
+        'areas': list(AreaDoConhecimento.objects.order_by('name').values_list('id', 'name')),
+        'difficulties': list(Dificuldade.objects.order_by('name').values_list('id', 'name')),
+        'cells': list(cells),
+    }
+
+
+def get_facets():
+    facets = cache.get(FACET_CACHE_KEY)
+    if facets is None:
+        facets = _build_facets()
+        cache.set(FACET_CACHE_KEY, facets, getattr(settings, 'FACET_COUNTS_TIMEOUT', 300))
+    return facets
+
+
+def invalidate_facets():
+    cache.delete(FACET_CACHE_KEY)
+
+
+def facet_counts(area_id=None, dificuldade_id=None):
+    """
+    Options of both filters with their counts. Each facet is counted with the
+    other one applied, so every number is what choosing that option would show.
+    Returns (areas, difficulties, area_total, difficulty_total), where the
+    options are dicts with id, name and count.
+    """
+    facets = get_facets()
+    by_area, by_difficulty = {}, {}
+    area_total = difficulty_total = 0
+    for area, difficulty, count in facets['cells']:
+        if dificuldade_id is None or difficulty == dificuldade_id:
+            by_area[area] = by_area.get(area, 0) + count
+            area_total += count
+        if area_id is None or area == area_id:
+            by_difficulty[difficulty] = by_difficulty.get(difficulty, 0) + count
+            difficulty_total += count
+
+    areas = [{'id': pk, 'name': name, 'count': by_area.get(pk, 0)} for pk, name in facets['areas']]
+    difficulties = [{'id': pk, 'name': name, 'count': by_difficulty.get(pk, 0)} for pk, name in facets['difficulties']]
+    return areas, difficulties, area_total, difficulty_total
@@ -0,0 +1,123 @@
+"""
+Print-resolution copies of uploaded images for the PDF exports.
+
+Summernote keeps uploads as they come (often multi-megapixel phone photos).
+An export only needs enough pixels to fill the widest box the image can take
+in its layout, so each image gets a downscaled, recompressed derivative per
+target width. Derivatives are cached on disk, keyed by source path + mtime,
+created on upload and otherwise on the first export that needs them.
+"""
+import io
+import logging
+
+from django.conf import settings
+from PIL import Image, ImageOps
+
+from . import metrics
+from .cache import RenderCache, make_cache_key
+
+# Bump whenever the way derivatives are produced changes
+IMAGE_DERIVATIVE_VERSION = 2
+
+# Widest box an image can fill in each export layout, in mm:
+# one exam column (A4 - 2 x 1cm margins - 1cm gap, halved) and the ABNT text block
+LAYOUT_WIDTHS_MM = {
+    'exam': 90,
+    'selected': 160,
+    'abnt': 160,
+}
+
+# EXIF orientations that swap width and height
+_ROTATED_ORIENTATIONS = {5, 6, 7, 8}
+
+logger = logging.getLogger('core.images')
+
+_derivative_cache = None
+
+def get_derivative_cache():
+    """ Process-wide cache for image derivatives (memory LRU + disk). """
+    global _derivative_cache
+    if _derivative_cache is None:
+        _derivative_cache = RenderCache(
+            directory=getattr(settings, 'PDF_IMAGE_DERIVATIVES_DIR', None),
+            memory_bytes=getattr(settings, 'PDF_IMAGE_DERIVATIVES_MEMORY_BYTES', 16 * 1024 * 1024),
+            disk_bytes=getattr(settings, 'PDF_IMAGE_DERIVATIVES_DISK_BYTES', 512 * 1024 * 1024),
+        )
+    return _derivative_cache
+
+metrics.register_cache('image_derivatives', get_derivative_cache)
+
+def layout_width_px(layout):
+    dpi = getattr(settings, 'PDF_IMAGE_DPI', 200)
+    return round(LAYOUT_WIDTHS_MM[layout] / 25.4 * dpi)
+
+def image_mime_type(img_bytes):
+    return 'image/png' if img_bytes.startswith(b'\x89PNG') else 'image/jpeg'
+
+def make_derivative(path, max_width):
+    """
+    Downscaled copy of an image (PNG, or any image with transparency, is saved
+    as PNG; anything else becomes JPEG).
+    Returns None when the original is already small enough to be used as is.
+    """
+    with Image.open(path) as img:
+        if getattr(img, 'is_animated', False):
+            return None
+        # JPEG has no alpha channel: transparent GIF/WebP/TIFF images stay PNG
+        keep_png = img.format == 'PNG' or img.has_transparency_data
+
+        width, height = img.size
+        if img.getexif().get(0x0112) in _ROTATED_ORIENTATIONS:
+            width, height = height, width
+        if width <= max_width:
+            return None
+
+        # JPEG only: decode at a reduced scale (still at least the target size)
+        target = (max_width, max(1, height * max_width // width))
+        img.draft('RGB', target if width == img.width else target[::-1])
+        img = ImageOps.exif_transpose(img)
+        img.thumbnail((max_width, img.height), Image.LANCZOS)
+
+        output = io.BytesIO()
+        if keep_png:
+            img.save(output, format='PNG', optimize=True)
+        else:
+            if img.mode != 'RGB':
+                img = img.convert('RGB')
+            quality = getattr(settings, 'PDF_IMAGE_JPEG_QUALITY', 85)
+            img.save(output, format='JPEG', quality=quality, optimize=True, progressive=True)
+
+    data = output.getvalue()
+    # Recompressing a small, already optimized file can make it bigger
+    return data if len(data) < path.stat().st_size else None
+
+def derivative_for(path, layout):
+    """
+    Print copy of the image at `path` for an export layout, as (bytes, mime type).
+    Returns None when the original file should be used.
+    """
+    try:
+        st = path.stat()
+        max_width = layout_width_px(layout)
+        key = make_cache_key(
+            'image', str(path), st.st_mtime_ns, st.st_size, max_width,
+            getattr(settings, 'PDF_IMAGE_JPEG_QUALITY', 85), IMAGE_DERIVATIVE_VERSION,
+        )
+        cache = get_derivative_cache()
+        data = cache.get(key)
+        if data is None:
+            # b'' records "keep the original" so the image is not opened again
+            data = make_derivative(path, max_width) or b''
+            cache.set(key, data)
+    except Exception as e:
+        logger.warning("Image derivative failed: %s | Path: %s", e, path)
+        return None
+
+    if not data:
+        return None
+    return data, image_mime_type(data)
+
+def create_derivatives(path):
+    """ Builds the derivatives of every layout ahead of the first export. """
+    for layout in LAYOUT_WIDTHS_MM:
+        derivative_for(path, layout)
@@ -0,0 +1,280 @@
+"""
+Bulk import of questions from JSON Lines or CSV (`manage.py import_questions`).
+
+Each record has a title, the HTML content and optionally an area name, a
+difficulty name, image files, a creation date and the colors to give an
+area or difficulty that has to be created. Records are read one at a time and saved
+with bulk_create in batches, each batch in its own transaction. Areas and
+difficulties are looked up by name (case-insensitive) in a dict loaded once,
+and created when missing.
+
+bulk_create sends no post_save signals, so the importer does what the Post
+receivers would: it indexes the new questions for search and drops the
+cached filter counts.
+"""
+import csv
+import json
+import re
+import sys
+import time
+from pathlib import Path
+
+from django.core.files import File
+from django.db import transaction
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from django_summernote.utils import get_attachment_model
+
+from .facets import invalidate_facets
+from .models import AreaDoConhecimento, Dificuldade, Post
+from .search import index_posts
+from .utils import prerender_formulas
+
+FORMATS = ('jsonl', 'csv')
+
+
+class InvalidRecord(ValueError):
+    """ A record that cannot be imported (the import goes on with the next one). """
+
+
+def detect_format(path):
+    return 'csv' if Path(path).suffix.lower() == '.csv' else 'jsonl'
+
+
+def read_records(file, fmt):
+    """
+    Yields (line number, record) from an open text file, one record at a time.
+    Records are dicts (CSV) or JSON text (JSON Lines), parsed by
+    QuestionImporter.add so that a malformed line is skipped like any bad record.
+    """
+    if fmt == 'csv':
+        # HTML content can be longer than the default 128 KB field limit
+        # (the limit is a C long: 32 bits on Windows)
+        csv.field_size_limit(min(sys.maxsize, 2 ** 31 - 1))
+        reader = csv.DictReader(file)
+        for record in reader:
+            yield reader.line_num, record
+        return
+
+    for line_number, line in enumerate(file, start=1):
+        if line.strip():
+            yield line_number, line
+
+
+def _color(value):
+    """ Color of a new area or difficulty, if the record gives a valid one. """
+    if isinstance(value, str) and re.fullmatch(r'#[0-9a-fA-F]{6}', value.strip()):
+        return {'color': value.strip()}
+    return {}
+
+
+def _text(record, *names):
+    """ The first of `names` the record has, as a string ('' when missing). """
+    for name in names:
+        value = record.get(name)
+        if value is None or value == '':
+            continue
+        if not isinstance(value, str):
+            raise InvalidRecord(f"{name} must be text, not {type(value).__name__}")
+        return value
+    return ''
+
+
+def _image_paths(value):
+    """ `images` is a list in JSON Lines, a ;-separated string in CSV. """
+    if not value:
+        return []
+    if isinstance(value, str):
+        value = value.split(';')
+    if not isinstance(value, list) or not all(isinstance(path, str) for path in value):
+        raise InvalidRecord("images must be a list of file names")
+    return [path.strip() for path in value if path.strip()]
+
+
+class QuestionImporter:
+    """ Imports records in batches; see import_file() for the usual entry point. """
+
+    def __init__(self, batch_size=500, prerender=False, images_dir='.', skip_existing=False):
+        self.batch_size = max(1, batch_size)
+        self.prerender = prerender
+        self.images_dir = Path(images_dir)
+        # Questions with the title and creation date of one already in the bank are not saved again
+        self.skip_existing = skip_existing
+
+        # Names are matched case-insensitively, without surrounding spaces
+        self.areas = {area.name.strip().casefold(): area for area in AreaDoConhecimento.objects.all()}
+        self.difficulties = {level.name.strip().casefold(): level for level in Dificuldade.objects.all()}
+        self.image_urls = {}
+
+        self.imported = 0
+        self.skipped = []
+        self.existing = 0
+        self.created_areas = 0
+        self.created_difficulties = 0
+        self.started = time.perf_counter()
+        self._batch = []
+
+    # --- Lookups ---
+
+    def _area(self, name, color=None):
+        name = (name or '').strip()
+        if not name:
+            return None
+        area = self.areas.get(name.casefold())
+        if area is None:
+            area = self.areas[name.casefold()] = AreaDoConhecimento.objects.create(name=name, **_color(color))
+            self.created_areas += 1
+        return area
+
+    def _difficulty(self, name, color=None):
+        name = (name or '').strip()
+        if not name:
+            return None
+        level = self.difficulties.get(name.casefold())
+        if level is None:
+            level = self.difficulties[name.casefold()] = Dificuldade.objects.create(name=name, **_color(color))
+            self.created_difficulties += 1
+        return level
+
+    def _image_url(self, path):
+        """ Stores an image as a Summernote attachment (once per import) and returns its URL. """
+        if path not in self.image_urls:
+            source = self.images_dir / path
+            if not source.is_file():
+                raise InvalidRecord(f"image not found: {source}")
+            attachment = get_attachment_model()(name=source.name)
+            with source.open('rb') as f:
+                attachment.file.save(source.name, File(f), save=True)
+            self.image_urls[path] = attachment.file.url
+        return self.image_urls[path]
+
+    # --- Records ---
+
+    def build_post(self, record):
+        # Every field is checked before anything (area, image) is created
+        title = _text(record, 'title').strip()
+        content = _text(record, 'content')
+        area = _text(record, 'area')
+        level = _text(record, 'dificuldade', 'difficulty')
+        image_paths = _image_paths(record.get('images'))
+        if not title:
+            raise InvalidRecord("missing title")
+        max_length = Post._meta.get_field('title').max_length
+        if len(title) > max_length:
+            raise InvalidRecord(f"title longer than {max_length} characters")
+        if not content.strip():
+            raise InvalidRecord("missing content")
+
+        created_at = None
+        if record.get('created_at'):
+            try:
+                created_at = parse_datetime(str(record['created_at']))
+            except ValueError:
+                created_at = None
+            if created_at is None:
+                raise InvalidRecord(f"invalid created_at: {record['created_at']}")
+            if timezone.is_naive(created_at):
+                created_at = timezone.make_aware(created_at)
+
+        # Images referenced by file name in the content point to their upload;
+        # the others are appended after the content
+        for path in image_paths:
+            url = self._image_url(path)
+            referenced = False
+            for quote in ('"', "'"):
+                if f'src={quote}{path}{quote}' in content:
+                    content = content.replace(f'src={quote}{path}{quote}', f'src="{url}"')
+                    referenced = True
+            if not referenced:
+                content += f'<p><img src="{url}" style="width: 50%;"></p>'
+
+        post = Post(
+            title=title,
+            content=content,
+            area_do_conhecimento=self._area(area, record.get('area_color')),
+            dificuldade=self._difficulty(level, record.get('dificuldade_color')),
+        )
+        post.imported_created_at = created_at
+        return post
+
+    def add(self, line_number, record):
+        """ Queues a record, saving the batch once it is full. Returns how many questions were saved. """
+        try:
+            if isinstance(record, str):
+                try:
+                    record = json.loads(record)
+                except ValueError as e:
+                    raise InvalidRecord(f"invalid JSON ({e})")
+            if not isinstance(record, dict):
+                raise InvalidRecord("a record must be an object")
+            self._batch.append(self.build_post(record))
+        except InvalidRecord as e:
+            self.skipped.append((line_number, str(e)))
+            return 0
+        if len(self._batch) >= self.batch_size:
+            return self.flush()
+        return 0
+
+    def flush(self):
+        """ Saves the pending batch. Returns how many questions it had. """
+        posts, self._batch = self._batch, []
+        if self.skip_existing:
+            posts = self._new_posts(posts)
+        if not posts:
+            return 0
+        if self.prerender:
+            # All formulas of the batch rendered at once, in the worker pool;
+            # the print-ready fragments are then saved with the questions
+            prerender_formulas(post.content for post in posts)
+            for post in posts:
+                post.refresh_rendered_content(save=False)
+        with transaction.atomic():
+            posts = Post.objects.bulk_create(posts)
+            # created_at is auto_now_add: dates from the file are set after the insert
+            dated = [post for post in posts if post.imported_created_at]
+            for post in dated:
+                post.created_at = post.imported_created_at
+            Post.objects.bulk_update(dated, ['created_at'])
+            index_posts(posts)
+        self.imported += len(posts)
+        return len(posts)
+
+    def _new_posts(self, posts):
+        """ The posts of a batch that are not in the bank yet (one query per batch). """
+        dated = [post for post in posts if post.imported_created_at]
+        existing = set(Post.objects.filter(
+            title__in={post.title for post in dated},
+            created_at__in={post.imported_created_at for post in dated},
+        ).values_list('title', 'created_at'))
+        new = [post for post in posts if (post.title, post.imported_created_at) not in existing]
+        self.existing += len(posts) - len(new)
+        return new
+
+    def finish(self):
+        self.flush()
+        invalidate_facets()
+
+    @property
+    def elapsed(self):
+        return time.perf_counter() - self.started
+
+    @property
+    def rate(self):
+        return self.imported / self.elapsed if self.elapsed else 0.0
+
+
+def import_file(path, fmt=None, batch_size=500, prerender=False, images_dir=None, progress=None):
+    """
+    Imports every record of a JSON Lines or CSV file. Image paths are relative
+    to `images_dir` (default: the file's directory). `progress(importer)` is
+    called after each batch. Returns the importer, with its counts.
+    """
+    path = Path(path)
+    fmt = fmt or detect_format(path)
+    importer = QuestionImporter(batch_size, prerender, images_dir or path.parent)
+    with path.open(newline='', encoding='utf-8') as file:
+        for line_number, record in read_records(file, fmt):
+            if importer.add(line_number, record) and progress is not None:
+                progress(importer)
+    importer.finish()
+    return importer
@@ -0,0 +1,200 @@
+"""
+Background PDF exports.
+
+Jobs are rows of ExportJob (no external broker). They are executed either by
+a local thread pool inside the web process (EXPORT_JOBS_MODE = 'thread') or
+by `python manage.py run_export_worker` (EXPORT_JOBS_MODE = 'worker').
+"""
+import logging
+import threading
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.files import File
+from django.db import close_old_connections
+from django.db.models import Case, When
+from django.utils import timezone
+
+from .models import ExportJob, Post
+from .pdf_cache import export_cache_key, open_or_build_pdf
+from .timing import export_timing, stage
+from .utils import uses_render_pool
+
+logger = logging.getLogger('core.jobs')
+
+_executor = None
+# Jobs handed to the thread pool of this process
+_submitted = set()
+# Thread mode has no worker loop: finished jobs trigger the cleanup of old exports
+_last_cleanup = None
+_cleanup_lock = threading.Lock()
+
+
+def _get_executor():
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(
+            max_workers=getattr(settings, 'EXPORT_JOBS_WORKERS', 2),
+            thread_name_prefix='pdf-export',
+        )
+    return _executor
+
+
+def submit_export_job(kind, post_ids):
+    """ Creates the job and, in 'thread' mode, starts it right away. """
+    job = ExportJob.objects.create(kind=kind, post_ids=[int(pk) for pk in post_ids])
+    if getattr(settings, 'EXPORT_JOBS_MODE', 'thread') == 'thread':
+        _submit_to_thread(job.pk)
+    return job
+
+
+def _submit_to_thread(job_pk):
+    _submitted.add(job_pk)
+    _get_executor().submit(_run_in_thread, job_pk)
+
+
+def _run_in_thread(job_pk):
+    close_old_connections()
+    try:
+        job = claim_job(job_pk)
+        if job is not None:
+            run_export_job(job)
+        _maybe_cleanup()
+    finally:
+        _submitted.discard(job_pk)
+        close_old_connections()
+
+
+def _maybe_cleanup():
+    """ Runs cleanup_old_exports() at most every EXPORT_JOBS_CLEANUP_INTERVAL seconds per process. """
+    global _last_cleanup
+    with _cleanup_lock:
+        if _last_cleanup is not None and time.monotonic() - _last_cleanup < getattr(settings, 'EXPORT_JOBS_CLEANUP_INTERVAL', 3600):
+            return
+        _last_cleanup = time.monotonic()
+    try:
+        cleanup_old_exports()
+    except Exception:
+        logger.exception("Export cleanup failed")
+
+
+def fail_stalled_jobs(timeout=None):
+    """
+    Marks as failed the jobs running for more than EXPORT_JOBS_TIMEOUT seconds:
+    their thread or worker process died (or the server restarted) mid-export.
+    Returns how many there were.
+    """
+    if timeout is None:
+        timeout = getattr(settings, 'EXPORT_JOBS_TIMEOUT', 30 * 60)
+    return ExportJob.objects.filter(
+        status=ExportJob.STATUS_RUNNING, started_at__lt=timezone.now() - timedelta(seconds=timeout),
+    ).update(
+        status=ExportJob.STATUS_FAILED, finished_at=timezone.now(),
+        error=f"The export did not finish within {timeout} seconds.",
+    )
+
+
+def recover_job(job):
+    """
+    Called when a job is polled. Fails it if it stalled and, in 'thread' mode,
+    runs a pending job that no thread of this process has (it was queued
+    before a restart, and no worker polls the queue in this mode).
+    Returns the job, reloaded if it changed.
+    """
+    if job.status == ExportJob.STATUS_RUNNING and fail_stalled_jobs():
+        job.refresh_from_db()
+    elif (job.status == ExportJob.STATUS_PENDING and job.pk not in _submitted
+          and getattr(settings, 'EXPORT_JOBS_MODE', 'thread') == 'thread'):
+        # claim_job() keeps it from running twice if another process has it too
+        _submit_to_thread(job.pk)
+    return job
+
+
+def claim_job(job_pk):
+    """ Marks a pending job as running. Returns None if another worker got it first. """
+    claimed = ExportJob.objects.filter(pk=job_pk, status=ExportJob.STATUS_PENDING).update(
+        status=ExportJob.STATUS_RUNNING, started_at=timezone.now(),
+    )
+    return ExportJob.objects.get(pk=job_pk) if claimed else None
+
+
+def claim_next_job():
+    fail_stalled_jobs()
+    for job_pk in ExportJob.objects.filter(status=ExportJob.STATUS_PENDING).order_by('created_at').values_list('pk', flat=True):
+        job = claim_job(job_pk)
+        if job is not None:
+            return job
+    return None
+
+
+def _queryset_for(job):
+    queryset = Post.objects.filter(id__in=job.post_ids)
+    if job.kind == 'abnt':
+        # Keep the order of the admin selection
+        queryset = queryset.order_by(Case(*[When(id=pk, then=pos) for pos, pk in enumerate(job.post_ids)]))
+    return queryset
+
+
+@uses_render_pool
+def run_export_job(job):
+    try:
+        # Same stage timings in the log as the synchronous exports
+        with export_timing(job.kind, endpoint='export_job'):
+            with stage('db'):
+                key = export_cache_key(job.kind, job.post_ids)
+            pdf_file = open_or_build_pdf(job.kind, _queryset_for(job), key)
+        with pdf_file:
+            job.file.save(job.filename, File(pdf_file), save=False)
+        job.status = ExportJob.STATUS_DONE
+    except Exception:
+        job.status = ExportJob.STATUS_FAILED
+        job.error = traceback.format_exc()
+        logger.error("Export job #%s failed\n%s", job.pk, job.error)
+    job.finished_at = timezone.now()
+    job.save(update_fields=['file', 'status', 'error', 'finished_at'])
+    return job
+
+
+def run_pending_jobs(poll_interval=2.0, once=False, cleanup_every=None):
+    """ Worker loop used by the run_export_worker command. """
+    if cleanup_every is None:
+        cleanup_every = getattr(settings, 'EXPORT_JOBS_CLEANUP_INTERVAL', 3600)
+    last_cleanup = 0
+    while True:
+        if time.monotonic() - last_cleanup > cleanup_every:
+            cleanup_old_exports()
+            last_cleanup = time.monotonic()
+
+        job = claim_next_job()
+        if job is not None:
+            run_export_job(job)
+            continue
+        if once:
+            return
+        close_old_connections()
+        time.sleep(poll_interval)
+
+
+def cleanup_old_exports(max_age=None):
+    """
+    Deletes finished jobs (and their files) older than EXPORT_JOBS_MAX_AGE
+    seconds, after failing the stalled ones so that they get deleted in turn.
+    """
+    fail_stalled_jobs()
+    if max_age is None:
+        max_age = getattr(settings, 'EXPORT_JOBS_MAX_AGE', 24 * 3600)
+    cutoff = timezone.now() - timedelta(seconds=max_age)
+
+    old_jobs = ExportJob.objects.filter(
+        status__in=[ExportJob.STATUS_DONE, ExportJob.STATUS_FAILED], finished_at__lt=cutoff,
+    )
+    removed = 0
+    for job in old_jobs:
+        if job.file:
+            job.file.delete(save=False)
+        job.delete()
+        removed += 1
+    return removed
@@ -0,0 +1,41 @@
+import inspect
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from core import metrics
+from core.benchmarks import SUITES
+from core.utils import uses_render_pool
+
+# Options of the synthetic question bank (pipeline suite)
+CORPUS_OPTIONS = ('posts', 'formulas', 'images', 'seed')
+
+
+class Command(BaseCommand):
+    help = "Runs a benchmark suite of the rendering pipeline and prints the results as JSON."
+
+    def add_arguments(self, parser):
+        parser.add_argument('suite', choices=sorted(SUITES))
+        parser.add_argument('--repeat', type=int, default=3, help="Timed runs per measurement.")
+        parser.add_argument('--posts', type=int, help="Questions in the synthetic bank (default 200).")
+        parser.add_argument('--formulas', type=int, help="Formulas per question (default 4).")
+        parser.add_argument('--images', type=float, help="Share of questions with an image from media/ (default 0.25).")
+        parser.add_argument('--seed', type=int, help="Seed of the synthetic bank (default 0).")
+        parser.add_argument('--output', help="Also write the JSON results to this file.")
+
+    @uses_render_pool
+    def handle(self, *args, **options):
+        # Benchmark renders and exports are not traffic: kept out of the deployment's /metrics/
+        metrics.local_only()
+        suite = SUITES[options['suite']]
+        kwargs = {name: options[name] for name in CORPUS_OPTIONS if options[name] is not None}
+        unsupported = set(kwargs) - set(inspect.signature(suite).parameters)
+        if unsupported:
+            raise CommandError(f"The {options['suite']} suite does not take --{', --'.join(sorted(unsupported))}.")
+
+        results = suite(repeat=options['repeat'], **kwargs)
+        output = json.dumps(results, indent=2)
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                f.write(output + '\n')
+        self.stdout.write(output)
@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from core.jobs import cleanup_old_exports
+
+
+class Command(BaseCommand):
+    help = "Deletes finished background PDF exports older than EXPORT_JOBS_MAX_AGE."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--max-age', type=int, default=None, help="Age in seconds (default: EXPORT_JOBS_MAX_AGE).")
+
+    def handle(self, *args, **options):
+        removed = cleanup_old_exports(options['max_age'])
+        self.stdout.write(f"Removed {removed} export(s).")
@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand
+
+from core.archive import export_archive
+
+
+class Command(BaseCommand):
+    help = "Writes every question and the media files they reference to a ZIP archive (see import_bank)."
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help="Archive to write.")
+        parser.add_argument('--chunk-size', type=int, default=500, help="Questions fetched from the database at a time.")
+
+    def handle(self, *args, **options):
+        manifest = export_archive(options['path'], chunk_size=options['chunk_size'])
+        for path in manifest['missing_media']:
+            self.stderr.write(f"Referenced media file not found: {path}")
+        self.stdout.write(
+            f"Exported {manifest['questions']} question(s) and {manifest['media_files']} media file(s) to {options['path']}."
+        )
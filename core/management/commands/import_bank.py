@@ -0,0 +1,35 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from core.archive import ArchiveError, import_archive
+from core.utils import uses_render_pool
+
+
+class Command(BaseCommand):
+    help = "Restores the questions and media files of an archive written by export_bank."
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help="Archive to read.")
+        parser.add_argument('--batch-size', type=int, default=500, help="Questions saved per transaction.")
+        parser.add_argument('--prerender', action='store_true',
+                            help="Render the formulas (in parallel) and store the PDF fragments while importing.")
+
+    @uses_render_pool
+    def handle(self, *args, **options):
+        def progress(importer):
+            self.stdout.write(f"{importer.imported} question(s) imported ({importer.rate:.1f}/s)")
+
+        try:
+            manifest, importer, media_files = import_archive(
+                options['path'], batch_size=options['batch_size'], prerender=options['prerender'], progress=progress,
+            )
+        except (ArchiveError, OSError) as e:
+            raise CommandError(f"Cannot import {options['path']}: {e}")
+
+        for line_number, error in importer.skipped:
+            self.stderr.write(f"Line {line_number} skipped: {error}")
+        self.stdout.write(
+            f"Imported {importer.imported} of {manifest['questions']} question(s) in {importer.elapsed:.1f}s "
+            f"({importer.rate:.1f}/s) and {media_files} new media file(s)."
+        )
+        if importer.existing:
+            self.stdout.write(f"{importer.existing} question(s) were already in the bank.")
@@ -0,0 +1,40 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from core.importer import FORMATS, import_file
+from core.utils import uses_render_pool
+
+
+class Command(BaseCommand):
+    help = (
+        "Imports questions from a JSON Lines or CSV file (fields: title, content, area, "
+        "dificuldade, images). Image paths are relative to the file unless --images-dir is given."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('path')
+        parser.add_argument('--format', choices=FORMATS, help="Default: from the file extension (.csv, else JSON Lines).")
+        parser.add_argument('--batch-size', type=int, default=500, help="Questions saved per transaction.")
+        parser.add_argument('--prerender', action='store_true',
+                            help="Render the formulas (in parallel) and store the PDF fragments while importing.")
+        parser.add_argument('--images-dir', help="Directory the image paths are relative to.")
+
+    @uses_render_pool
+    def handle(self, *args, **options):
+        def progress(importer):
+            self.stdout.write(f"{importer.imported} question(s) imported ({importer.rate:.1f}/s)")
+
+        try:
+            importer = import_file(
+                options['path'], fmt=options['format'], batch_size=options['batch_size'],
+                prerender=options['prerender'], images_dir=options['images_dir'], progress=progress,
+            )
+        except (OSError, UnicodeDecodeError) as e:
+            raise CommandError(f"Cannot read {options['path']}: {e}")
+
+        for line_number, error in importer.skipped:
+            self.stderr.write(f"Line {line_number} skipped: {error}")
+        self.stdout.write(
+            f"Imported {importer.imported} question(s) in {importer.elapsed:.1f}s ({importer.rate:.1f}/s), "
+            f"{len(importer.skipped)} skipped. Created {importer.created_areas} area(s) "
+            f"and {importer.created_difficulties} difficulty level(s)."
+        )
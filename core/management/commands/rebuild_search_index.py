@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from core.search import rebuild_search_index
+
+
+class Command(BaseCommand):
+    help = "Recreates the full-text search index of the questions (SQLite FTS5)."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500, help="Questions indexed per batch.")
+
+    def handle(self, *args, **options):
+        total = rebuild_search_index(options['batch_size'])
+        self.stdout.write(f"Indexed {total} question(s).")
@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from core.jobs import run_pending_jobs
+
+
+class Command(BaseCommand):
+    help = "Runs queued background PDF exports (use with EXPORT_JOBS_MODE = 'worker')."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true', help="Exit when the queue is empty.")
+        parser.add_argument('--poll-interval', type=float, default=2.0, help="Seconds between queue checks.")
+
+    def handle(self, *args, **options):
+        run_pending_jobs(poll_interval=options['poll_interval'], once=options['once'])
@@ -0,0 +1,70 @@
+import time
+from datetime import datetime
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
+
+from core import metrics
+from core.models import Post
+from core.utils import LATEX_FORMATS, get_render_pool_size, uses_render_pool, warm_latex_cache
+
+
+def parse_since(value):
+    """ An ISO date or date/time, in the current time zone when it has none. """
+    since = parse_datetime(value)
+    if since is None:
+        date = parse_date(value)
+        if date is None:
+            return None
+        since = datetime.combine(date, datetime.min.time())
+    if timezone.is_naive(since):
+        since = timezone.make_aware(since)
+    return since
+
+
+class Command(BaseCommand):
+    help = (
+        "Renders every unique formula of the question bank into the LaTeX cache, so the first "
+        "exports after a deploy or a cache wipe do not rasterize them. Cached formulas are skipped."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--since', help="Only questions changed since this date or date/time (ISO 8601).")
+        parser.add_argument('--format', choices=sorted(LATEX_FORMATS),
+                            help="Image format to render (default: LATEX_OUTPUT_FORMAT).")
+        parser.add_argument('--chunk-size', type=int, default=256, help="Formulas rendered between progress lines.")
+
+    @uses_render_pool
+    def handle(self, *args, **options):
+        # Not traffic: kept out of the deployment's /metrics/
+        metrics.local_only()
+        posts = Post.objects.all()
+        if options['since']:
+            try:
+                since = parse_since(options['since'])
+            except ValueError:
+                since = None
+            if since is None:
+                raise CommandError(f"Invalid --since: {options['since']} (expected e.g. 2026-10-01 or 2026-10-01T08:00).")
+            posts = posts.filter(updated_at__gte=since)
+
+        if not getattr(settings, 'LATEX_CACHE_DIR', None):
+            self.stderr.write("LATEX_CACHE_DIR is not set: the formulas are only cached for this process.")
+
+        start = time.perf_counter()
+
+        def progress(done, total, rendered):
+            rate = done / (time.perf_counter() - start)
+            self.stdout.write(f"{done}/{total} formula(s) rendered ({rate:.1f}/s)")
+
+        self.stdout.write(f"Rendering with {get_render_pool_size()} worker(s).")
+        # Only the content is read, a chunk of rows at a time
+        contents = posts.values_list('content', flat=True).iterator(chunk_size=500)
+        counts = warm_latex_cache(contents, fmt=options['format'], chunk_size=options['chunk_size'], progress=progress)
+
+        self.stdout.write(
+            f"{counts['formulas']} unique formula(s): {counts['cached']} already cached, "
+            f"{counts['rendered']} rendered, {counts['failed']} failed in {time.perf_counter() - start:.1f}s."
+        )
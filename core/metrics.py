@@ -0,0 +1,341 @@
+"""
+Rolling metrics of the formula renderer and the PDF exports, served in the
+Prometheus text format by the /metrics/ endpoint.
+
+Counters and histograms live in memory (a dict update under a lock per
+sample). With METRICS_DIR set, every process also writes its values to its
+own file there, at most every METRICS_FLUSH_INTERVAL seconds and at exit, and
+the endpoint adds up the files of all processes: any worker answers for the
+whole deployment. Without METRICS_DIR (the default) only the answering
+process is counted.
+
+The directory is per host. Files of processes that exited are folded into
+stopped.json by the next scrape, so counters keep growing without a file
+per dead worker. One-off commands (benchmarks, cache warming) call
+local_only() so their renders are not reported as traffic.
+"""
+import atexit
+import json
+import logging
+import os
+import re
+import threading
+import time
+import uuid
+from pathlib import Path
+
+from django.conf import settings
+
+COUNTERS = {
+    'qrepo_formula_renders_total': "Formulas rendered (cache misses), by output format.",
+    'qrepo_formula_errors_total': "Formulas replaced by the [Math Error] fallback.",
+    'qrepo_cache_hits_total': "Cache hits, by cache.",
+    'qrepo_cache_misses_total': "Cache misses, by cache.",
+    'qrepo_export_errors_total': "PDF exports that failed, by endpoint and kind.",
+}
+
+# Upper bounds of the buckets
+HISTOGRAMS = {
+    'qrepo_formula_render_seconds': (
+        "Time to render one formula, by output format.",
+        (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0),
+    ),
+    'qrepo_export_seconds': (
+        "PDF export latency, by endpoint and kind.",
+        (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0),
+    ),
+    'qrepo_export_pdf_bytes': (
+        "Size of the built PDFs, by kind.",
+        (10e3, 50e3, 100e3, 500e3, 1e6, 5e6, 10e6, 50e6),
+    ),
+    'qrepo_export_pages': (
+        "Pages of the built PDFs, by kind.",
+        (1, 2, 5, 10, 20, 50, 100, 200, 500),
+    ),
+}
+
+logger = logging.getLogger('core.metrics')
+
+# Counters of the processes that exited, and the lock taken to fold them in
+STOPPED_NAME = 'stopped.json'
+FOLD_LOCK_NAME = 'fold.lock'
+# A lock older than this was left by a crash
+FOLD_LOCK_TIMEOUT = 60
+_process_file_re = re.compile(r'^(\d+)-[0-9a-f]+$')
+
+_lock = threading.Lock()
+_registry = None
+_local_only = False
+_caches = {}
+# Hit/miss counts the caches already had when this process was forked
+_cache_baseline = {}
+
+
+class _Registry:
+
+    def __init__(self):
+        self.pid = os.getpid()
+        # The pid alone could be reused by a later process and overwrite its file
+        self.name = f'{self.pid}-{uuid.uuid4().hex[:8]}'
+        self.counters = {}
+        self.histograms = {}
+        self.last_flush = 0.0
+
+
+def _get_registry():
+    """ Called with _lock held. A forked child starts from zero: its parent reports its own values. """
+    global _registry
+    if _registry is None or _registry.pid != os.getpid():
+        _registry = _Registry()
+    return _registry
+
+
+def _after_fork_in_child():
+    """
+    A forked child inherits its parent's caches with their hit/miss counts,
+    which the parent reports itself: the child only counts its own lookups.
+    """
+    global _lock
+    # Another thread of the parent may have held it at fork time
+    _lock = threading.Lock()
+    _cache_baseline.clear()
+    for name, getter in _caches.items():
+        try:
+            cache = getter()
+        except Exception:
+            # Settings not configured yet: no cache, nothing inherited
+            continue
+        # Read without the cache's lock, for the same reason
+        _cache_baseline[name] = (cache.hits, cache.misses)
+
+os.register_at_fork(after_in_child=_after_fork_in_child)
+
+
+def register_cache(name, getter):
+    """ Reports the hits and misses of the cache returned by `getter` (anything with stats()). """
+    _caches[name] = getter
+
+
+def inc(name, amount=1, **labels):
+    with _lock:
+        registry = _get_registry()
+        key = (name, tuple(sorted(labels.items())))
+        registry.counters[key] = registry.counters.get(key, 0) + amount
+    _maybe_flush()
+
+
+def observe(name, value, **labels):
+    bounds = HISTOGRAMS[name][1]
+    with _lock:
+        registry = _get_registry()
+        key = (name, tuple(sorted(labels.items())))
+        # One count per bucket (not cumulative), then the +Inf bucket, the sum and the count
+        values = registry.histograms.get(key)
+        if values is None:
+            values = registry.histograms[key] = [0] * (len(bounds) + 1) + [0.0, 0]
+        index = next((i for i, bound in enumerate(bounds) if value <= bound), len(bounds))
+        values[index] += 1
+        values[-2] += value
+        values[-1] += 1
+    _maybe_flush()
+
+
+def _snapshot():
+    with _lock:
+        registry = _get_registry()
+        counters = dict(registry.counters)
+        histograms = {key: list(values) for key, values in registry.histograms.items()}
+
+    for cache_name, getter in _caches.items():
+        stats = getter().stats()
+        hits, misses = _cache_baseline.get(cache_name, (0, 0))
+        if stats['hits'] < hits or stats['misses'] < misses:
+            # Cleared since the fork: every count is this process's
+            _cache_baseline.pop(cache_name)
+            hits = misses = 0
+        counters[('qrepo_cache_hits_total', (('cache', cache_name),))] = stats['hits'] - hits
+        counters[('qrepo_cache_misses_total', (('cache', cache_name),))] = stats['misses'] - misses
+
+    return {
+        'counters': [[name, list(labels), value] for (name, labels), value in counters.items()],
+        'histograms': [[name, list(labels), values] for (name, labels), values in histograms.items()],
+    }
+
+
+def local_only():
+    """ Keeps this process's values out of METRICS_DIR (for one-off commands). """
+    global _local_only
+    _local_only = True
+
+
+def _metrics_dir():
+    directory = getattr(settings, 'METRICS_DIR', None)
+    return None if _local_only or not directory else Path(directory)
+
+
+def flush():
+    """ Writes this process's values to METRICS_DIR (no-op without it). """
+    directory = _metrics_dir()
+    if directory is None:
+        return
+    with _lock:
+        registry = _get_registry()
+        registry.last_flush = time.monotonic()
+        path = directory / f'{registry.name}.json'
+    try:
+        directory.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_suffix(f'.{threading.get_ident()}.tmp')
+        tmp_path.write_text(json.dumps(_snapshot()))
+        os.replace(tmp_path, path)
+    except OSError as e:
+        logger.warning("Cannot write metrics to %s: %s", path, e)
+
+
+def _maybe_flush():
+    if _metrics_dir() is None:
+        return
+    registry = _registry
+    if time.monotonic() - registry.last_flush >= getattr(settings, 'METRICS_FLUSH_INTERVAL', 5.0):
+        flush()
+
+
+def _flush_at_exit():
+    if _registry is not None:
+        flush()
+
+atexit.register(_flush_at_exit)
+
+
+def _add_up(snapshots):
+    counters, histograms = {}, {}
+    for snapshot in snapshots:
+        for name, labels, value in snapshot['counters']:
+            key = (name, tuple(tuple(label) for label in labels))
+            counters[key] = counters.get(key, 0) + value
+        for name, labels, values in snapshot['histograms']:
+            key = (name, tuple(tuple(label) for label in labels))
+            if key in histograms:
+                histograms[key] = [a + b for a, b in zip(histograms[key], values)]
+            else:
+                histograms[key] = values
+    return counters, histograms
+
+
+def _read_snapshot(path):
+    try:
+        return json.loads(path.read_text())
+    except (OSError, ValueError):
+        # Being replaced, or left half-written by a crash
+        return None
+
+
+def _process_exited(path):
+    match = _process_file_re.match(path.stem)
+    if match is None:
+        return False
+    try:
+        os.kill(int(match.group(1)), 0)
+    except ProcessLookupError:
+        return True
+    except (PermissionError, OverflowError):
+        pass
+    return False
+
+
+def _fold_stopped(directory):
+    """ Adds the files of processes that exited into stopped.json, then deletes them. """
+    if os.name == 'nt':
+        # os.kill(pid, 0) would send CTRL_C_EVENT there
+        return
+    stopped = [path for path in directory.glob('*.json') if _process_exited(path)]
+    if not stopped:
+        return
+
+    lock = directory / FOLD_LOCK_NAME
+    try:
+        os.close(os.open(lock, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+    except FileExistsError:
+        # Another process is folding them
+        try:
+            if time.time() - lock.stat().st_mtime > FOLD_LOCK_TIMEOUT:
+                lock.unlink(missing_ok=True)
+        except OSError:
+            pass
+        return
+    except OSError as e:
+        logger.warning("Cannot fold stopped processes' metrics in %s: %s", directory, e)
+        return
+
+    try:
+        archive = directory / STOPPED_NAME
+        snapshots = [_read_snapshot(path) for path in [archive] + stopped if path.exists()]
+        counters, histograms = _add_up(snapshot for snapshot in snapshots if snapshot)
+        tmp_path = archive.with_suffix(f'.{os.getpid()}.tmp')
+        tmp_path.write_text(json.dumps({
+            'counters': [[name, list(labels), value] for (name, labels), value in counters.items()],
+            'histograms': [[name, list(labels), values] for (name, labels), values in histograms.items()],
+        }))
+        os.replace(tmp_path, archive)
+        for path in stopped:
+            path.unlink(missing_ok=True)
+    except OSError as e:
+        logger.warning("Cannot fold stopped processes' metrics in %s: %s", directory, e)
+    finally:
+        lock.unlink(missing_ok=True)
+
+
+def collect():
+    """ Values of every process (or of this one without METRICS_DIR), added up. """
+    directory = _metrics_dir()
+    if directory is None:
+        return _add_up([_snapshot()])
+
+    flush()
+    _fold_stopped(directory)
+    snapshots = (_read_snapshot(path) for path in directory.glob('*.json'))
+    return _add_up(snapshot for snapshot in snapshots if snapshot)
+
+
+def _labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ''
+    escaped = (
+        (name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for name, value in pairs
+    )
+    return '{' + ','.join(f'{name}="{value}"' for name, value in escaped) + '}'
+
+
+def render_prometheus():
+    """ All metrics in the Prometheus text exposition format (version 0.0.4). """
+    counters, histograms = collect()
+    lines = []
+
+    for name, help_text in COUNTERS.items():
+        lines += [f'# HELP {name} {help_text}', f'# TYPE {name} counter']
+        for (sample_name, labels), value in sorted(counters.items()):
+            if sample_name == name:
+                lines.append(f'{name}{_labels(labels)} {value}')
+
+    # Derived from the summed counts, so it is the ratio of the whole deployment
+    lines += ['# HELP qrepo_cache_hit_ratio Share of cache lookups that were hits, by cache.',
+              '# TYPE qrepo_cache_hit_ratio gauge']
+    for (sample_name, labels), hits in sorted(counters.items()):
+        if sample_name == 'qrepo_cache_hits_total':
+            lookups = hits + counters.get(('qrepo_cache_misses_total', labels), 0)
+            lines.append(f'qrepo_cache_hit_ratio{_labels(labels)} {hits / lookups if lookups else 0.0:.4f}')
+
+    for name, (help_text, bounds) in HISTOGRAMS.items():
+        lines += [f'# HELP {name} {help_text}', f'# TYPE {name} histogram']
+        for (sample_name, labels), values in sorted(histograms.items()):
+            if sample_name != name:
+                continue
+            cumulative = 0
+            for bound, count in zip(list(bounds) + ['+Inf'], values):
+                cumulative += count
+                lines.append(f'{name}_bucket{_labels(labels, [("le", bound)])} {cumulative}')
+            lines.append(f'{name}_sum{_labels(labels)} {values[-2]}')
+            lines.append(f'{name}_count{_labels(labels)} {values[-1]}')
+
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,58 @@
+# Generated by Django 5.2.18 on 2026-10-18 20:32
+
+from html import unescape
+
+import django.db.models.deletion
+from django.db import migrations, models
+from django.utils.html import strip_tags
+
+
+def create_search_table(apps, schema_editor):
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+    Post = apps.get_model('core', 'Post')
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute(
+            "CREATE VIRTUAL TABLE core_post_fts USING fts5(title, body, tokenize='unicode61 remove_diacritics 2')"
+        )
+        # Default ranking for ORDER BY rank: title matches weigh 10x body matches
+        cursor.execute("INSERT INTO core_post_fts (core_post_fts, rank) VALUES ('rank', 'bm25(10.0, 1.0)')")
+        cursor.executemany(
+            'INSERT INTO core_post_fts (rowid, title, body) VALUES (%s, %s, %s)',
+            [
+                (pk, title, unescape(strip_tags(content or '')))
+                for pk, title, content in Post.objects.values_list('id', 'title', 'content').iterator()
+            ],
+        )
+
+
+def drop_search_table(apps, schema_editor):
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute('DROP TABLE IF EXISTS core_post_fts')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0010_post_keyset_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PostSearchIndex',
+            fields=[
+                ('post', models.OneToOneField(db_column='rowid', on_delete=django.db.models.deletion.DO_NOTHING, primary_key=True, related_name='search_index', serialize=False, to='core.post')),
+                ('title', models.TextField()),
+                ('body', models.TextField()),
+                ('document', models.TextField(db_column='core_post_fts')),
+                ('rank', models.FloatField()),
+            ],
+            options={
+                'db_table': 'core_post_fts',
+                'managed': False,
+            },
+        ),
+        migrations.RunPython(create_search_table, drop_search_table),
+    ]
@@ -0,0 +1,36 @@
+# Generated by Django 5.2.18 on 2026-10-18 21:15
+
+from html import unescape
+
+from django.db import migrations, models
+from django.utils.html import strip_tags
+from django.utils.text import Truncator
+
+
+def fill_excerpts(apps, schema_editor):
+    # Same text as core.models.make_excerpt at the time of this migration
+    Post = apps.get_model('core', 'Post')
+    batch = []
+    for post in Post.objects.only('content').iterator(chunk_size=500):
+        post.excerpt = Truncator(unescape(strip_tags(post.content or ''))).chars(300)
+        batch.append(post)
+        if len(batch) >= 500:
+            Post.objects.bulk_update(batch, ['excerpt'])
+            batch = []
+    Post.objects.bulk_update(batch, ['excerpt'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0012_post_facet_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='post',
+            name='excerpt',
+            field=models.TextField(blank=True, editable=False),
+        ),
+        migrations.RunPython(fill_excerpts, migrations.RunPython.noop),
+    ]
@@ -1,7 +1,16 @@
 # core/models.py
+import os
+from html import unescape
+
+from django.conf import settings
+from django.core.files.storage import FileSystemStorage
 from django.db import models
+from django.utils.html import strip_tags
+from django.utils.text import Truncator
 from colorfield.fields import ColorField
 
+from .utils import RENDERER_VERSION, content_hash, fragment_is_resolvable, prerender_formulas, process_content_for_pdf
+
 
 class AreaDoConhecimento(models.Model):
     name = models.CharField(max_length=200)
@@ -23,13 +32,182 @@ class Dificuldade(models.Model):
         return self.name
 
 
+# Characters of plain text shown on a question card
+EXCERPT_LENGTH = 300
+
+def make_excerpt(content, length=EXCERPT_LENGTH):
+    """ Plain-text start of a question for the list cards (the full content is fetched on demand). """
+    return Truncator(unescape(strip_tags(content or ''))).chars(length)
+
+
+class PostQuerySet(models.QuerySet):
+
+    def bulk_create(self, objs, *args, **kwargs):
+        """ bulk_create does not call save(): the excerpts are filled in here. """
+        objs = list(objs)
+        for post in objs:
+            post.excerpt = make_excerpt(post.content)
+        return super().bulk_create(objs, *args, **kwargs)
+
+
 class Post(models.Model):
     title = models.CharField(max_length=200)
     content = models.TextField()
+    # Kept in step with the content by save() and bulk_create(), so the list
+    # never loads the full HTML of its cards
+    excerpt = models.TextField(blank=True, editable=False)
     area_do_conhecimento = models.ForeignKey(AreaDoConhecimento, on_delete=models.SET_NULL, null=True, blank=True)
     dificuldade = models.ForeignKey(Dificuldade, on_delete=models.SET_NULL, null=True, blank=True)
     created_at = models.DateTimeField(auto_now_add=True, blank=True)
     updated_at = models.DateTimeField(auto_now=True)
 
+    # Print-ready HTML used by the PDF exports (formulas already rendered).
+    # Rebuilt on save and lazily whenever the content or the renderer changes.
+    rendered_content = models.TextField(blank=True, editable=False)
+    rendered_hash = models.CharField(max_length=64, blank=True, editable=False)
+    rendered_version = models.PositiveIntegerField(default=0, editable=False)
+
+    objects = PostQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            # Keyset pagination of the question list (see core.pagination)
+            models.Index(fields=['-created_at', '-id'], name='post_created_id_idx'),
+            # The same list filtered by area or by difficulty
+            models.Index(fields=['area_do_conhecimento', '-created_at', '-id'], name='post_area_created_idx'),
+            models.Index(fields=['dificuldade', '-created_at', '-id'], name='post_difficulty_created_idx'),
+        ]
+
     def __str__(self):
-        return self.title
\ No newline at end of file
+        return self.title
+
+    def save(self, *args, **kwargs):
+        if 'content' not in self.get_deferred_fields():
+            self.excerpt = make_excerpt(self.content)
+            update_fields = kwargs.get('update_fields')
+            if update_fields is not None and 'content' in update_fields:
+                kwargs['update_fields'] = {*update_fields, 'excerpt'}
+        super().save(*args, **kwargs)
+
+    def rendered_is_stale(self):
+        return (
+            self.rendered_version != RENDERER_VERSION
+            or self.rendered_hash != content_hash(self.content)
+            # Formula images are referenced by cache key: they must not have been evicted
+            or not fragment_is_resolvable(self.rendered_content)
+        )
+
+    def refresh_rendered_content(self, save=True):
+        """ Rebuilds the print-ready fragment from the current content. """
+        self.rendered_content = process_content_for_pdf(self.content)
+        self.rendered_hash = content_hash(self.content)
+        self.rendered_version = RENDERER_VERSION
+        if save and self.pk:
+            # update() keeps updated_at untouched: the question itself did not change
+            Post.objects.filter(pk=self.pk).update(
+                rendered_content=self.rendered_content,
+                rendered_hash=self.rendered_hash,
+                rendered_version=self.rendered_version,
+            )
+
+    def get_rendered_content(self):
+        """ Returns the print-ready fragment, rebuilding it first if it is stale. """
+        if self.rendered_is_stale():
+            self.refresh_rendered_content()
+        return self.rendered_content
+
+
+def refresh_rendered_posts(posts):
+    """ Rebuilds several print-ready fragments: formulas rendered in one batch, saved with one bulk UPDATE. """
+    posts = list(posts)
+    if not posts:
+        return
+    prerender_formulas(post.content for post in posts)
+    for post in posts:
+        post.refresh_rendered_content(save=False)
+    # Like refresh_rendered_content, updated_at is left untouched
+    Post.objects.bulk_update(posts, ['rendered_content', 'rendered_hash', 'rendered_version'], batch_size=200)
+
+class FullTextMatch(models.Lookup):
+    """ `document__match=expression`: FTS5 MATCH over every indexed column. """
+    lookup_name = 'match'
+
+    def as_sql(self, compiler, connection):
+        lhs, lhs_params = self.process_lhs(compiler, connection)
+        rhs, rhs_params = self.process_rhs(compiler, connection)
+        return f'{lhs} MATCH {rhs}', lhs_params + rhs_params
+
+
+class PostSearchIndex(models.Model):
+    """
+    Row of the core_post_fts FTS5 table (SQLite only, see core.search): the
+    question title and its content without HTML. Written with raw SQL, read
+    through Post.search_index joins.
+    """
+    post = models.OneToOneField(
+        Post, primary_key=True, db_column='rowid', on_delete=models.DO_NOTHING, related_name='search_index',
+    )
+    title = models.TextField()
+    body = models.TextField()
+    # FTS5 hidden columns: the one named after the table is the MATCH target,
+    # rank is the bm25 score of the current match
+    document = models.TextField(db_column='core_post_fts')
+    rank = models.FloatField()
+
+    class Meta:
+        managed = False
+        db_table = 'core_post_fts'
+
+
+PostSearchIndex._meta.get_field('document').register_lookup(FullTextMatch)
+
+
+class ExportStorage(FileSystemStorage):
+    """ Finished exports live outside MEDIA_ROOT and are served by export_job_download. """
+
+    @property
+    def base_location(self):
+        return settings.EXPORT_JOBS_DIR
+
+    @property
+    def location(self):
+        return os.path.abspath(self.base_location)
+
+
+class ExportJob(models.Model):
+    STATUS_PENDING = 'pending'
+    STATUS_RUNNING = 'running'
+    STATUS_DONE = 'done'
+    STATUS_FAILED = 'failed'
+    STATUS_CHOICES = [
+        (STATUS_PENDING, 'Pending'),
+        (STATUS_RUNNING, 'Running'),
+        (STATUS_DONE, 'Done'),
+        (STATUS_FAILED, 'Failed'),
+    ]
+    KIND_CHOICES = [
+        ('selected', 'Questões selecionadas'),
+        ('exam', 'Prova'),
+        ('abnt', 'ABNT'),
+    ]
+    FILENAMES = {
+        'selected': 'questoes_selecionadas.pdf',
+        'exam': 'prova_gerada.pdf',
+        'abnt': 'posts_ABNT.pdf',
+    }
+
+    kind = models.CharField(max_length=20, choices=KIND_CHOICES)
+    post_ids = models.JSONField(default=list)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=STATUS_PENDING, db_index=True)
+    file = models.FileField(storage=ExportStorage(), upload_to='%Y-%m-%d/', blank=True)
+    error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    def __str__(self):
+        return f"{self.get_kind_display()} #{self.pk} ({self.status})"
+
+    @property
+    def filename(self):
+        return self.FILENAMES[self.kind]
@@ -0,0 +1,67 @@
+"""
+Keyset (cursor) pagination for the question list.
+
+Pages are ordered by (-created_at, -id) (or by search rank, then id) and the
+cursor is the position of the last question shown, so fetching a page is an
+index range scan whatever the depth, and questions added meanwhile never
+shift the following pages.
+"""
+import json
+from datetime import datetime
+
+from django.db.models import Q
+from django.utils.encoding import force_str
+from django.utils.http import urlsafe_base64_decode, urlsafe_base64_encode
+
+KEYSET_ORDERING = ('-created_at', '-id')
+# Search results: best bm25 score first (FTS5 ranks are negative, lower is better)
+RANKED_ORDERING = ('search_rank', 'id')
+
+# Type of the cursor value for the first field of each ordering
+CURSOR_TYPES = {
+    'created_at': datetime,
+    'search_rank': (int, float),
+}
+
+
+def _field(name):
+    return name.lstrip('-')
+
+
+def encode_cursor(post, ordering=KEYSET_ORDERING):
+    value, pk = (getattr(post, _field(name)) for name in ordering)
+    if isinstance(value, datetime):
+        value = {'datetime': value.isoformat()}
+    return urlsafe_base64_encode(json.dumps([value, pk]).encode())
+
+
+def decode_cursor(cursor, ordering=KEYSET_ORDERING):
+    """ Returns (value, id), or None if the cursor is malformed or was made for another ordering. """
+    try:
+        value, pk = json.loads(force_str(urlsafe_base64_decode(cursor)))
+        if isinstance(value, dict):
+            value = datetime.fromisoformat(value['datetime'])
+        # bool is an int, but never a valid position
+        if isinstance(value, bool) or not isinstance(value, CURSOR_TYPES[_field(ordering[0])]):
+            return None
+        return value, int(pk)
+    except (ValueError, TypeError, KeyError, UnicodeDecodeError):
+        return None
+
+
+def keyset_page(queryset, position=None, size=20, ordering=KEYSET_ORDERING):
+    """ Returns the questions after `position` (a decoded cursor) and the cursor of the next page. """
+    queryset = queryset.order_by(*ordering)
+    if position is not None:
+        (first, second), (value, pk) = ordering, position
+        after = {name: f"{_field(name)}__{'lt' if name.startswith('-') else 'gt'}" for name in ordering}
+        queryset = queryset.filter(
+            Q(**{after[first]: value}) | Q(**{_field(first): value, after[second]: pk})
+        )
+
+    # One extra row tells whether there is a next page
+    posts = list(queryset[:size + 1])
+    if len(posts) <= size:
+        return posts, None
+    posts = posts[:size]
+    return posts, encode_cursor(posts[-1], ordering)
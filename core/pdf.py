@@ -0,0 +1,295 @@
+import functools
+import mimetypes
+import threading
+from pathlib import Path
+from urllib.parse import unquote, urlsplit
+
+from django.conf import settings
+from django.template.loader import render_to_string
+from django.utils.safestring import mark_safe
+from weasyprint import CSS, HTML
+from weasyprint.text.fonts import FontConfiguration
+from weasyprint.urls import URLFetcher, URLFetcherResponse
+
+from . import metrics
+from .cache import ObjectCache, make_cache_key
+from .images import derivative_for
+from .models import refresh_rendered_posts
+from .pdf_cache import PDF_TEMPLATE_VERSION
+from .timing import stage
+from .utils import (
+    LATEX_URL_SCHEME, RENDERER_VERSION, get_latex_format, latex_image_for_url, latex_mime_type,
+)
+
+# Relative URLs in the exported HTML (e.g. src="/media/...") are resolved
+# against this pseudo-origin and then served from disk by PdfUrlFetcher.
+# The .invalid TLD guarantees nothing is ever fetched over the network.
+PDF_HOST = 'pdf-export.invalid'
+PDF_BASE_URL = f'http://{PDF_HOST}/'
+
+
+def pdf_base_url(layout=None):
+    """ Each layout gets its own origin: images are cached by URL and their print copies differ per layout. """
+    return f'http://{layout}.{PDF_HOST}/' if layout else PDF_BASE_URL
+
+
+def media_path_for_url(url):
+    """ Maps a resolved /media/ URL to the file under MEDIA_ROOT, or None. """
+    parts = urlsplit(url)
+    if parts.scheme != 'http' or not (parts.netloc == PDF_HOST or parts.netloc.endswith(f'.{PDF_HOST}')):
+        return None
+    path = unquote(parts.path)
+    if not path.startswith(settings.MEDIA_URL):
+        return None
+
+    media_root = Path(settings.MEDIA_ROOT).resolve()
+    file_path = (media_root / path[len(settings.MEDIA_URL):]).resolve()
+    if not file_path.is_relative_to(media_root):
+        return None
+    return file_path
+
+
+class PdfUrlFetcher(URLFetcher):
+    """
+    Serves export resources without going through data: URIs or HTTP:
+
+    - latex://<key> from the LaTeX render cache (memory, then disk), or
+      rendered again from the formula in the URL if it was evicted
+    - /media/... from MEDIA_ROOT, as the print copy for `layout` when the
+      original is larger than the layout needs (see core.images)
+
+    WeasyPrint caches images by URL (see get_image_cache), so a formula or
+    picture repeated across questions and exports is decoded only once.
+    """
+
+    def __init__(self, layout=None, **kwargs):
+        super().__init__(**kwargs)
+        self.layout = layout
+
+    def fetch(self, url, headers=None):
+        if url.startswith(LATEX_URL_SCHEME):
+            data = latex_image_for_url(url)
+            if data is None:
+                raise ValueError(f'Formula image is not in the cache and cannot be rendered: {url}')
+            return URLFetcherResponse(url, data, {'Content-Type': latex_mime_type(data)})
+
+        file_path = media_path_for_url(url)
+        if file_path is not None:
+            derivative = derivative_for(file_path, self.layout) if self.layout else None
+            if derivative is not None:
+                data, mime_type = derivative
+                return URLFetcherResponse(url, data, {'Content-Type': mime_type})
+            mime_type = mimetypes.guess_type(file_path.name)[0] or 'application/octet-stream'
+            return URLFetcherResponse(url, file_path.open('rb'), {'Content-Type': mime_type})
+
+        return super().fetch(url, headers)
+
+
+# --- Shared rendering layer ---
+# Everything that does not depend on the questions is built once per process:
+# the stylesheet of each layout (templates/pdf/<layout>.css), the font
+# configuration and the decoded images.
+
+@functools.lru_cache(maxsize=None)
+def get_stylesheet(layout):
+    """ Parsed weasyprint CSS for an export layout ('selected', 'exam' or 'abnt'). """
+    return CSS(string=render_to_string(f'pdf/{layout}.css'), base_url=PDF_BASE_URL)
+
+_font_config = None
+_font_config_lock = threading.Lock()
+# Pango font maps are not thread-safe: every layout and PDF write of the
+# process (request threads, pdf-export job threads) uses the shared font
+# configuration under this lock, so laid-out Documents can be reused by any thread
+_layout_lock = threading.Lock()
+
+def get_font_config():
+    """ The process's FontConfiguration (use it under _layout_lock). """
+    global _font_config
+    with _font_config_lock:
+        if _font_config is None:
+            _font_config = FontConfiguration()
+        return _font_config
+
+_image_cache = {}
+
+def get_image_cache():
+    """
+    Image cache shared by every export. Past PDF_IMAGE_CACHE_ENTRIES a new one
+    is started; documents still referencing the old one keep it alive.
+    """
+    global _image_cache
+    if len(_image_cache) > getattr(settings, 'PDF_IMAGE_CACHE_ENTRIES', 2000):
+        _image_cache = {}
+    return _image_cache
+
+def render_export_html(template_name, parts):
+    """ Puts the body fragments (joined once) into a compiled document template. """
+    return render_to_string(template_name, {'body': mark_safe(''.join(parts))})
+
+
+def render_document(html_string, layout=None):
+    """ Lays out an export document (a weasyprint Document, pages ready to be written). """
+    with stage('layout'):
+        html = HTML(string=html_string, base_url=pdf_base_url(layout), url_fetcher=PdfUrlFetcher(layout))
+        stylesheets = [get_stylesheet(layout)] if layout else None
+        with _layout_lock:
+            return html.render(stylesheets=stylesheets, font_config=get_font_config(), cache=get_image_cache())
+
+
+def write_pdf(html_string, layout=None, target=None):
+    """ Lays out an export document and returns the PDF bytes, or writes them to the `target` file. """
+    return write_document(render_document(html_string, layout), layout, target)
+
+
+def write_document(document, layout=None, target=None):
+    if layout:
+        metrics.observe('qrepo_export_pages', len(document.pages), kind=layout)
+    with stage('write_pdf'), _layout_lock:
+        return document.write_pdf(target)
+
+
+# --- Per-question pages ---
+# In the one-question-per-page exports every question is laid out on its own,
+# so its pages can be cached and reused by any export that includes it.
+
+_page_cache = None
+
+# Rough memory held by a laid-out question: its box tree per page, plus the parsed HTML
+PAGE_COST_BYTES = 256 * 1024
+HTML_COST_FACTOR = 10
+
+def get_page_cache():
+    """ Process-wide LRU of laid-out questions (weasyprint Documents), bounded by estimated size. """
+    global _page_cache
+    if _page_cache is None:
+        _page_cache = ObjectCache(
+            max_entries=getattr(settings, 'PDF_PAGE_CACHE_ENTRIES', 300),
+            max_bytes=getattr(settings, 'PDF_PAGE_CACHE_BYTES', 32 * 1024 * 1024),
+        )
+    return _page_cache
+
+def document_size(document, html_string):
+    """ Estimated memory of a laid-out Document, for the page cache bound. """
+    return len(document.pages) * PAGE_COST_BYTES + len(html_string) * HTML_COST_FACTOR
+
+metrics.register_cache('pdf_pages', get_page_cache)
+
+def page_cache_key(layout, post):
+    return make_cache_key(
+        'page', layout, post.pk, post.updated_at.isoformat(), PDF_TEMPLATE_VERSION, RENDERER_VERSION, get_latex_format(),
+    )
+
+def _question_page_html(post):
+    return f"""
+    <div class="post-wrapper">
+        <h1>{post.title}</h1>
+        <div style="text-align: right; font-size: 10pt; margin-bottom: 1cm;">
+            {post.created_at.strftime('%d de %B de %Y')}
+        </div>
+        <div class="content">
+            {post.get_rendered_content()}
+        </div>
+    </div>
+    """
+
+def render_question_documents(layout, queryset):
+    """ One laid-out Document per question; only new or edited questions are laid out again. """
+    cache = get_page_cache()
+    with stage('db'):
+        posts = list(queryset)
+    keys = [page_cache_key(layout, post) for post in posts]
+    documents = [cache.get(key) for key in keys]
+
+    # Stale questions: formulas rendered at once (in parallel), fragments saved in one UPDATE
+    with stage('formulas'):
+        refresh_rendered_posts(
+            post for post, document in zip(posts, documents)
+            if document is None and post.rendered_is_stale()
+        )
+
+    for index, (post, key) in enumerate(zip(posts, keys)):
+        if documents[index] is None:
+            with stage('html'):
+                html_string = render_export_html('pdf/document.html', [_question_page_html(post)])
+            documents[index] = render_document(html_string, layout)
+            cache.set(key, documents[index], document_size(documents[index], html_string))
+    return documents
+
+def assemble_pdf(documents, target=None):
+    """ Writes the pages of several Documents as one PDF (metadata from the first). """
+    pages = [page for document in documents for page in document.pages]
+    with stage('write_pdf'), _layout_lock:
+        return documents[0].copy(pages).write_pdf(target)
+
+def _build_question_pages(layout, queryset, target=None):
+    documents = render_question_documents(layout, queryset)
+    if not documents:
+        return write_pdf(render_export_html('pdf/document.html', []), layout, target)
+    metrics.observe('qrepo_export_pages', sum(len(document.pages) for document in documents), kind=layout)
+    return assemble_pdf(documents, target)
+
+
+# --- Exports ---
+# Each builder returns the PDF bytes, or writes them to `target` (a binary
+# file) and returns None: the exports served to clients use a spooled file.
+
+def build_selected_pdf(queryset, target=None):
+    """ "Exportar Selecionados": one question per page, ABNT-like layout. """
+    return _build_question_pages('selected', queryset, target)
+
+
+def build_exam_pdf(queryset, target=None):
+    """ "Gerar Prova": two-column exam grouped by area, with header and footer. """
+    # Areas are joined in: comparing post.area_do_conhecimento must not query per question
+    with stage('db'):
+        posts = list(queryset.select_related('area_do_conhecimento').order_by('area_do_conhecimento__name', 'id'))
+
+    # Stale questions: formulas rendered at once (in parallel), fragments saved in one UPDATE
+    with stage('formulas'):
+        refresh_rendered_posts(post for post in posts if post.rendered_is_stale())
+
+    with stage('html'):
+        html_string = _exam_html(posts)
+    document = render_document(html_string, 'exam')
+    # The questions and the HTML are no longer needed: let them go before the PDF is written
+    del posts, html_string
+    return write_document(document, 'exam', target)
+
+
+def _exam_html(posts):
+    """ Exam body: questions grouped under their area headers, numbered in order. """
+    parts = []
+    current_area = None
+    for index, post in enumerate(posts):
+        if post.area_do_conhecimento != current_area:
+            current_area = post.area_do_conhecimento
+            area_name = current_area.name if current_area else "Sem Área"
+            parts.append(f"""
+            <div class="area-header" style="background-color: grey; color: white; padding: 5px; margin-top: 20px; margin-bottom: 10px; font-weight: bold; text-transform: uppercase;">
+                {area_name}
+            </div>
+            """)
+
+        parts.append(f"""
+        <div class="question-item">
+            <h1 style="background-color:lightgrey;">QUESTÃO {index + 1:02d}</h1>
+            <div class="content">
+                {post.get_rendered_content()}
+            </div>
+        </div>
+        """)
+
+    return render_export_html('pdf/exam.html', parts)
+
+
+def build_abnt_pdf(queryset, target=None):
+    """ Admin "Export PDF (ABNT Format)": one question per page. """
+    return _build_question_pages('abnt', queryset, target)
+
+
+# Builder per export kind (see ExportJob.KIND_CHOICES)
+EXPORTS = {
+    'selected': build_selected_pdf,
+    'exam': build_exam_pdf,
+    'abnt': build_abnt_pdf,
+}
@@ -0,0 +1,90 @@
+"""
+Whole-document cache for PDF exports.
+
+The key covers everything the PDF is made of: the export kind, the ordered
+question ids, the updated_at of each question and of its area and difficulty,
+the export template version and the formula renderer settings. Editing any of
+those models therefore changes the key, so old entries are never served again
+and simply age out of the (size-bounded) cache.
+
+PDFs are never held whole in memory on their way to the client: a miss is
+written to a spooled temporary file (PDF_SPOOL_MEMORY_BYTES in memory, the
+rest on disk) and copied into the cache from there, and a hit on disk is
+streamed from the cache file.
+"""
+import os
+import tempfile
+
+from django.conf import settings
+
+from . import metrics, renderers
+from .cache import RenderCache, make_cache_key
+from .models import Post
+from .timing import describe, stage
+from .utils import RENDERER_VERSION, get_latex_format
+
+# Bump whenever the export templates (templates/pdf/), the builders in core/pdf.py
+# or the way images are embedded change
+PDF_TEMPLATE_VERSION = 3
+
+_pdf_cache = None
+
+def get_pdf_cache():
+    """ Process-wide cache for finished export PDFs (memory LRU + disk). """
+    global _pdf_cache
+    if _pdf_cache is None:
+        _pdf_cache = RenderCache(
+            directory=getattr(settings, 'PDF_CACHE_DIR', None),
+            memory_bytes=getattr(settings, 'PDF_CACHE_MEMORY_BYTES', 16 * 1024 * 1024),
+            disk_bytes=getattr(settings, 'PDF_CACHE_DISK_BYTES', 256 * 1024 * 1024),
+        )
+    return _pdf_cache
+
+def pdf_cache_stats():
+    return get_pdf_cache().stats()
+
+metrics.register_cache('pdf', get_pdf_cache)
+
+def export_cache_key(kind, post_ids):
+    """ Cache key (and ETag) of an export, from a single query over the included questions. """
+    post_ids = [int(pk) for pk in post_ids]
+    rows = {
+        row[0]: row[1:]
+        for row in Post.objects.filter(id__in=post_ids).values_list(
+            'id', 'updated_at', 'area_do_conhecimento__updated_at', 'dificuldade__updated_at',
+        )
+    }
+    parts = [kind, PDF_TEMPLATE_VERSION, RENDERER_VERSION, get_latex_format()]
+    for pk in post_ids:
+        # Deleted questions are dropped from the PDF, and so from the key
+        if pk in rows:
+            parts.append((pk,) + tuple(value.isoformat() if value else None for value in rows[pk]))
+    return make_cache_key(*parts)
+
+def spooled_pdf_file():
+    """ Temporary file for a PDF being built: in memory while small, on disk past PDF_SPOOL_MEMORY_BYTES. """
+    return tempfile.SpooledTemporaryFile(max_size=getattr(settings, 'PDF_SPOOL_MEMORY_BYTES', 1024 * 1024))
+
+def file_size(file):
+    """ Size of a seekable file, which is left at its start. """
+    size = file.seek(0, os.SEEK_END)
+    file.seek(0)
+    return size
+
+def open_or_build_pdf(kind, queryset, key):
+    """
+    Returns the PDF for `key` as a binary file at its start (the caller closes
+    it), from the cache or built (and stored) on a miss.
+    """
+    cache = get_pdf_cache()
+    with stage('pdf_cache'):
+        pdf_file = cache.open(key)
+    describe('pdf_cache', 'miss' if pdf_file is None else 'hit')
+    if pdf_file is None:
+        # WeasyPrint is only needed on a miss
+        pdf_file = spooled_pdf_file()
+        renderers.pdf().EXPORTS[kind](queryset, pdf_file)
+        size = file_size(pdf_file)
+        metrics.observe('qrepo_export_pdf_bytes', size, kind=kind)
+        cache.set_file(key, pdf_file, size)
+    return pdf_file
@@ -0,0 +1,67 @@
+"""
+Lazy loading of the heavy renderers: matplotlib (formula images) and
+WeasyPrint (PDF exports).
+
+Importing the app (models, views, admin, management commands) loads
+neither: each is imported on first use through mathtext() and pdf(). A
+preforking server can call warm_up() in its master process (see
+PRELOAD_RENDERERS) so every worker inherits the loaded modules, fonts and
+mathtext parser instead of paying for them on its first export.
+"""
+import functools
+import importlib
+import logging
+import sys
+import time
+from types import SimpleNamespace
+
+# Modules that must not be imported by startup alone
+HEAVY_MODULES = ('matplotlib', 'numpy', 'weasyprint')
+
+logger = logging.getLogger('core.renderers')
+
+
+@functools.cache
+def mathtext():
+    """ matplotlib (non-interactive Agg backend) and NumPy, as used by the formula rasterizers. """
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    import numpy as np
+    from matplotlib.backends.backend_agg import RendererAgg
+    from matplotlib.font_manager import FontProperties
+    from matplotlib.mathtext import MathTextParser
+
+    return SimpleNamespace(
+        plt=plt, np=np, RendererAgg=RendererAgg, FontProperties=FontProperties, MathTextParser=MathTextParser,
+    )
+
+
+def pdf():
+    """ core.pdf: the export builders, with WeasyPrint. """
+    return importlib.import_module('.pdf', __package__)
+
+
+def loaded_modules():
+    """ The heavy modules this process has imported so far. """
+    return [name for name in HEAVY_MODULES if name in sys.modules]
+
+
+def warm_up(pdf_exports=True):
+    """
+    Loads the renderers now rather than on the first request: matplotlib,
+    its fonts and the mathtext parser (by rendering a formula), then
+    WeasyPrint unless `pdf_exports` is False. Returns the seconds taken.
+    """
+    from .utils import LATEX_STYLES, render_latex_png
+
+    start = time.perf_counter()
+    render_latex_png('x', *LATEX_STYLES['inline'][:2])
+    if pdf_exports:
+        try:
+            pdf()
+        except OSError as e:
+            # WeasyPrint without its system libraries (Pango): the exports
+            # will fail the same way, the rest of the app works
+            logger.warning("WeasyPrint not loaded: %s", e)
+    return time.perf_counter() - start
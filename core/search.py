@@ -0,0 +1,91 @@
+"""
+Full-text search over questions with SQLite FTS5.
+
+core_post_fts indexes the title and the content with the HTML stripped, so
+the LaTeX source (e.g. "\\frac" or "x^2") is searchable as text. Accents are
+ignored and results are ranked by bm25, a title match counting more than a
+body match. Rows are kept in sync by the Post signals in core.signals; the
+`rebuild_search_index` command recreates them from scratch.
+
+Other database backends fall back to a case-insensitive substring search.
+"""
+import re
+from html import unescape
+
+from django.db import connection
+from django.db.models import F, Q
+from django.utils.html import strip_tags
+
+from .models import Post
+
+FTS_TABLE = 'core_post_fts'
+# bm25 weight of each column (title, body)
+FTS_RANK = 'bm25(10.0, 1.0)'
+
+_WORD_RE = re.compile(r'\w+')
+
+
+def search_available():
+    return connection.vendor == 'sqlite'
+
+
+def search_document(title, content):
+    """ Indexed text of a question: title and content without tags or entities. """
+    return title, unescape(strip_tags(content or ''))
+
+
+def index_posts(posts):
+    """ Adds or replaces the index rows of the given questions. """
+    rows = [(post.pk, *search_document(post.title, post.content)) for post in posts]
+    if not rows or not search_available():
+        return
+    with connection.cursor() as cursor:
+        cursor.executemany(f'DELETE FROM {FTS_TABLE} WHERE rowid = %s', [(row[0],) for row in rows])
+        cursor.executemany(f'INSERT INTO {FTS_TABLE} (rowid, title, body) VALUES (%s, %s, %s)', rows)
+
+
+def unindex_post(post_id):
+    if not search_available():
+        return
+    with connection.cursor() as cursor:
+        cursor.execute(f'DELETE FROM {FTS_TABLE} WHERE rowid = %s', [post_id])
+
+
+def rebuild_search_index(batch_size=500):
+    """ Reindexes every question. Returns how many were indexed. """
+    if not search_available():
+        return 0
+    with connection.cursor() as cursor:
+        cursor.execute(f'DELETE FROM {FTS_TABLE}')
+
+    total, batch = 0, []
+    for post in Post.objects.only('title', 'content').iterator(chunk_size=batch_size):
+        batch.append(post)
+        if len(batch) >= batch_size:
+            index_posts(batch)
+            total, batch = total + len(batch), []
+    index_posts(batch)
+    total += len(batch)
+
+    with connection.cursor() as cursor:
+        cursor.execute(f"INSERT INTO {FTS_TABLE} ({FTS_TABLE}) VALUES ('optimize')")
+    return total
+
+
+def fts_query(text):
+    """ FTS5 expression for what the user typed: every word, as a prefix. """
+    return ' '.join(f'"{word}"*' for word in _WORD_RE.findall(text))
+
+
+def search_posts(queryset, text):
+    """
+    Questions of `queryset` matching `text`. On SQLite they are annotated with
+    `search_rank` (lower is better) for ordering.
+    """
+    if not search_available():
+        return queryset.filter(Q(title__icontains=text) | Q(content__icontains=text))
+
+    expression = fts_query(text)
+    if not expression:
+        return queryset.none()
+    return queryset.filter(search_index__document__match=expression).annotate(search_rank=F('search_index__rank'))
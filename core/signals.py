@@ -0,0 +1,47 @@
+from pathlib import Path
+
+from django.db.models.signals import post_delete, post_save
+from django_summernote.utils import get_attachment_model
+
+from .facets import invalidate_facets
+from .images import create_derivatives
+from .models import AreaDoConhecimento, Dificuldade, Post
+from .search import index_posts, unindex_post
+
+
+def create_attachment_derivatives(sender, instance, created, **kwargs):
+    """ Prepares the print copies of a Summernote upload before the first export needs them. """
+    if not created or not instance.file:
+        return
+    try:
+        path = instance.file.path
+    except NotImplementedError:
+        # Not stored on the local filesystem: the PDF exports only read MEDIA_ROOT
+        return
+    create_derivatives(Path(path))
+
+
+def update_search_index(sender, instance, **kwargs):
+    """ Keeps the full-text index in step with every saved question. """
+    index_posts([instance])
+
+
+def remove_from_search_index(sender, instance, **kwargs):
+    unindex_post(instance.pk)
+
+
+def drop_facet_counts(sender, **kwargs):
+    """ Any question, area or difficulty change can move the filter counts. """
+    invalidate_facets()
+
+
+def connect_signals():
+    for model in (Post, AreaDoConhecimento, Dificuldade):
+        for signal in (post_save, post_delete):
+            signal.connect(drop_facet_counts, sender=model, dispatch_uid=f'core.drop_facet_counts.{model.__name__}')
+    post_save.connect(update_search_index, sender=Post, dispatch_uid='core.update_search_index')
+    post_delete.connect(remove_from_search_index, sender=Post, dispatch_uid='core.remove_from_search_index')
+    post_save.connect(
+        create_attachment_derivatives, sender=get_attachment_model(),
+        dispatch_uid='core.create_attachment_derivatives',
+    )
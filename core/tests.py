@@ -1,3 +1,1678 @@
-from django.test import TestCase
+import hashlib
+import html
+import importlib
+import io
+import json
+import multiprocessing
+import os
+import pstats
+import random
+import re
+import shutil
+import tempfile
+import threading
+import tracemalloc
+import types
+import zipfile
+from contextlib import contextmanager
+from pathlib import Path
+from unittest import mock, skipUnless
 
-# Create your tests here.
+import numpy as np
+from PIL import Image
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.files.base import ContentFile
+from django.core.management import CommandError, call_command
+from django.db import connection, transaction
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+
+try:
+    import weasyprint  # noqa: F401
+    HAS_WEASYPRINT = True
+except (ImportError, OSError):
+    # OSError: the Python package is there but Pango/HarfBuzz are not
+    HAS_WEASYPRINT = False
+
+
+class FakeDocument:
+    """ Stand-in for a laid-out weasyprint Document: writing checks the layout lock is held. """
+
+    def __init__(self, pages, lock):
+        self.pages = pages
+        self.lock = lock
+
+    def copy(self, pages):
+        return FakeDocument(pages, self.lock)
+
+    def write_pdf(self, target=None):
+        assert self.lock.locked(), "write_pdf outside the layout lock"
+        data = b'%PDF-fake ' + b' '.join(page.encode() for page in self.pages)
+        if target is None:
+            return data
+        target.write(data)
+
+
+def fake_weasyprint_modules():
+    """ Just enough of WeasyPrint's API for core.pdf to import and run where Pango is missing. """
+    weasyprint = types.ModuleType('weasyprint')
+    fonts = types.ModuleType('weasyprint.text.fonts')
+    urls = types.ModuleType('weasyprint.urls')
+    weasyprint.CSS = mock.Mock(name='CSS')
+    weasyprint.HTML = mock.Mock(name='HTML')
+    fonts.FontConfiguration = type('FontConfiguration', (), {})
+    urls.URLFetcher = type('URLFetcher', (), {'__init__': lambda self, **kwargs: None})
+    urls.URLFetcherResponse = lambda url, body, headers: (url, body, headers)
+    return {
+        'weasyprint': weasyprint, 'weasyprint.text': types.ModuleType('weasyprint.text'),
+        'weasyprint.text.fonts': fonts, 'weasyprint.urls': urls,
+    }
+
+
+def import_pdf_module(test):
+    """ core.pdf: the real one with WeasyPrint, else a copy importing the stand-ins (undone after the test). """
+    import core
+
+    if HAS_WEASYPRINT:
+        from . import pdf
+        return pdf
+    patcher = mock.patch.dict('sys.modules', fake_weasyprint_modules())
+    patcher.start()
+    test.addCleanup(patcher.stop)
+    test.addCleanup(lambda: core.__dict__.pop('pdf', None))
+    return importlib.import_module('core.pdf')
+
+from . import archive, benchmarks, facets, images, jobs, metrics, pdf_cache, search, timing, utils
+from .cache import ObjectCache, RenderCache, make_cache_key
+from .models import AreaDoConhecimento, Dificuldade, ExportJob, Post, refresh_rendered_posts
+from .pagination import decode_cursor, encode_cursor, keyset_page
+
+
+class RenderCacheTests(SimpleTestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir, ignore_errors=True)
+
+    def test_memory_lru_is_bounded_by_size(self):
+        cache = RenderCache(memory_bytes=10, disk_bytes=0)
+        cache.set('a', b'12345')
+        cache.set('b', b'12345')
+        cache.get('a')  # 'a' becomes most recently used
+        cache.set('c', b'12345')
+
+        self.assertIsNotNone(cache.get('a'))
+        self.assertIsNone(cache.get('b'))
+        self.assertIsNotNone(cache.get('c'))
+
+    def test_disk_level_survives_a_new_process(self):
+        RenderCache(directory=self.tmpdir).set('k' * 64, b'png-bytes')
+
+        fresh = RenderCache(directory=self.tmpdir)
+        self.assertEqual(fresh.get('k' * 64), b'png-bytes')
+        stats = fresh.stats()
+        self.assertEqual((stats['hits'], stats['disk_hits'], stats['misses']), (1, 1, 0))
+
+    def test_disk_level_evicts_oldest_files(self):
+        cache = RenderCache(directory=self.tmpdir, memory_bytes=0, disk_bytes=25)
+        for key in ('aa1', 'aa2', 'aa3'):
+            cache.set(key, b'0123456789')
+
+        self.assertFalse(cache.contains('aa1'))
+        self.assertTrue(cache.contains('aa3'))
+
+    def test_key_depends_on_every_part(self):
+        self.assertNotEqual(make_cache_key('x', 'inline', 16), make_cache_key('x', 'inline', 13))
+
+
+class LatexCacheTests(SimpleTestCase):
+
+    def setUp(self):
+        patcher = mock.patch.object(utils, '_latex_cache', RenderCache())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_same_formula_is_rendered_once(self):
+        with mock.patch.object(utils, 'render_latex_png', return_value=b'png') as render:
+            first = utils.process_content_for_pdf('<p>##x^2##</p><p>##x^2##</p>')
+            second = utils.latex_to_base64('x^2', style='inline', embed=False)
+
+        self.assertEqual(render.call_count, 1)
+        self.assertIn(second, first)
+        self.assertEqual(utils.latex_cache_stats()['hits'], 2)
+
+    def test_style_is_part_of_the_key(self):
+        with mock.patch.object(utils, 'render_latex_png', return_value=b'png') as render:
+            utils.latex_to_base64('x', style='inline')
+            utils.latex_to_base64('x', style='block')
+
+        self.assertEqual(render.call_count, 2)
+
+
+class PrerenderFormulasTests(SimpleTestCase):
+
+    def setUp(self):
+        patcher = mock.patch.object(utils, '_latex_cache', RenderCache())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_extract_formulas_deduplicates_per_style(self):
+        content = r'<p>##a##, \[a\] and ##a## again, ##b&amp;c##</p>'
+        self.assertEqual(
+            utils.extract_formulas(content),
+            {('a', 'inline'), ('a', 'block'), ('b&c', 'inline')},
+        )
+
+    @override_settings(LATEX_RENDER_WORKERS=1)
+    def test_prerender_fills_the_cache_for_process_content(self):
+        contents = ['##x## \\[y\\]', '##x## ##z##']
+        with mock.patch.object(utils, 'render_latex_png', return_value=b'png') as render:
+            self.assertEqual(utils.prerender_formulas(contents), 3)
+            self.assertEqual(utils.prerender_formulas(contents), 0)
+            for content in contents:
+                utils.process_content_for_pdf(content)
+
+        self.assertEqual(render.call_count, 3)
+
+    @override_settings(LATEX_RENDER_WORKERS=2)
+    def test_pool_output_matches_serial_rendering(self):
+        prerender = utils.uses_render_pool(utils.prerender_formulas)
+        self.assertEqual(prerender(['##x^2## ##\\frac{1}{2}##']), 2)
+        key = utils.latex_cache_key('x^2', 'inline')
+        self.assertEqual(utils.get_latex_cache().get(key), utils.render_latex_png('x^2', 16, 150))
+
+
+    @override_settings(LATEX_RENDER_WORKERS=2)
+    def test_pool_is_only_used_where_allowed(self):
+        with mock.patch.object(utils, 'ProcessPoolExecutor') as executor, \
+                mock.patch.object(utils, '_render_pool', None), \
+                mock.patch.object(utils, 'render_latex_png', return_value=b'png'):
+            # e.g. a question saved from the web form
+            self.assertEqual(utils.prerender_formulas(['##a## ##b##']), 2)
+            executor.assert_not_called()
+
+            self.assertIs(utils.uses_render_pool(utils.get_render_pool)(), executor.return_value)
+        self.assertIsNone(utils.get_render_pool())
+
+
+class PreRenderedContentTests(TestCase):
+
+    def setUp(self):
+        patcher = mock.patch.object(utils, '_latex_cache', RenderCache())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.render = mock.patch.object(utils, 'render_latex_png', return_value=b'png').start()
+        self.addCleanup(mock.patch.stopall)
+
+    def test_fragment_is_reused_until_content_changes(self):
+        post = Post.objects.create(title='Q1', content='<p>##x##</p>')
+        post.refresh_rendered_content()
+
+        post = Post.objects.get(pk=post.pk)
+        self.assertFalse(post.rendered_is_stale())
+        with mock.patch.object(Post, 'refresh_rendered_content') as refresh:
+            self.assertIn('latex-inline', post.get_rendered_content())
+        refresh.assert_not_called()
+
+        Post.objects.filter(pk=post.pk).update(content='<p>##y##</p>')
+        post = Post.objects.get(pk=post.pk)
+        self.assertTrue(post.rendered_is_stale())
+        post.get_rendered_content()
+        self.assertFalse(Post.objects.get(pk=post.pk).rendered_is_stale())
+
+    def test_evicted_formula_images_mark_fragments_stale(self):
+        post = Post.objects.create(title='Q1', content='<p><img src="/media/a.png"> ##x##</p>')
+        post.refresh_rendered_content()
+        self.assertIn('src="/media/a.png"', post.rendered_content)
+        self.assertIn('src="latex://', post.rendered_content)
+        self.assertFalse(post.rendered_is_stale())
+
+        utils.get_latex_cache().clear()
+        self.assertTrue(post.rendered_is_stale())
+
+    def test_renderer_version_bump_marks_fragments_stale(self):
+        post = Post.objects.create(title='Q1', content='<p>##x##</p>')
+        post.refresh_rendered_content()
+
+        with mock.patch('core.models.RENDERER_VERSION', post.rendered_version + 1):
+            self.assertTrue(post.rendered_is_stale())
+
+
+class SvgOutputTests(SimpleTestCase):
+
+    def setUp(self):
+        patcher = mock.patch.object(utils, '_latex_cache', RenderCache())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    @override_settings(LATEX_OUTPUT_FORMAT='svg')
+    def test_svg_mode_emits_vector_images_with_the_same_css_class(self):
+        tag = utils.latex_to_base64(r'\frac{a}{b}', style='block')
+        self.assertIn('src="data:image/svg+xml;base64,', tag)
+        self.assertIn('class="latex-block"', tag)
+
+    def test_svg_has_glyphs_as_paths_and_is_deterministic(self):
+        svg = utils.render_latex_svg('x^2', 16, 150)
+        self.assertIn(b'<path', svg)
+        self.assertNotIn(b'<text', svg)
+        self.assertEqual(svg, utils.render_latex_svg('x^2', 16, 150))
+
+    def test_format_is_part_of_the_keys(self):
+        self.assertNotEqual(utils.latex_cache_key('x', 'inline', 'png'), utils.latex_cache_key('x', 'inline', 'svg'))
+        with override_settings(LATEX_OUTPUT_FORMAT='svg'):
+            svg_hash = utils.content_hash('##x##')
+        self.assertNotEqual(svg_hash, utils.content_hash('##x##'))
+
+
+class FastRasterizerTests(SimpleTestCase):
+    """ The mathtext rasterizer must stay close to the pyplot one it replaced. """
+
+    FORMULAS = [
+        'x',
+        r'\alpha',
+        'x^2 + y^2 = r^2',
+        'f(x) = 3x - 2',
+        r'\frac{-b \pm \sqrt{b^2 - 4ac}}{2a}',
+        r'\int_0^1 x^2 \, dx',
+        r'\sum_{n=1}^{\infty} \frac{1}{n^2}',
+    ]
+
+    @staticmethod
+    def _alpha(png_bytes):
+        return np.asarray(Image.open(io.BytesIO(png_bytes)).convert('RGBA'))[..., 3].astype(float)
+
+    @staticmethod
+    def _blur(a):
+        padded = np.pad(a, 1)
+        return sum(padded[i:i + a.shape[0], j:j + a.shape[1]] for i in range(3) for j in range(3)) / 9
+
+    def _best_correlation(self, a, b):
+        """ Normalized cross-correlation, allowing a shift of up to 2px. """
+        height = max(a.shape[0], b.shape[0]) + 4
+        width = max(a.shape[1], b.shape[1]) + 4
+
+        def place(img, dy, dx):
+            canvas = np.zeros((height, width))
+            canvas[2 + dy:2 + dy + img.shape[0], 2 + dx:2 + dx + img.shape[1]] = img
+            return canvas - canvas.mean()
+
+        ref = place(a, 0, 0)
+        best = -1
+        for dy in range(-2, 3):
+            for dx in range(-2, 3):
+                other = place(b, dy, dx)
+                best = max(best, (ref * other).sum() / np.sqrt((ref * ref).sum() * (other * other).sum()))
+        return best
+
+    def test_matches_pyplot_rendering_within_tolerance(self):
+        for formula in self.FORMULAS:
+            for style in ('inline', 'block'):
+                font_size, dpi_val, _ = utils.LATEX_STYLES[style]
+                with self.subTest(formula=formula, style=style):
+                    old = self._alpha(utils.render_latex_png_pyplot(formula, font_size, dpi_val))
+                    new = self._alpha(utils.render_latex_png(formula, font_size, dpi_val))
+
+                    # Same footprint on the page (sizes in px)
+                    self.assertLessEqual(abs(old.shape[0] - new.shape[0]), 4)
+                    self.assertLessEqual(abs(old.shape[1] - new.shape[1]), 4)
+                    # Same amount of ink, in the same places (sub-pixel placement aside)
+                    self.assertAlmostEqual(new.sum() / old.sum(), 1, delta=0.25)
+                    self.assertGreater(self._best_correlation(self._blur(old), self._blur(new)), 0.75)
+
+    def test_invalid_formula_still_falls_back_to_math_error(self):
+        with mock.patch.object(utils, '_latex_cache', RenderCache()):
+            self.assertIn('[Math Error]', utils.latex_to_base64(r'\frac{', style='inline'))
+
+
+class LatexBatchTests(SimpleTestCase):
+
+    def setUp(self):
+        patcher = mock.patch.object(utils, '_latex_cache', RenderCache())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    @override_settings(LATEX_RENDER_WORKERS=1)
+    def test_batch_keeps_order_and_renders_each_formula_once(self):
+        items = [('x', 'inline'), ('y', 'block'), ('x', 'inline'), ('x', 'block')]
+        with mock.patch.object(utils, 'render_latex_png', side_effect=lambda f, *a: f.encode()) as render:
+            tags = utils.latex_to_base64_batch(items)
+
+        self.assertEqual(render.call_count, 3)
+        self.assertEqual(tags, [utils.latex_to_base64(f, style=s) for f, s in items])
+
+    @override_settings(LATEX_RENDER_WORKERS=1)
+    def test_process_content_matches_per_formula_substitution(self):
+        content = r'<p>Seja ##a^2## e \[\frac{a}{b}\] com ##a^2## e ##b##.</p>'
+        expected = content
+        expected = re.sub(r'\\\[(.*?)\\\]', lambda m: utils.latex_to_base64(m.group(1), style='block', embed=False), expected, flags=re.DOTALL)
+        expected = re.sub(r'\#\#(.*?)\#\#', lambda m: utils.latex_to_base64(m.group(1), style='inline', embed=False), expected, flags=re.DOTALL)
+
+        self.assertEqual(utils.process_content_for_pdf(content), expected)
+
+
+class EvictedFormulaTests(SimpleTestCase):
+    """ Runs with or without Pango (see import_pdf_module). """
+
+    def setUp(self):
+        patcher = mock.patch.object(utils, '_latex_cache', RenderCache())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.pdf = import_pdf_module(self)
+
+    @override_settings(LATEX_OUTPUT_FORMAT='png')
+    def test_evicted_formula_is_rendered_again_from_its_url(self):
+        tag = utils.latex_to_base64('a < b', style='block', embed=False)
+        url = html.unescape(re.search(r'src="([^"]+)"', tag).group(1))
+        key = utils.LATEX_REF_RE.search(tag).group(1)
+        expected = utils.get_latex_cache().get(key)
+        utils.get_latex_cache().clear()
+
+        with mock.patch.object(utils, 'render_latex_png', wraps=utils.render_latex_png) as render:
+            self.pdf.PdfUrlFetcher().fetch(url)
+            self.pdf.PdfUrlFetcher().fetch(url)
+        render.assert_called_once_with('a < b', *utils.LATEX_STYLES['block'][:2])
+        self.assertEqual(utils.get_latex_cache().get(key), expected)
+
+        # Only the formula the key was made from
+        utils.get_latex_cache().clear()
+        with self.assertRaises(ValueError):
+            self.pdf.PdfUrlFetcher().fetch(url.replace('a+%3C+b', 'c'))
+        with self.assertRaises(ValueError):
+            self.pdf.PdfUrlFetcher().fetch(f'latex://{key}')
+
+
+@skipUnless(HAS_WEASYPRINT, "WeasyPrint system libraries are not installed")
+class PdfUrlFetcherTests(SimpleTestCase):
+
+    def setUp(self):
+        patcher = mock.patch.object(utils, '_latex_cache', RenderCache())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_formulas_are_served_from_the_cache(self):
+        from .pdf import PdfUrlFetcher
+
+        tag = utils.latex_to_base64('x^2', style='inline', embed=False)
+        key = utils.LATEX_REF_RE.search(tag).group(1)
+        response = PdfUrlFetcher().fetch(f'latex://{key}')
+
+        self.assertEqual(response.read(), utils.get_latex_cache().get(key))
+        self.assertEqual(response.content_type, 'image/png')
+
+    def test_media_urls_map_to_media_root_only(self):
+        from .pdf import PDF_BASE_URL, media_path_for_url
+
+        media_root = Path(settings.MEDIA_ROOT).resolve()
+        self.assertEqual(
+            media_path_for_url(PDF_BASE_URL + 'media/django-summernote/a%20b.png'),
+            media_root / 'django-summernote' / 'a b.png',
+        )
+        self.assertIsNone(media_path_for_url(PDF_BASE_URL + 'media/../settings.py'))
+        self.assertIsNone(media_path_for_url('http://example.com/media/a.png'))
+
+    def test_repeated_formulas_are_embedded_once(self):
+        from .pdf import write_pdf
+
+        content = utils.process_content_for_pdf('<p>##x^2##</p>' * 20)
+        once = write_pdf(f'<html><body>{utils.process_content_for_pdf("<p>##x^2##</p>")}</body></html>')
+        many = write_pdf(f'<html><body>{content}</body></html>')
+        self.assertLess(len(many), len(once) * 2)
+
+
+@override_settings(EXPORT_JOBS_MODE='worker')
+class ExportJobTests(TestCase):
+
+    def setUp(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir, ignore_errors=True)
+        settings_patch = override_settings(EXPORT_JOBS_DIR=Path(tmpdir))
+        settings_patch.enable()
+        self.addCleanup(settings_patch.disable)
+
+    def test_a_job_can_only_be_claimed_once(self):
+        job = jobs.submit_export_job('exam', ['1', '2'])
+        self.assertEqual(job.post_ids, [1, 2])
+
+        self.assertIsNotNone(jobs.claim_job(job.pk))
+        self.assertIsNone(jobs.claim_job(job.pk))
+        self.assertIsNone(jobs.claim_next_job())
+
+    def test_cleanup_removes_old_finished_jobs_and_files(self):
+        old = ExportJob.objects.create(kind='exam', status=ExportJob.STATUS_DONE,
+                                       finished_at=timezone.now() - timezone.timedelta(days=2))
+        old.file.save('old.pdf', ContentFile(b'%PDF'), save=True)
+        fresh = ExportJob.objects.create(kind='exam', status=ExportJob.STATUS_DONE, finished_at=timezone.now())
+        pending = ExportJob.objects.create(kind='exam')
+
+        self.assertEqual(jobs.cleanup_old_exports(max_age=3600), 1)
+        self.assertFalse(Path(old.file.path).exists())
+        self.assertEqual(set(ExportJob.objects.values_list('pk', flat=True)), {fresh.pk, pending.pk})
+
+    def test_stalled_running_jobs_are_failed_then_cleaned_up(self):
+        stalled = ExportJob.objects.create(kind='exam', status=ExportJob.STATUS_RUNNING,
+                                           started_at=timezone.now() - timezone.timedelta(hours=2))
+        recent = ExportJob.objects.create(kind='exam', status=ExportJob.STATUS_RUNNING, started_at=timezone.now())
+
+        payload = self.client.get(reverse('export_job_status', args=[stalled.pk])).json()
+        self.assertEqual(payload['status'], 'failed')
+        self.assertIn('did not finish', payload['error'])
+        self.assertIsNone(jobs.claim_next_job())
+        recent.refresh_from_db()
+        self.assertEqual(recent.status, ExportJob.STATUS_RUNNING)
+
+        ExportJob.objects.filter(pk=stalled.pk).update(finished_at=timezone.now() - timezone.timedelta(days=2))
+        self.assertEqual(jobs.cleanup_old_exports(max_age=3600), 1)
+
+    def test_pending_job_from_before_a_restart_is_resubmitted_when_polled(self):
+        # Queued by a previous process: no thread of this one has it
+        job = ExportJob.objects.create(kind='exam', post_ids=[1])
+        status_url = reverse('export_job_status', args=[job.pk])
+        with mock.patch.object(jobs, '_get_executor') as executor:
+            # A worker will claim it
+            self.client.get(status_url)
+            executor.return_value.submit.assert_not_called()
+
+            with override_settings(EXPORT_JOBS_MODE='thread'):
+                self.client.get(status_url)
+                self.client.get(status_url)
+        executor.return_value.submit.assert_called_once_with(jobs._run_in_thread, job.pk)
+        jobs._submitted.discard(job.pk)
+
+    def test_thread_mode_cleans_up_after_a_job(self):
+        old = ExportJob.objects.create(kind='exam', status=ExportJob.STATUS_DONE,
+                                       finished_at=timezone.now() - timezone.timedelta(days=2))
+        job = ExportJob.objects.create(kind='exam', post_ids=[1])
+        with mock.patch.object(jobs, 'run_export_job') as run_export_job, \
+                mock.patch.object(jobs, 'close_old_connections'), \
+                mock.patch.object(jobs, '_last_cleanup', None):
+            jobs._run_in_thread(job.pk)
+            run_export_job.assert_called_once()
+            self.assertFalse(ExportJob.objects.filter(pk=old.pk).exists())
+
+            # At most once per EXPORT_JOBS_CLEANUP_INTERVAL
+            old = ExportJob.objects.create(kind='exam', status=ExportJob.STATUS_DONE,
+                                           finished_at=timezone.now() - timezone.timedelta(days=2))
+            jobs._run_in_thread(ExportJob.objects.create(kind='exam', post_ids=[1]).pk)
+            self.assertTrue(ExportJob.objects.filter(pk=old.pk).exists())
+
+    @skipUnless(HAS_WEASYPRINT, "WeasyPrint system libraries are not installed")
+    def test_async_export_can_be_polled_and_downloaded(self):
+        post = Post.objects.create(title='Q1', content='<p>##x##</p>')
+        response = self.client.post(reverse('generate_exam_pdf'), {'post_ids': [post.pk], 'async': '1'})
+        self.assertEqual(response.status_code, 202)
+        status_url = response.json()['status_url']
+        self.assertEqual(self.client.get(status_url).json()['status'], 'pending')
+
+        jobs.run_pending_jobs(once=True)
+
+        payload = self.client.get(status_url).json()
+        self.assertEqual(payload['status'], 'done')
+        download = self.client.get(payload['download_url'])
+        self.assertEqual(download['Content-Type'], 'application/pdf')
+        self.assertTrue(b''.join(download.streaming_content).startswith(b'%PDF'))
+
+
+class PdfResultCacheTests(TestCase):
+
+    def setUp(self):
+        patcher = mock.patch.object(pdf_cache, '_pdf_cache', RenderCache())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.area = AreaDoConhecimento.objects.create(name='Física')
+        self.dificuldade = Dificuldade.objects.create(name='Fácil')
+        self.post = Post.objects.create(title='Q1', content='<p>x</p>', area_do_conhecimento=self.area,
+                                        dificuldade=self.dificuldade)
+        self.other = Post.objects.create(title='Q2', content='<p>y</p>')
+
+    def test_key_depends_on_kind_and_order_of_questions(self):
+        ids = [self.post.pk, self.other.pk]
+        key = pdf_cache.export_cache_key('exam', ids)
+        self.assertEqual(key, pdf_cache.export_cache_key('exam', [str(pk) for pk in ids]))
+        self.assertNotEqual(key, pdf_cache.export_cache_key('selected', ids))
+        self.assertNotEqual(key, pdf_cache.export_cache_key('exam', ids[::-1]))
+
+    def test_editing_a_question_area_or_difficulty_changes_the_key(self):
+        ids = [self.post.pk, self.other.pk]
+        keys = {pdf_cache.export_cache_key('exam', ids)}
+        for obj in (self.post, self.area, self.dificuldade):
+            obj.save()
+            keys.add(pdf_cache.export_cache_key('exam', ids))
+        self.other.delete()
+        keys.add(pdf_cache.export_cache_key('exam', ids))
+        self.assertEqual(len(keys), 5)
+
+    def test_cached_export_is_served_with_etag_and_revalidated(self):
+        key = pdf_cache.export_cache_key('exam', [self.post.pk])
+        pdf_cache.get_pdf_cache().set(key, b'%PDF-cached')
+
+        response = self.client.post(reverse('generate_exam_pdf'), {'post_ids': [self.post.pk]})
+        self.assertEqual(response.getvalue(), b'%PDF-cached')
+        self.assertEqual(response['ETag'], f'"{key}"')
+
+        url = f"{reverse('generate_exam_pdf')}?post_ids={self.post.pk}"
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=f'"{key}"').status_code, 304)
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH='"stale"').getvalue(), b'%PDF-cached')
+
+    def test_invalid_question_ids_are_rejected(self):
+        for post_ids in (['1', 'abc'], ['1.5'], ['0'], [str(2 ** 63)]):
+            for url_name in ('export_selected_pdf', 'generate_exam_pdf'):
+                with self.subTest(post_ids=post_ids, url_name=url_name):
+                    url = reverse(url_name)
+                    self.assertEqual(self.client.get(url, {'post_ids': post_ids}).status_code, 400)
+                    self.assertEqual(self.client.post(url, {'post_ids': post_ids}).status_code, 400)
+                    self.assertEqual(self.client.post(url, {'post_ids': post_ids, 'async': '1'}).status_code, 400)
+        self.assertFalse(ExportJob.objects.exists())
+
+
+class ExportTimingTests(TestCase):
+
+    def setUp(self):
+        patcher = mock.patch.object(pdf_cache, '_pdf_cache', RenderCache())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.post = Post.objects.create(title='Q1', content='<p>x</p>')
+
+    def export(self, **params):
+        with self.assertLogs('core.exports', 'INFO') as logs:
+            response = self.client.get(reverse('generate_exam_pdf'), {'post_ids': [self.post.pk], **params})
+        return response, logs.records[-1]
+
+    def test_stages_go_to_server_timing_and_the_log(self):
+        def build(queryset, target):
+            with timing.stage('layout'):
+                pass
+            with timing.stage('layout'):
+                pass
+            target.write(b'%PDF-built')
+
+        # A stand-in for core.pdf, which needs WeasyPrint's system libraries
+        fake_pdf = mock.Mock(EXPORTS={'exam': build})
+        with mock.patch.dict('sys.modules', {'core.pdf': fake_pdf}):
+            response, record = self.export()
+        self.assertEqual(response.getvalue(), b'%PDF-built')
+        metrics = [metric.split(';')[0] for metric in response['Server-Timing'].split(', ')]
+        self.assertEqual(metrics, ['db', 'pdf_cache', 'layout', 'total'])
+        self.assertIn('pdf_cache;desc="miss"', response['Server-Timing'])
+
+        self.assertEqual(record.export_timing['kind'], 'exam')
+        self.assertEqual(record.export_timing['pdf_cache'], 'miss')
+        self.assertIn('total_ms', record.export_timing)
+        self.assertTrue(record.getMessage().startswith('pdf_export kind=exam '))
+
+        # Served from the PDF cache the second time
+        response, record = self.export()
+        self.assertIn('pdf_cache;desc="hit"', response['Server-Timing'])
+
+    def test_stages_outside_an_export_are_not_recorded(self):
+        with timing.stage('db'):
+            pass
+        with timing.export_timing('exam') as timer:
+            with timing.stage('db'):
+                pass
+        self.assertEqual(list(timer.stages), ['db'])
+
+    def test_profile_is_dumped_only_when_enabled(self):
+        pdf_cache.get_pdf_cache().set(pdf_cache.export_cache_key('exam', [self.post.pk]), b'%PDF-cached')
+        profile_dir = Path(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, profile_dir)
+
+        self.export(profile='1')
+        self.assertEqual(list(profile_dir.iterdir()), [])
+
+        with override_settings(PDF_EXPORT_PROFILE_DIR=profile_dir):
+            self.export()
+            self.assertEqual(list(profile_dir.iterdir()), [])
+            _, record = self.export(profile='1')
+
+        dumps = list(profile_dir.iterdir())
+        self.assertEqual(len(dumps), 1)
+        self.assertEqual(record.export_timing['profile'], str(dumps[0]))
+        self.assertGreater(pstats.Stats(str(dumps[0])).total_calls, 0)
+
+
+def _count_in_child():
+    metrics.inc('qrepo_formula_errors_total', 2)
+    metrics.flush()
+
+
+# Only the values of the test process: no files from other runs or tests
+@override_settings(METRICS_DIR=None, METRICS_TOKEN='scrape-token')
+class MetricsTests(TestCase):
+
+    def setUp(self):
+        patchers = [
+            mock.patch.object(metrics, '_registry', None),
+            mock.patch.object(pdf_cache, '_pdf_cache', RenderCache()),
+            mock.patch.object(utils, '_latex_cache', RenderCache()),
+        ]
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def scrape(self):
+        response = self.client.get(reverse('metrics'), headers={'Authorization': 'Bearer scrape-token'})
+        self.assertTrue(response['Content-Type'].startswith('text/plain; version=0.0.4'))
+        return response.content.decode()
+
+    def test_histograms_are_cumulative(self):
+        for seconds in (0.003, 0.02, 0.02, 3.0):
+            metrics.observe('qrepo_formula_render_seconds', seconds, format='png')
+        text = self.scrape()
+        self.assertIn('# TYPE qrepo_formula_render_seconds histogram', text)
+        self.assertIn('qrepo_formula_render_seconds_bucket{format="png",le="0.005"} 1', text)
+        self.assertIn('qrepo_formula_render_seconds_bucket{format="png",le="0.025"} 3', text)
+        self.assertIn('qrepo_formula_render_seconds_bucket{format="png",le="1.0"} 3', text)
+        self.assertIn('qrepo_formula_render_seconds_bucket{format="png",le="+Inf"} 4', text)
+        self.assertIn('qrepo_formula_render_seconds_count{format="png"} 4', text)
+
+    @override_settings(LATEX_RENDER_WORKERS=1)
+    def test_formula_renders_errors_and_cache_hits(self):
+        utils.latex_to_base64('x^2')
+        utils.latex_to_base64('x^2')
+        utils.latex_to_base64_batch([('y^2', 'inline'), ('z^2', 'block')])
+        utils.latex_to_base64('\\frac{')
+        text = self.scrape()
+        self.assertIn('qrepo_formula_renders_total{format="png"} 3', text)
+        self.assertIn('qrepo_formula_render_seconds_count{format="png"} 3', text)
+        self.assertIn('qrepo_formula_errors_total 1', text)
+        self.assertRegex(text, r'qrepo_cache_hits_total\{cache="latex"\} [1-9]')
+        self.assertRegex(text, r'qrepo_cache_hit_ratio\{cache="latex"\} 0\.\d{4}')
+
+    def test_export_latency_and_pdf_size_per_endpoint(self):
+        post = Post.objects.create(title='Q1', content='<p>x</p>')
+        fake_pdf = mock.Mock(EXPORTS={'exam': lambda queryset, target: target.write(b'%PDF-built')})
+        with mock.patch.dict('sys.modules', {'core.pdf': fake_pdf}), self.assertLogs('core.exports'):
+            for _ in range(2):
+                self.client.post(reverse('generate_exam_pdf'), {'post_ids': [post.pk]})
+        text = self.scrape()
+        self.assertIn('qrepo_export_seconds_count{endpoint="generate_exam_pdf",kind="exam"} 2', text)
+        # Built once, then served from the PDF cache
+        self.assertIn('qrepo_export_pdf_bytes_count{kind="exam"} 1', text)
+        self.assertIn('qrepo_cache_hit_ratio{cache="pdf"} 0.5000', text)
+
+    def test_scraping_requires_the_token_or_a_staff_login(self):
+        self.assertEqual(self.client.get(reverse('metrics')).status_code, 403)
+        response = self.client.get(reverse('metrics'), headers={'Authorization': 'Bearer wrong'})
+        self.assertEqual(response.status_code, 403)
+
+        staff = User.objects.create_user('staff', password='x', is_staff=True)
+        self.client.force_login(staff)
+        self.assertEqual(self.client.get(reverse('metrics')).status_code, 200)
+
+    def test_processes_are_added_up_through_the_metrics_dir(self):
+        metrics_dir = Path(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, metrics_dir)
+        with override_settings(METRICS_DIR=metrics_dir):
+            metrics.inc('qrepo_formula_errors_total')
+            utils.get_latex_cache().get('missing')
+            # A forked worker starts from zero and writes its own file
+            child = multiprocessing.get_context('fork').Process(target=_count_in_child)
+            child.start()
+            child.join()
+            self.assertEqual(child.exitcode, 0)
+            self.assertEqual(len(list(metrics_dir.glob('*.json'))), 2)
+
+            text = self.scrape()
+            self.assertIn('qrepo_formula_errors_total 3', text)
+            # The cache lookup the child inherited is only counted by the parent
+            self.assertIn('qrepo_cache_misses_total{cache="latex"} 1', text)
+
+            # The child exited: its file was folded into stopped.json, counts unchanged
+            names = sorted(path.name for path in metrics_dir.iterdir())
+            self.assertEqual(names, sorted([f'{metrics._registry.name}.json', metrics.STOPPED_NAME]))
+            metrics.inc('qrepo_formula_errors_total')
+            self.assertIn('qrepo_formula_errors_total 4', self.scrape())
+
+
+class StreamedExportTests(TestCase):
+    """ Exports go to the client from a spooled file: memory does not grow with the size of the PDF. """
+
+    PDF_SIZE = 32 * 1024 * 1024
+
+    def setUp(self):
+        cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_dir)
+        patcher = mock.patch.object(pdf_cache, '_pdf_cache', RenderCache(directory=cache_dir, disk_bytes=2 * self.PDF_SIZE))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.post = Post.objects.create(title='Q1', content='<p>x</p>')
+
+    def build_large_pdf(self, queryset, target):
+        chunk = b'%PDF' + b'x' * (64 * 1024 - 4)
+        for _ in range(self.PDF_SIZE // len(chunk)):
+            target.write(chunk)
+
+    def download(self):
+        """ Bytes received and peak traced memory of one export request. """
+        tracemalloc.start()
+        try:
+            with self.assertLogs('core.exports'):
+                response = self.client.post(reverse('export_selected_pdf'), {'post_ids': [self.post.pk]})
+            received = sum(len(chunk) for chunk in response.streaming_content)
+            response.close()
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+        self.assertEqual(int(response['Content-Length']), received)
+        return received, peak
+
+    def test_large_export_is_streamed_built_and_from_the_cache(self):
+        fake_pdf = mock.Mock(EXPORTS={'selected': self.build_large_pdf})
+        with mock.patch.dict('sys.modules', {'core.pdf': fake_pdf}):
+            for served_from in ('build', 'disk cache'):
+                with self.subTest(served_from=served_from):
+                    received, peak = self.download()
+                    self.assertEqual(received, self.PDF_SIZE)
+                    self.assertLess(peak, self.PDF_SIZE // 4)
+        self.assertEqual(pdf_cache.pdf_cache_stats()['disk_hits'], 1)
+        self.assertEqual(pdf_cache.pdf_cache_stats()['memory_entries'], 0)
+
+    def test_views_stream_the_pdf_written_by_each_builder(self):
+        """ Runs with or without Pango: only the layout is replaced by FakeDocument. """
+        pdf = import_pdf_module(self)
+        html = mock.Mock(side_effect=lambda **kwargs: mock.Mock(
+            render=lambda **kwargs: FakeDocument(['page'], pdf._layout_lock),
+        ))
+        with mock.patch.object(pdf, 'HTML', html), mock.patch.object(pdf, '_page_cache', ObjectCache()), \
+                mock.patch.object(pdf, 'get_stylesheet', return_value=None):
+            for url_name in ('export_selected_pdf', 'generate_exam_pdf'):
+                with self.subTest(url_name=url_name):
+                    with self.assertLogs('core.exports'):
+                        response = self.client.get(reverse(url_name), {'post_ids': [self.post.pk]})
+                    self.assertTrue(response.streaming)
+                    received = b''.join(response.streaming_content)
+                    response.close()
+                    self.assertEqual(received, b'%PDF-fake page')
+                    self.assertEqual(int(response['Content-Length']), len(received))
+
+    def test_small_pdfs_are_also_kept_in_memory(self):
+        cache = RenderCache()
+        cache.set_file('key', io.BytesIO(b'%PDF-small'), 10)
+        with cache.open('key') as file:
+            self.assertEqual(file.read(), b'%PDF-small')
+
+    @skipUnless(HAS_WEASYPRINT, "WeasyPrint system libraries are not installed")
+    @override_settings(LATEX_RENDER_WORKERS=1)
+    def test_large_synthetic_selection(self):
+        from . import pdf
+
+        corpus = benchmarks.build_corpus(posts=120, formulas=3, images=0.5, seed=1)
+        queryset = Post.objects.filter(id__in=[post.pk for post in corpus])
+        for kind, builder in pdf.EXPORTS.items():
+            with self.subTest(kind=kind), pdf_cache.spooled_pdf_file() as target:
+                self.assertIsNone(builder(queryset, target))
+                target.seek(0)
+                self.assertEqual(target.read(4), b'%PDF')
+
+        with override_settings(PDF_SPOOL_MEMORY_BYTES=64 * 1024):
+            response = self.client.post(reverse('export_selected_pdf'), {'post_ids': [post.pk for post in corpus]})
+            # Serving does not load the file: it is read in blocks
+            tracemalloc.start()
+            try:
+                received = sum(len(chunk) for chunk in response.streaming_content)
+                peak = tracemalloc.get_traced_memory()[1]
+            finally:
+                tracemalloc.stop()
+        self.assertEqual(int(response['Content-Length']), received)
+        self.assertLess(peak, 1024 * 1024)
+
+
+class ObjectCacheTests(SimpleTestCase):
+
+    def test_least_recently_used_entry_is_evicted(self):
+        cache = ObjectCache(max_entries=2)
+        cache.set('a', object())
+        cache.set('b', object())
+        cache.get('a')
+        cache.set('c', object())
+
+        self.assertIsNotNone(cache.get('a'))
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.stats()['entries'], 2)
+
+    def test_bounded_by_estimated_size(self):
+        cache = ObjectCache(max_entries=10, max_bytes=100)
+        cache.set('a', object(), 60)
+        cache.set('b', object(), 30)
+        cache.set('c', object(), 30)
+        cache.set('huge', object(), 101)
+
+        self.assertIsNone(cache.get('a'))
+        self.assertIsNone(cache.get('huge'))
+        self.assertEqual(cache.stats()['bytes'], 60)
+
+
+class PageCacheThreadTests(TestCase):
+    """ Runs with or without Pango: layout is replaced by FakeDocument. """
+
+    def setUp(self):
+        self.pdf = import_pdf_module(self)
+        self.font_configs = []
+
+        def render(**kwargs):
+            # Layout must hold the lock and use the process's font configuration
+            self.assertTrue(self.pdf._layout_lock.locked())
+            self.font_configs.append(kwargs['font_config'])
+            return FakeDocument([f'page-{len(self.font_configs)}'], self.pdf._layout_lock)
+
+        html = mock.Mock(side_effect=lambda **kwargs: mock.Mock(render=render))
+        for patcher in (
+            mock.patch.object(self.pdf, '_page_cache', ObjectCache()),
+            mock.patch.object(self.pdf, 'HTML', html),
+            mock.patch.object(self.pdf, 'get_stylesheet', return_value=None),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_pages_laid_out_by_one_thread_are_reused_by_another(self):
+        posts = [Post.objects.create(title=f'Q{i}', content=f'<p>Questão {i}</p>') for i in range(2)]
+        # The thread must not need the (per-connection, in-transaction) test database
+        refresh_rendered_posts(posts)
+        results = {}
+        thread = threading.Thread(
+            target=lambda: results.update(documents=self.pdf.render_question_documents('abnt', posts)),
+        )
+        thread.start()
+        thread.join()
+
+        documents = self.pdf.render_question_documents('abnt', posts)
+        self.assertEqual(len(self.font_configs), 2)
+        self.assertIs(self.font_configs[0], self.font_configs[1])
+        self.assertEqual([id(d) for d in documents], [id(d) for d in results['documents']])
+        self.assertEqual(self.pdf.assemble_pdf(documents), b'%PDF-fake page-1 page-2')
+
+        cache = self.pdf.get_page_cache().stats()
+        self.assertEqual((cache['hits'], cache['entries']), (2, 2))
+        self.assertGreaterEqual(cache['bytes'], 2 * self.pdf.PAGE_COST_BYTES)
+
+
+@skipUnless(HAS_WEASYPRINT, "WeasyPrint system libraries are not installed")
+class QuestionPageCacheTests(TestCase):
+
+    def test_only_edited_questions_are_laid_out_again(self):
+        from . import pdf
+
+        patcher = mock.patch.object(pdf, '_page_cache', ObjectCache())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        posts = [Post.objects.create(title=f'Q{i}', content=f'<p>Questão {i}</p>') for i in range(3)]
+        with mock.patch.object(pdf, 'render_document', wraps=pdf.render_document) as render:
+            first = pdf.build_abnt_pdf(Post.objects.order_by('id'))
+            self.assertEqual(render.call_count, 3)
+
+            posts[1].content = '<p>Editada</p>'
+            posts[1].save()
+            second = pdf.build_abnt_pdf(Post.objects.order_by('id'))
+            self.assertEqual(render.call_count, 4)
+
+        self.assertTrue(first.startswith(b'%PDF') and second.startswith(b'%PDF'))
+
+
+@skipUnless(HAS_WEASYPRINT, "WeasyPrint system libraries are not installed")
+class SharedRenderingLayerTests(TestCase):
+
+    def test_exam_reuses_parsed_stylesheet_and_joins_body_into_template(self):
+        from . import pdf
+
+        html_string = pdf.render_export_html('pdf/exam.html', ['<p>A</p>', '<p>B</p>'])
+        self.assertIn('<div class="content-columns">\n<p>A</p><p>B</p>', html_string)
+        self.assertIs(pdf.get_stylesheet('exam'), pdf.get_stylesheet('exam'))
+
+        Post.objects.create(title='Q1', content='<p>##x^2##</p>')
+        with mock.patch.object(pdf, 'CSS', wraps=pdf.CSS) as css:
+            self.assertTrue(pdf.build_exam_pdf(Post.objects.all()).startswith(b'%PDF'))
+        css.assert_not_called()
+
+
+# The two regex passes process_content_for_pdf used before the tokenizer
+LEGACY_BLOCK_RE = re.compile(r'\\\[(.*?)\\\]', re.DOTALL)
+LEGACY_INLINE_RE = re.compile(r'\#\#(.*?)\#\#', re.DOTALL)
+
+def legacy_process_content_for_pdf(html_content):
+    if not html_content: return ""
+    for pattern, style in ((LEGACY_BLOCK_RE, 'block'), (LEGACY_INLINE_RE, 'inline')):
+        html_content = pattern.sub(
+            lambda m: utils.latex_to_base64_batch([(m.group(1), style)], embed=False)[0], html_content,
+        )
+    return html_content
+
+def legacy_extract_formulas(html_content):
+    if not html_content: return set()
+    formulas = {(utils.clean_latex(m.group(1)), 'block') for m in LEGACY_BLOCK_RE.finditer(html_content)}
+    remainder = LEGACY_BLOCK_RE.sub(' ', html_content)
+    formulas.update((utils.clean_latex(m.group(1)), 'inline') for m in LEGACY_INLINE_RE.finditer(remainder))
+    return formulas
+
+def fake_batch(items, fmt=None, embed=True):
+    # Like the real tags: no '#' or backslash, distinct per formula and style
+    return [
+        f'<img class="latex-{style}" data-src="{hashlib.sha1(source.encode()).hexdigest()}">'
+        for source, style in items
+    ]
+
+
+class ContentTokenizerTests(SimpleTestCase):
+    FRAGMENTS = [
+        '\\[', '\\]', '##', '#', '\\', '[', ']', 'x^2', ' ', '\n', '<p>', '</p>', '&amp;', '\xa0',
+        'src="/media/uploads/a.png"', "src='/media/b c.png'", 'src="/media/', 'src="/static/c.png"',
+        '<img src="/media/d.png">',
+    ]
+
+    def setUp(self):
+        patcher = mock.patch.object(utils, 'latex_to_base64_batch', side_effect=fake_batch)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def random_content(self, rng):
+        return ''.join(rng.choice(self.FRAGMENTS) for _ in range(rng.randint(0, 30)))
+
+    def test_matches_the_two_pass_implementation(self):
+        rng = random.Random(2024)
+        for _ in range(3000):
+            content = self.random_content(rng)
+            with self.subTest(content=content):
+                self.assertEqual(utils.process_content_for_pdf(content), legacy_process_content_for_pdf(content))
+                self.assertEqual(utils.extract_formulas(content), legacy_extract_formulas(content))
+
+    def test_tokens_cover_the_content(self):
+        content = 'a ##x \\[y\\] <img src="/media/z.png"> ## b \\[w\\] ##open'
+        tokens = list(utils.tokenize_content(content))
+        self.assertEqual(tokens, [
+            ('text', 'a '),
+            ('inline', [('text', 'x '), ('block', 'y'), ('text', ' <img '), ('media', 'src="/media/z.png"'),
+                        ('text', '> ')]),
+            ('text', ' b '),
+            ('block', 'w'),
+            ('text', ' '),
+            ('text', '##'),
+            ('text', 'open'),
+        ])
+        flat = ''.join(value if kind != 'block' else f'\\[{value}\\]' for kind, value in utils._walk_tokens(tokens))
+        self.assertEqual(flat.replace('##', ''), content.replace('##', ''))
+
+
+class ImageDerivativeTests(TestCase):
+
+    def setUp(self):
+        patcher = mock.patch.object(images, '_derivative_cache', RenderCache())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.tmpdir = Path(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, self.tmpdir, ignore_errors=True)
+
+    def save_photo(self, name, size, orientation=None):
+        path = self.tmpdir / name
+        noise = np.random.default_rng(0).integers(0, 256, (size[1], size[0], 3), dtype=np.uint8)
+        exif = Image.Exif()
+        if orientation:
+            exif[0x0112] = orientation
+        Image.fromarray(noise).save(path, format='JPEG', quality=95, exif=exif)
+        return path
+
+    def test_large_photo_is_downscaled_to_the_layout_width(self):
+        path = self.save_photo('photo.jpg', (3000, 2000))
+        data, mime_type = images.derivative_for(path, 'exam')
+
+        self.assertEqual(mime_type, 'image/jpeg')
+        self.assertLess(len(data), path.stat().st_size)
+        with Image.open(io.BytesIO(data)) as img:
+            self.assertEqual(img.size, (images.layout_width_px('exam'), round(2000 * images.layout_width_px('exam') / 3000)))
+
+    def test_exif_rotation_is_applied_and_small_images_are_kept(self):
+        path = self.save_photo('rotated.jpg', (2000, 3000), orientation=6)
+        data, _ = images.derivative_for(path, 'abnt')
+        with Image.open(io.BytesIO(data)) as img:
+            self.assertEqual(img.width, images.layout_width_px('abnt'))
+            self.assertLess(img.height, img.width)
+
+        self.assertIsNone(images.derivative_for(self.save_photo('small.jpg', (300, 200)), 'exam'))
+
+    def test_transparent_images_keep_their_alpha(self):
+        path = self.tmpdir / 'diagram.webp'
+        rgba = np.random.default_rng(0).integers(0, 256, (1000, 1500, 4), dtype=np.uint8)
+        rgba[:, :750, 3] = 0
+        Image.fromarray(rgba).save(path, format='WEBP', lossless=True)
+
+        data, mime_type = images.derivative_for(path, 'exam')
+        self.assertEqual(mime_type, 'image/png')
+        with Image.open(io.BytesIO(data)) as img:
+            self.assertEqual(img.mode, 'RGBA')
+            self.assertEqual(img.getpixel((0, 0))[3], 0)
+
+    def test_derivatives_are_cached_by_path_and_mtime(self):
+        path = self.save_photo('photo.jpg', (3000, 2000))
+        with mock.patch.object(images, 'make_derivative', wraps=images.make_derivative) as make:
+            images.derivative_for(path, 'exam')
+            images.derivative_for(path, 'exam')
+            self.assertEqual(make.call_count, 1)
+
+            st = path.stat()
+            os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns + 10 ** 9))
+            images.derivative_for(path, 'exam')
+            self.assertEqual(make.call_count, 2)
+
+    def test_summernote_upload_creates_derivatives(self):
+        from django.core.files.uploadedfile import SimpleUploadedFile
+        from django_summernote.utils import get_attachment_model
+
+        photo = self.save_photo('upload.jpg', (3000, 2000)).read_bytes()
+        with override_settings(MEDIA_ROOT=self.tmpdir / 'media'), \
+                mock.patch.object(images, 'make_derivative', wraps=images.make_derivative) as make:
+            get_attachment_model().objects.create(file=SimpleUploadedFile('upload.jpg', photo))
+        # exam + one shared width for the selected/ABNT layouts
+        self.assertEqual(make.call_count, 2)
+
+
+class PostListPaginationTests(TestCase):
+
+    def setUp(self):
+        self.area = AreaDoConhecimento.objects.create(name='Física')
+        self.posts = [
+            Post.objects.create(title=f'Questão {i}', content=f'<p>Enunciado &amp; texto {i}</p>' + 'x' * 500,
+                                area_do_conhecimento=self.area if i % 2 else None)
+            for i in range(7)
+        ]
+        # Ties on created_at are broken by id
+        Post.objects.filter(pk__in=[p.pk for p in self.posts[2:5]]).update(created_at=self.posts[2].created_at)
+
+    def test_keyset_pages_cover_every_question_once_in_order(self):
+        seen, position = [], None
+        while True:
+            page, cursor = keyset_page(Post.objects.all(), position, size=3)
+            seen.extend(page)
+            if cursor is None:
+                break
+            position = decode_cursor(cursor)
+
+        expected = list(Post.objects.order_by('-created_at', '-id'))
+        self.assertEqual(seen, expected)
+
+    def test_index_renders_first_page_with_excerpts(self):
+        with mock.patch('core.views.PostListView.page_size', 4):
+            response = self.client.get(reverse('index'))
+        self.assertEqual(len(response.context['posts']), 4)
+        self.assertIsNotNone(response.context['next_cursor'])
+        self.assertContains(response, 'Enunciado &amp; texto 6')
+        self.assertNotContains(response, '<p>Enunciado')
+        self.assertNotContains(response, 'x' * 400)
+        # The cards read the stored excerpt, never the full HTML
+        self.assertIn('content', response.context['posts'][0].get_deferred_fields())
+
+    def test_excerpt_follows_the_content(self):
+        post = self.posts[0]
+        post.content = '<p>Novo &lt;enunciado&gt;</p>'
+        post.save()
+        self.assertEqual(Post.objects.get(pk=post.pk).excerpt, 'Novo <enunciado>')
+        [created] = Post.objects.bulk_create([Post(title='Q', content='<b>Em lote</b>')])
+        self.assertEqual(Post.objects.get(pk=created.pk).excerpt, 'Em lote')
+
+    def test_page_endpoint_continues_from_cursor_with_filters(self):
+        first, cursor = keyset_page(Post.objects.filter(area_do_conhecimento=self.area), size=2)
+        response = self.client.get(reverse('post_list_page'), {'cursor': cursor, 'area': self.area.pk})
+        payload = response.json()
+
+        rest = [p for p in self.posts if p.area_do_conhecimento_id][::-1][2:]
+        for post in rest:
+            self.assertIn(f'id="card-post-{post.pk}"', payload['html'])
+        self.assertEqual(payload['html'].count('class="post-card"'), len(rest))
+        self.assertIsNone(payload['next_cursor'])
+
+        self.assertEqual(self.client.get(reverse('post_list_page'), {'cursor': 'nope'}).status_code, 400)
+
+    def test_content_endpoint_returns_full_question(self):
+        post = self.posts[0]
+        payload = self.client.get(reverse('post_content', args=[post.pk])).json()
+        self.assertEqual(payload['content'], post.content)
+        self.assertEqual(payload['title'], post.title)
+
+
+class QueryBudgetMixin:
+    """
+    Query budgets for the paths that read many questions. Each path is run
+    against a small and a larger bank: the number of queries must stay within
+    the budget and must not grow with the number of questions.
+    """
+
+    @contextmanager
+    def assertQueryBudget(self, budget):
+        with CaptureQueriesContext(connection) as queries:
+            yield queries
+        self.assertLessEqual(
+            len(queries), budget,
+            f"{len(queries)} queries, budget is {budget}:\n" + '\n'.join(q['sql'] for q in queries.captured_queries),
+        )
+
+    def create_posts(self, count):
+        """ Every question gets its own area and difficulty, so a lookup per question would show. """
+        posts = []
+        for _ in range(count):
+            index = Post.objects.count()
+            posts.append(Post.objects.create(
+                title=f'Questão {index}', content=f'<p>Enunciado {index}</p>',
+                area_do_conhecimento=AreaDoConhecimento.objects.create(name=f'Área {index}'),
+                dificuldade=Dificuldade.objects.create(name=f'Nível {index}'),
+            ))
+        return posts
+
+    def assertBudgetHoldsAsBankGrows(self, budget, run, prepare=None, sizes=(3, 12)):
+        counts = []
+        for size in sizes:
+            self.create_posts(size)
+            if prepare is not None:
+                prepare()
+            with self.assertQueryBudget(budget) as queries:
+                run()
+            counts.append(len(queries))
+        self.assertEqual(len(set(counts)), 1, f"Query count grows with the bank: {counts}")
+
+
+class QueryBudgetTests(QueryBudgetMixin, TestCase):
+
+    def test_question_list(self):
+        def list_page():
+            self.client.get(reverse('index'))
+        # posts + area/difficulty choices of the form, the filter counts come from the cache
+        self.assertBudgetHoldsAsBankGrows(3, list_page, prepare=list_page)
+
+    def test_question_list_next_page(self):
+        def next_page():
+            _, cursor = keyset_page(Post.objects.all(), size=2)
+            self.client.get(reverse('post_list_page'), {'cursor': cursor})
+        # The keyset_page above, then the page itself
+        self.assertBudgetHoldsAsBankGrows(2, next_page)
+
+    def test_refreshing_stale_fragments_is_one_update(self):
+        with mock.patch.object(utils, '_latex_cache', RenderCache()):
+            # The SELECT, then a single bulk UPDATE
+            self.assertBudgetHoldsAsBankGrows(2, lambda: refresh_rendered_posts(Post.objects.all()))
+
+    @skipUnless(HAS_WEASYPRINT, "WeasyPrint system libraries are not installed")
+    def test_exports(self):
+        from . import pdf
+
+        for kind, builder in pdf.EXPORTS.items():
+            with self.subTest(kind=kind):
+                def export():
+                    with mock.patch.object(pdf, '_page_cache', ObjectCache()):
+                        builder(Post.objects.all())
+                # Pre-rendered questions: a single SELECT, areas joined in
+                self.assertBudgetHoldsAsBankGrows(1, export, prepare=lambda: refresh_rendered_posts(Post.objects.all()))
+
+
+class FacetCountTests(QueryBudgetMixin, TestCase):
+
+    def setUp(self):
+        facets.invalidate_facets()
+        self.algebra = AreaDoConhecimento.objects.create(name='Álgebra')
+        self.optics = AreaDoConhecimento.objects.create(name='Óptica')
+        self.easy = Dificuldade.objects.create(name='Fácil')
+        self.hard = Dificuldade.objects.create(name='Difícil')
+        for area, dificuldade, count in [(self.algebra, self.easy, 3), (self.algebra, self.hard, 1),
+                                         (self.optics, self.hard, 2), (None, self.easy, 1)]:
+            for i in range(count):
+                Post.objects.create(title=f'Q{i}', content='<p>x</p>', area_do_conhecimento=area, dificuldade=dificuldade)
+
+    def counts(self, **params):
+        context = self.client.get(reverse('index'), params).context
+        return (
+            {area['name']: area['count'] for area in context['areas']},
+            {dificuldade['name']: dificuldade['count'] for dificuldade in context['dificuldades']},
+            context['area_total'], context['dificuldade_total'],
+        )
+
+    def test_each_facet_is_counted_with_the_other_applied(self):
+        self.assertEqual(self.counts(), ({'Álgebra': 4, 'Óptica': 2}, {'Difícil': 3, 'Fácil': 4}, 7, 7))
+        self.assertEqual(
+            self.counts(area=self.algebra.pk, dificuldade=self.hard.pk),
+            ({'Álgebra': 1, 'Óptica': 2}, {'Difícil': 1, 'Fácil': 3}, 3, 4),
+        )
+
+    def test_list_filters_by_area_and_difficulty(self):
+        def listed(**params):
+            return len(self.client.get(reverse('index'), params).context['posts'])
+
+        self.assertEqual(listed(dificuldade=self.easy.pk), 4)
+        self.assertEqual(listed(area=self.algebra.pk, dificuldade=self.easy.pk), 3)
+        self.assertEqual(listed(area=self.optics.pk, dificuldade=self.easy.pk), 0)
+        # Malformed ids are ignored rather than failing the page
+        self.assertEqual(listed(area='abc', dificuldade=''), 7)
+
+    def test_counts_are_one_cached_query_dropped_on_changes(self):
+        # Miss: the grouped counts + the names of both facets
+        with self.assertQueryBudget(3):
+            facets.facet_counts()
+        with self.assertQueryBudget(0):
+            facets.facet_counts(self.algebra.pk, self.easy.pk)
+
+        Post.objects.create(title='Nova', content='<p>x</p>', area_do_conhecimento=self.optics, dificuldade=self.easy)
+        self.assertEqual(self.counts(dificuldade=self.easy.pk)[0], {'Álgebra': 3, 'Óptica': 1})
+        self.optics.delete()
+        self.assertEqual(self.counts()[0], {'Álgebra': 4})
+
+    def test_filtered_list_uses_the_composite_indexes(self):
+        if connection.vendor != 'sqlite':
+            self.skipTest('EXPLAIN QUERY PLAN is SQLite only')
+        for params, index in [({'area_do_conhecimento': self.algebra}, 'post_area_created_idx'),
+                              ({'dificuldade': self.easy}, 'post_difficulty_created_idx')]:
+            plan = Post.objects.filter(**params).order_by('-created_at', '-id')[:20].explain()
+            self.assertIn(index, plan)
+            self.assertNotIn('TEMP B-TREE', plan)
+
+
+@override_settings(LATEX_RENDER_WORKERS=1)
+class PipelineBenchmarkTests(TestCase):
+
+    def setUp(self):
+        # The command keeps its process out of METRICS_DIR for good
+        patcher = mock.patch.object(metrics, '_local_only', False)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_synthetic_bank_is_reproducible(self):
+        def corpus(seed):
+            with transaction.atomic():
+                contents = [post.content for post in benchmarks.build_corpus(posts=5, formulas=3, images=1.0, seed=seed)]
+                transaction.set_rollback(True)
+            return contents
+
+        first = corpus(seed=7)
+        self.assertEqual(corpus(seed=7), first)
+        self.assertNotEqual(corpus(seed=8), first)
+        self.assertTrue(all(len(utils.extract_formulas(content)) == 3 for content in first))
+        if benchmarks.media_images():
+            self.assertTrue(all('<img src="/media/' in content for content in first))
+
+    def test_pipeline_reports_percentiles_and_leaves_no_rows(self):
+        output = Path(tempfile.mkdtemp()) / 'results.json'
+        self.addCleanup(shutil.rmtree, output.parent)
+        with mock.patch.object(utils, '_latex_cache', RenderCache()) as latex_cache:
+            call_command('benchmark', 'pipeline', posts=3, formulas=2, repeat=2, output=str(output), stdout=io.StringIO())
+
+        results = json.loads(output.read_text())
+        self.assertEqual(results['corpus']['posts'], 3)
+        self.assertEqual(results['latex_to_base64']['cold']['runs'], 6)
+        self.assertEqual(results['process_content_for_pdf']['warm']['runs'], 3)
+        self.assertEqual(results['list_view']['search']['runs'], 2)
+        for summary in (results['latex_to_base64']['cold'], results['list_view']['first_page']):
+            self.assertLessEqual(summary['min_ms'], summary['p50_ms'])
+            self.assertLessEqual(summary['p50_ms'], summary['p99_ms'])
+            self.assertLessEqual(summary['p99_ms'], summary['max_ms'])
+        if HAS_WEASYPRINT:
+            self.assertEqual(set(results['exports']), {'selected', 'exam', 'abnt'})
+        else:
+            self.assertIn('skipped', results['exports'])
+
+        # The bank is rolled back and the real LaTeX cache is untouched
+        self.assertFalse(Post.objects.exists())
+        self.assertFalse(AreaDoConhecimento.objects.exists())
+        self.assertEqual(latex_cache.stats()['memory_entries'], 0)
+
+    def test_corpus_options_are_pipeline_only(self):
+        with self.assertRaises(CommandError):
+            call_command('benchmark', 'rasterizers', posts=3, stdout=io.StringIO())
+
+
+class ImportQuestionsTests(TestCase):
+
+    def setUp(self):
+        self.tmpdir = Path(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        settings_patch = override_settings(MEDIA_ROOT=self.tmpdir / 'media')
+        settings_patch.enable()
+        self.addCleanup(settings_patch.disable)
+        # Uploads get derivatives: keep them out of PDF_IMAGE_DERIVATIVES_DIR
+        patcher = mock.patch.object(images, '_derivative_cache', RenderCache())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.physics = AreaDoConhecimento.objects.create(name='Física')
+
+    def run_import(self, name, text, **options):
+        path = self.tmpdir / name
+        path.write_text(text, encoding='utf-8')
+        out, err = io.StringIO(), io.StringIO()
+        call_command('import_questions', str(path), stdout=out, stderr=err, **options)
+        return out.getvalue(), err.getvalue()
+
+    def test_json_lines_in_batches_with_name_lookup(self):
+        records = [
+            {'title': f'Questão {i}', 'content': f'<p>Enunciado {i}</p>', 'area': area, 'dificuldade': level}
+            for i, (area, level) in enumerate([
+                ('física', 'Fácil'), (' Química ', 'fácil'), ('QUÍMICA', None), (None, 'Difícil'), ('Física', 'Fácil'),
+            ])
+        ]
+        lines = [json.dumps(record) for record in records]
+        lines[2:2] = ['{not json', '', json.dumps({'title': '', 'content': '<p>x</p>'})]
+
+        with CaptureQueriesContext(connection) as queries:
+            out, err = self.run_import('bank.jsonl', '\n'.join(lines), batch_size=2)
+        inserts = [q['sql'] for q in queries.captured_queries if q['sql'].startswith('INSERT INTO "core_post"')]
+        self.assertEqual(len(inserts), 3)
+
+        self.assertIn('Imported 5 question(s)', out)
+        self.assertIn('2 skipped. Created 1 area(s) and 2 difficulty level(s).', out)
+        self.assertIn('Line 3 skipped: invalid JSON', err)
+        self.assertIn('Line 5 skipped: missing title', err)
+
+        self.assertEqual(Post.objects.filter(area_do_conhecimento=self.physics).count(), 2)
+        self.assertEqual(Post.objects.filter(area_do_conhecimento__name='Química').count(), 2)
+        self.assertEqual(Post.objects.filter(dificuldade__name='Fácil').count(), 3)
+        # No post_save for bulk_create: indexed and counted by the importer itself
+        response = self.client.get(reverse('index'), {'search': 'enunciado'})
+        self.assertEqual(len(response.context['posts']), 5)
+        self.assertEqual(response.context['area_total'], 5)
+
+    def test_mistyped_fields_skip_only_their_record(self):
+        from django_summernote.utils import get_attachment_model
+
+        Image.new('RGB', (4, 4), 'red').save(self.tmpdir / 'fig.png')
+        lines = [json.dumps(record) for record in (
+            {'title': 5, 'content': '<p>a</p>'},
+            {'title': 'Lista', 'content': ['a']},
+            {'title': 'Área', 'content': '<p>a</p>', 'area': 3},
+            {'title': 'Imagens', 'content': '<p>a</p>', 'images': [1]},
+            {'title': 'Data', 'content': '<p>a</p>', 'created_at': '2026-02-30T10:00', 'images': ['fig.png']},
+            {'title': 'Válida', 'content': '<p>a</p>', 'area': 'Física'},
+        )]
+        out, err = self.run_import('bank.jsonl', '\n'.join(lines))
+
+        self.assertIn('Imported 1 question(s)', out)
+        self.assertIn('Line 1 skipped: title must be text, not int', err)
+        self.assertIn('Line 2 skipped: content must be text, not list', err)
+        self.assertIn('Line 3 skipped: area must be text, not int', err)
+        self.assertIn('Line 4 skipped: images must be a list of file names', err)
+        self.assertIn('Line 5 skipped: invalid created_at', err)
+        self.assertEqual(list(Post.objects.values_list('title', flat=True)), ['Válida'])
+        self.assertEqual(AreaDoConhecimento.objects.count(), 1)
+        # The bad date is found before the image is uploaded
+        self.assertFalse(get_attachment_model().objects.exists())
+
+    @override_settings(LATEX_RENDER_WORKERS=1)
+    def test_csv_with_images_and_prerendered_formulas(self):
+        Image.new('RGB', (4, 4), 'red').save(self.tmpdir / 'fig.png')
+        Image.new('RGB', (4, 4), 'blue').save(self.tmpdir / 'extra.png')
+        text = (
+            'title,content,area,dificuldade,images\n'
+            '"Gráfico","<p>Veja ##x^2##</p><img src=""fig.png"">",Física,,fig.png;extra.png\n'
+            '"Sem imagem","<p>\\[\\frac{1}{2}\\]</p>",,,missing.png\n'
+        )
+        with mock.patch.object(utils, '_latex_cache', RenderCache()):
+            out, err = self.run_import('bank.csv', text, prerender=True)
+            post = Post.objects.get()
+            self.assertFalse(post.rendered_is_stale())
+        self.assertIn('Line 3 skipped: image not found', err)
+
+        urls = re.findall(r'src="([^"]+)"', post.content)
+        self.assertEqual(len(urls), 2)
+        self.assertTrue(all(url.startswith('/media/django-summernote/') for url in urls))
+        self.assertIn('latex://', post.rendered_content)
+
+
+class NonSeekableFile(io.RawIOBase):
+    """ Write-only stream, like a socket or a pipe. """
+
+    def __init__(self):
+        self.data = io.BytesIO()
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        return self.data.write(data)
+
+
+class BankArchiveTests(TestCase):
+
+    def setUp(self):
+        self.tmpdir = Path(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        settings_patch = override_settings(MEDIA_ROOT=self.tmpdir / 'source')
+        settings_patch.enable()
+        self.addCleanup(settings_patch.disable)
+        # Uploads get derivatives: keep them out of PDF_IMAGE_DERIVATIVES_DIR
+        patcher = mock.patch.object(images, '_derivative_cache', RenderCache())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def create_bank(self):
+        image = self.tmpdir / 'source' / 'django-summernote' / '2025-11-13' / 'fig.png'
+        image.parent.mkdir(parents=True)
+        Image.new('RGB', (4, 4), 'red').save(image)
+        area = AreaDoConhecimento.objects.create(name='Física', color='#123456')
+        for title, src in [('Com figura', 'fig.png'), ('Mesma figura', 'fig.png'), ('Figura perdida', 'gone.png')]:
+            Post.objects.create(
+                title=title, area_do_conhecimento=area,
+                content=f'<p>##x^2##</p><img src="/media/django-summernote/2025-11-13/{src}">',
+            )
+        Post.objects.filter(title='Com figura').update(created_at=timezone.now() - timezone.timedelta(days=30))
+
+    def test_round_trip_with_deduplicated_media(self):
+        self.create_bank()
+        expected = list(Post.objects.order_by('created_at', 'id').values_list('title', 'created_at'))
+        path = self.tmpdir / 'bank.zip'
+        out, err = io.StringIO(), io.StringIO()
+        call_command('export_bank', str(path), chunk_size=2, stdout=out, stderr=err)
+        self.assertIn('Exported 3 question(s) and 1 media file(s)', out.getvalue())
+        self.assertIn('gone.png', err.getvalue())
+        with zipfile.ZipFile(path) as zf:
+            self.assertEqual(sorted(zf.namelist()), [
+                'manifest.json', 'media/django-summernote/2025-11-13/fig.png', 'questions.jsonl',
+            ])
+
+        Post.objects.all().delete()
+        AreaDoConhecimento.objects.all().delete()
+        with override_settings(MEDIA_ROOT=self.tmpdir / 'restored', MEDIA_URL='/files/'):
+            out = io.StringIO()
+            call_command('import_bank', str(path), stdout=out, stderr=io.StringIO())
+            self.assertIn('Imported 3 of 3 question(s)', out.getvalue())
+            self.assertTrue((self.tmpdir / 'restored' / 'django-summernote' / '2025-11-13' / 'fig.png').is_file())
+
+        self.assertEqual(list(Post.objects.order_by('created_at', 'id').values_list('title', 'created_at')), expected)
+        post = Post.objects.get(title='Com figura')
+        self.assertIn('src="/files/django-summernote/2025-11-13/fig.png"', post.content)
+        self.assertEqual(post.area_do_conhecimento.color, '#123456')
+
+    def test_importing_an_archive_twice_keeps_one_copy(self):
+        self.create_bank()
+        path = self.tmpdir / 'bank.zip'
+        archive.export_archive(path)
+        Post.objects.filter(title='Mesma figura').delete()
+
+        out = io.StringIO()
+        call_command('import_bank', str(path), stdout=out, stderr=io.StringIO())
+        self.assertIn('Imported 1 of 3 question(s)', out.getvalue())
+        self.assertIn('2 question(s) were already in the bank', out.getvalue())
+
+        _, importer, written = archive.import_archive(path, batch_size=2)
+        self.assertEqual((importer.imported, importer.existing, written), (0, 3, 0))
+        self.assertEqual(sorted(Post.objects.values_list('title', flat=True)),
+                         ['Com figura', 'Figura perdida', 'Mesma figura'])
+
+    def test_export_to_a_non_seekable_stream(self):
+        self.create_bank()
+        stream = NonSeekableFile()
+        archive.export_archive(stream)
+        with zipfile.ZipFile(io.BytesIO(stream.data.getvalue())) as zf:
+            self.assertEqual(len(zf.read('questions.jsonl').splitlines()), 3)
+
+    def test_member_names_cannot_escape_media_root(self):
+        path = self.tmpdir / 'evil.zip'
+        with zipfile.ZipFile(path, 'w') as zf:
+            zf.writestr('manifest.json', json.dumps({'version': archive.ARCHIVE_VERSION}))
+            zf.writestr('media/../../evil.txt', 'x')
+            zf.writestr('questions.jsonl', '')
+        with self.assertRaisesMessage(CommandError, 'unsafe file name'):
+            call_command('import_bank', str(path), stdout=io.StringIO())
+        self.assertFalse((self.tmpdir / 'evil.txt').exists())
+
+    def test_memory_does_not_grow_with_the_bank(self):
+        content = '<p>' + 'Enunciado longo. ' * 120 + '</p>'
+
+        def peaks(count):
+            Post.objects.all().delete()
+            Post.objects.bulk_create(Post(title=f'Q{i}', content=content) for i in range(count))
+            path = self.tmpdir / f'bank-{count}.zip'
+            tracemalloc.start()
+            try:
+                archive.export_archive(path, chunk_size=100)
+                export_peak = tracemalloc.get_traced_memory()[1]
+                Post.objects.all().delete()
+                tracemalloc.reset_peak()
+                archive.import_archive(path, batch_size=100)
+                import_peak = tracemalloc.get_traced_memory()[1]
+            finally:
+                tracemalloc.stop()
+            self.assertEqual(Post.objects.count(), count)
+            return export_peak, import_peak
+
+        small, large = peaks(100), peaks(1000)
+        for small_peak, large_peak in zip(small, large):
+            self.assertLess(large_peak, small_peak * 2)
+
+
+class FullTextSearchTests(TestCase):
+
+    def setUp(self):
+        self.area = AreaDoConhecimento.objects.create(name='Física')
+        self.in_title = Post.objects.create(title='Velocidade média', content='<p>Um carro percorre 100 km.</p>',
+                                            area_do_conhecimento=self.area)
+        self.in_body = Post.objects.create(title='Cinemática', content='<p>Calcule a <b>velocidade</b> final.</p>')
+        self.latex = Post.objects.create(title='Frações', content='<p>Simplifique ##\\frac{a}{b}##.</p>')
+
+    def search(self, text, **params):
+        response = self.client.get(reverse('index'), {'search': text, **params})
+        return [post.pk for post in response.context['posts']]
+
+    def test_title_matches_rank_first_and_body_is_searched(self):
+        self.assertEqual(self.search('velocidade'), [self.in_title.pk, self.in_body.pk])
+
+    def test_accents_prefixes_and_latex_source(self):
+        self.assertEqual(self.search('cinematica'), [self.in_body.pk])
+        self.assertEqual(self.search('veloc'), [self.in_title.pk, self.in_body.pk])
+        self.assertEqual(self.search('frac'), [self.latex.pk])
+        # Tags are not indexed
+        self.assertEqual(self.search('b'), [self.latex.pk])
+
+    def test_area_filter_applies_to_search_results(self):
+        self.assertEqual(self.search('velocidade', area=self.area.pk), [self.in_title.pk])
+
+    def test_query_without_words_matches_nothing(self):
+        cursor = encode_cursor(self.in_body)
+        for text in ('"', '*', '?', '+'):
+            self.assertEqual(self.search(text), [])
+            response = self.client.get(reverse('post_list_page'), {'search': text, 'cursor': cursor})
+            self.assertEqual(response.status_code, 200)
+            self.assertIsNone(response.json()['next_cursor'])
+
+    def test_cursor_of_another_ordering_is_rejected(self):
+        with mock.patch('core.views.PostListView.page_size', 1):
+            ranked_cursor = self.client.get(reverse('index'), {'search': 'velocidade'}).context['next_cursor']
+            response = self.client.get(reverse('post_list_page'), {'search': 'velocidade', 'cursor': ranked_cursor})
+        self.assertIn(f'id="card-post-{self.in_body.pk}"', response.json()['html'])
+
+        date_cursor = encode_cursor(self.in_title)
+        for params in ({'search': 'velocidade', 'cursor': date_cursor}, {'cursor': ranked_cursor}):
+            response = self.client.get(reverse('post_list_page'), params)
+            self.assertEqual(response.status_code, 400)
+
+    def test_index_follows_edits_and_deletes(self):
+        self.in_body.content = '<p>Calcule a aceleração.</p>'
+        self.in_body.save()
+        self.in_title.delete()
+        self.assertEqual(self.search('velocidade'), [])
+        self.assertEqual(self.search('aceleracao'), [self.in_body.pk])
+
+    def test_rebuild_command_restores_the_index(self):
+        with connection.cursor() as cursor:
+            cursor.execute(f'DELETE FROM {search.FTS_TABLE}')
+        self.assertEqual(self.search('velocidade'), [])
+
+        call_command('rebuild_search_index', stdout=io.StringIO())
+        self.assertEqual(self.search('velocidade'), [self.in_title.pk, self.in_body.pk])
+
+    def test_search_results_are_paginated_by_rank(self):
+        for i in range(5):
+            Post.objects.create(title=f'Questão {i}', content='<p>velocidade ' * (i + 1) + '</p>')
+        expected = self.search('velocidade')
+
+        with mock.patch('core.views.PostListView.page_size', 3):
+            response = self.client.get(reverse('index'), {'search': 'velocidade'})
+            seen = [post.pk for post in response.context['posts']]
+            cursor = response.context['next_cursor']
+            while cursor:
+                payload = self.client.get(reverse('post_list_page'), {'search': 'velocidade', 'cursor': cursor}).json()
+                seen.extend(int(pk) for pk in re.findall(r'id="card-post-(\d+)"', payload['html']))
+                cursor = payload['next_cursor']
+        self.assertEqual(seen, expected)
+        self.assertEqual(len(seen), 7)
+
+
+@override_settings(LATEX_RENDER_WORKERS=1)
+class WarmLatexCacheTests(TestCase):
+
+    def setUp(self):
+        self.old = Post.objects.create(title='Antiga', content=r'<p>##x## e \[y\]</p>')
+        Post.objects.create(title='Nova', content=r'<p>##x## e ##z## ##\frac{##</p>')
+        Post.objects.filter(pk=self.old.pk).update(updated_at=timezone.now() - timezone.timedelta(days=30))
+        # Saving the questions rendered their formulas: start from an empty cache
+        patchers = [
+            mock.patch.object(utils, '_latex_cache', RenderCache()),
+            mock.patch.object(metrics, '_local_only', False),
+        ]
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def warm(self, **options):
+        out = io.StringIO()
+        call_command('warm_latex_cache', stdout=out, stderr=io.StringIO(), **options)
+        return out.getvalue()
+
+    def test_renders_each_unique_formula_once(self):
+        with mock.patch.object(utils, 'render_latex_png', wraps=utils.render_latex_png) as render:
+            out = self.warm(chunk_size=2)
+            self.assertIn('2/4 formula(s) rendered', out)
+            self.assertIn('4 unique formula(s): 0 already cached, 3 rendered, 1 failed', out)
+            self.assertEqual(render.call_count, 4)
+
+            # The exports then only hit the cache
+            utils.process_content_for_pdf(self.old.content)
+            self.assertEqual(render.call_count, 4)
+
+            out = self.warm()
+            self.assertIn('4 unique formula(s): 3 already cached, 0 rendered, 1 failed', out)
+
+    def test_renders_are_kept_out_of_the_metrics_dir(self):
+        metrics_dir = Path(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, metrics_dir)
+        with override_settings(METRICS_DIR=metrics_dir), mock.patch.object(metrics, '_registry', None):
+            self.warm()
+            metrics.flush()
+        self.assertEqual(list(metrics_dir.iterdir()), [])
+
+    def test_since_only_scans_recent_questions(self):
+        since = (timezone.now() - timezone.timedelta(days=1)).date().isoformat()
+        self.assertIn('3 unique formula(s): 0 already cached, 2 rendered', self.warm(since=since))
+        self.assertFalse(utils.get_latex_cache().contains(utils.latex_cache_key('y', 'block')))
+
+        with self.assertRaises(CommandError):
+            self.warm(since='last week')
+
+
+class LazyRendererTests(SimpleTestCase):
+
+    def test_startup_does_not_import_the_renderers(self):
+        report = benchmarks.measure_startup()
+        self.assertEqual(report['heavy_modules'], [])
+
+    def test_warm_up_loads_them_ahead_of_the_first_export(self):
+        report = benchmarks.measure_startup(warm_up=True)
+        expected = ['matplotlib', 'numpy'] + (['weasyprint'] if HAS_WEASYPRINT else [])
+        self.assertEqual(report['heavy_modules'], expected)
+        self.assertGreater(report['warm_up_s'], 0)
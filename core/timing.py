@@ -0,0 +1,128 @@
+"""
+Stage timings of the PDF exports.
+
+An export runs inside `export_timing(kind)` and the builders mark their
+stages (database, PDF cache, formulas, HTML, layout, write_pdf) with
+`stage(name)`. Outside of an export stage() only checks a context variable,
+so the builders pay nothing when they run from a job or a benchmark.
+
+When the export ends, the timings are logged as one line of the
+`core.exports` logger (key=value, with the same values as a dict in the
+record's `export_timing` attribute) and `server_timing()` formats them for
+the Server-Timing response header.
+
+With PDF_EXPORT_PROFILE_DIR set, an export requested with ?profile=1 is also
+run under cProfile and its stats are dumped there (read them with pstats).
+"""
+import cProfile
+import contextvars
+import logging
+import os
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+from django.conf import settings
+
+from . import metrics
+
+logger = logging.getLogger('core.exports')
+
+_current_timer = contextvars.ContextVar('export_timer', default=None)
+
+
+class ExportTimer:
+    """ Time spent per stage of one export; a stage entered several times adds up. """
+
+    def __init__(self, kind):
+        self.kind = kind
+        self.stages = {}
+        self.descriptions = {}
+        self.total = None
+        self.profile_path = None
+
+    def add(self, name, seconds):
+        self.stages[name] = self.stages.get(name, 0.0) + seconds
+
+    def as_dict(self):
+        data = {'kind': self.kind}
+        data.update({f'{name}_ms': round(seconds * 1000, 1) for name, seconds in self.stages.items()})
+        data.update(self.descriptions)
+        data['total_ms'] = round((self.total or 0.0) * 1000, 1)
+        if self.profile_path:
+            data['profile'] = str(self.profile_path)
+        return data
+
+    def server_timing(self):
+        metrics = []
+        for name, seconds in list(self.stages.items()) + [('total', self.total or 0.0)]:
+            description = self.descriptions.get(name)
+            desc = f';desc="{description}"' if description else ''
+            metrics.append(f'{name}{desc};dur={seconds * 1000:.1f}')
+        return ', '.join(metrics)
+
+
+@contextmanager
+def stage(name):
+    """ Adds the time spent in the block to `name` in the current export, if any. """
+    timer = _current_timer.get()
+    if timer is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timer.add(name, time.perf_counter() - start)
+
+
+def describe(name, description):
+    """ Short note on a stage of the current export (e.g. a cache hit or miss). """
+    timer = _current_timer.get()
+    if timer is not None:
+        timer.descriptions[name] = description
+
+
+def profile_path_for(request, kind):
+    """ Where to dump the profile of this request, or None (not asked for, or disabled). """
+    directory = getattr(settings, 'PDF_EXPORT_PROFILE_DIR', None)
+    if not directory or request.GET.get('profile') != '1':
+        return None
+    return Path(directory) / f'{kind}-{time.strftime("%Y%m%d-%H%M%S")}-{os.getpid()}-{time.monotonic_ns()}.pstats'
+
+
+@contextmanager
+def export_timing(kind, profile_path=None, endpoint=None):
+    """
+    Times the stages of one export, and profiles it when `profile_path` is given.
+    With an `endpoint`, its latency (or failure) is also counted in the metrics.
+    """
+    timer = ExportTimer(kind)
+    token = _current_timer.set(timer)
+    profiler = cProfile.Profile() if profile_path else None
+    start = time.perf_counter()
+    if profiler is not None:
+        profiler.enable()
+    try:
+        yield timer
+    except Exception:
+        if endpoint:
+            metrics.inc('qrepo_export_errors_total', endpoint=endpoint, kind=kind)
+        raise
+    finally:
+        if profiler is not None:
+            profiler.disable()
+        timer.total = time.perf_counter() - start
+        _current_timer.reset(token)
+        if endpoint:
+            metrics.observe('qrepo_export_seconds', timer.total, endpoint=endpoint, kind=kind)
+        if profiler is not None:
+            profile_path.parent.mkdir(parents=True, exist_ok=True)
+            profiler.dump_stats(profile_path)
+            timer.profile_path = profile_path
+
+        data = timer.as_dict()
+        logger.info(
+            'pdf_export ' + ' '.join(f'{name}={value}' for name, value in data.items()),
+            extra={'export_timing': data},
+        )
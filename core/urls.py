@@ -5,6 +5,11 @@ from . import views
 urlpatterns = [
     path('', views.PostListView.as_view(), name='index'),
     path('create/', views.PostCreateView.as_view(), name='create_post'),
+    path('posts/page/', views.post_list_page, name='post_list_page'),
+    path('posts/<int:pk>/content/', views.post_content, name='post_content'),
     path('export/', views.export_selected_pdf, name='export_selected_pdf'),
     path('generate-exam/', views.generate_exam_pdf, name='generate_exam_pdf'),
+    path('export/jobs/<int:pk>/', views.export_job_status, name='export_job_status'),
+    path('export/jobs/<int:pk>/download/', views.export_job_download, name='export_job_download'),
+    path('metrics/', views.metrics, name='metrics'),
 ]
\ No newline at end of file
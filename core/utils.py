@@ -1,88 +1,567 @@
+import os
 import re
 import io
 import base64
+import contextvars
 import html 
-import matplotlib.pyplot as plt
+import functools
+import logging
+import threading
+import time
+from urllib.parse import parse_qs, urlencode
+from PIL import Image
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from django.conf import settings
 
-# 1. Set backend to non-interactive
-plt.switch_backend('Agg')
+# matplotlib and NumPy are only imported by the first formula render (see core.renderers)
+from . import metrics, renderers
+from .cache import RenderCache, make_cache_key
 
-def fix_image_paths(html_content):
-    """ Converts /media/ URLs to file:// paths for WeasyPrint. """
-    if not html_content: return ""
-    
-    media_url = settings.MEDIA_URL
-    media_root = settings.MEDIA_ROOT
-    media_root_str = str(media_root).replace('\\', '/')
+logger = logging.getLogger('core.utils')
+
+# Bump whenever the HTML produced by process_content_for_pdf changes, so the
+# fragments pre-rendered on Post are rebuilt on their next export.
+RENDERER_VERSION = 4
+
+# Render parameters per style: (font size, DPI, css class)
+LATEX_STYLES = {
+    # Reduced font to 13 (closer to document text)
+    # Reduced DPI to 110 (prevents image from being physically huge)
+    'block': (13, 110, 'latex-block'),
+    # Inline relies on CSS height, so high quality is fine here
+    'inline': (16, 150, 'latex-inline'),
+}
+LATEX_FONTSET = 'dejavuserif'
+# Transparent margin around each formula image
+LATEX_PAD_INCHES = 0.02
+
+_latex_cache = None
+
+def get_latex_cache():
+    """ Process-wide render cache for formula images (memory LRU + disk). """
+    global _latex_cache
+    if _latex_cache is None:
+        _latex_cache = RenderCache(
+            directory=getattr(settings, 'LATEX_CACHE_DIR', None),
+            memory_bytes=getattr(settings, 'LATEX_CACHE_MEMORY_BYTES', 32 * 1024 * 1024),
+            disk_bytes=getattr(settings, 'LATEX_CACHE_DISK_BYTES', 512 * 1024 * 1024),
+        )
+    return _latex_cache
+
+def latex_cache_stats():
+    return get_latex_cache().stats()
+
+metrics.register_cache('latex', get_latex_cache)
+
+# Output formats for formula images: raster PNG or vector SVG (glyphs as paths)
+LATEX_FORMATS = {
+    'png': 'image/png',
+    'svg': 'image/svg+xml',
+}
+
+def get_latex_format():
+    fmt = getattr(settings, 'LATEX_OUTPUT_FORMAT', 'png')
+    return fmt if fmt in LATEX_FORMATS else 'png'
+
+def latex_mime_type(img_bytes):
+    return 'image/png' if img_bytes.startswith(b'\x89PNG') else 'image/svg+xml'
+
+# PDF exports reference formula images by cache key (served by core.pdf.PdfUrlFetcher).
+# The URL fragment carries the formula, so an image evicted from the cache
+# can be rendered again: latex://<key>#style=...&fmt=...&tex=...
+LATEX_URL_SCHEME = 'latex://'
+LATEX_REF_RE = re.compile(r'src="latex://([0-9a-f]{64})[#"]')
+
+def content_hash(html_content):
+    """ Hash of a question's content as seen by process_content_for_pdf. """
+    return make_cache_key(html_content or '', get_latex_format())
+
+def fragment_is_resolvable(html_content):
+    """ True if every latex:// image referenced by a rendered fragment is still cached. """
+    cache = get_latex_cache()
+    return all(cache.contains(key) for key in LATEX_REF_RE.findall(html_content or ''))
+
+def clean_latex(latex_content):
+    clean_content = html.unescape(latex_content) 
+    return clean_content.replace('\xa0', ' ')
+
+def latex_cache_key(clean_content, style, fmt='png'):
+    font_size, dpi_val, _ = LATEX_STYLES[style]
+    return make_cache_key(clean_content, style, font_size, dpi_val, LATEX_FONTSET, fmt, RENDERER_VERSION)
+
+_mathtext_parser = None
+
+def _get_mathtext_parser():
+    global _mathtext_parser
+    if _mathtext_parser is None:
+        _mathtext_parser = renderers.mathtext().MathTextParser('agg')
+    return _mathtext_parser
+
+@functools.lru_cache(maxsize=None)
+def _line_box(font_size, dpi_val):
+    """ Ascent and descent (px) of a line of text, as matplotlib's Text measures it ("lp"). """
+    mpl = renderers.mathtext()
+    prop = mpl.FontProperties(family='serif', size=font_size)
+    _, height, descent = mpl.RendererAgg(1, 1, dpi_val).get_text_width_height_descent('lp', prop, ismath=False)
+    return height - descent, descent
+
+def render_latex_png(clean_content, font_size, dpi_val):
+    """
+    Rasterizes an already cleaned formula to PNG bytes.
+
+    The mathtext parser lays the glyphs out straight into an alpha mask (no
+    pyplot figure, no second draw for bbox_inches='tight'). Transparent
+    margins are cropped with a NumPy bounding box, but like a matplotlib Text
+    the image is never shorter than a line of text, so the fixed-height
+    latex-inline CSS keeps the same proportions as before.
+    """
+    mpl = renderers.mathtext()
+    np = mpl.np
+    prop = mpl.FontProperties(family='serif', size=font_size, math_fontfamily=LATEX_FONTSET)
+    parsed = _get_mathtext_parser().parse(f"${clean_content}$", dpi=dpi_val, prop=prop)
+    alpha = np.asarray(parsed.image)
+
+    # 1. Ink bounding box
+    rows = np.flatnonzero(alpha.any(axis=1))
+    cols = np.flatnonzero(alpha.any(axis=0))
+    left, right = (cols[0], cols[-1] + 1) if len(cols) else (0, alpha.shape[1])
+
+    # 2. Extend it vertically to the line box around the baseline
+    baseline = alpha.shape[0] - parsed.depth
+    ascent, descent = _line_box(font_size, dpi_val)
+    top = int(np.floor(baseline - ascent))
+    bottom = int(np.ceil(baseline + descent))
+    if len(rows):
+        top, bottom = min(top, rows[0]), max(bottom, rows[-1] + 1)
+
+    # 3. Black glyphs on a transparent, padded canvas
+    pad = round(LATEX_PAD_INCHES * dpi_val)
+    rgba = np.zeros((bottom - top + 2 * pad, right - left + 2 * pad, 4), dtype=np.uint8)
+    src_top, src_bottom = max(top, 0), min(bottom, alpha.shape[0])
+    rgba[pad + src_top - top:pad + src_bottom - top, pad:pad + right - left, 3] = alpha[src_top:src_bottom, left:right]
+
+    buf = io.BytesIO()
+    Image.fromarray(rgba).save(buf, format='png')
+    return buf.getvalue()
+
+def render_latex_png_pyplot(clean_content, font_size, dpi_val):
+    """ Reference rasterizer through a pyplot figure (slower; kept for comparisons). """
+    plt = renderers.mathtext().plt
+    fig = plt.figure(figsize=(0.1, 0.1))
+    plt.rcParams['font.family'] = 'serif'
+    plt.rcParams['mathtext.fontset'] = LATEX_FONTSET
+
+    fig.text(0.5, 0.5, f"${clean_content}$", fontsize=font_size, ha='center', va='center')
     
-    if media_url in html_content:
-        base_replacement = f'file://{media_root_str}/'
-        if base_replacement.endswith('//'): base_replacement = base_replacement[:-1]
-        
-        html_content = html_content.replace(f'src="{media_url}', f'src="{base_replacement}')
-        html_content = html_content.replace(f"src='{media_url}", f"src='{base_replacement}")
+    buf = io.BytesIO()
+    # Keep pad_inches small to avoid extra whitespace
+    try:
+        fig.savefig(buf, format='png', bbox_inches='tight', pad_inches=LATEX_PAD_INCHES, transparent=True, dpi=dpi_val)
+    finally:
+        plt.close(fig)
+    return buf.getvalue()
+
+def render_latex_svg(clean_content, font_size, dpi_val):
+    """
+    Renders an already cleaned formula to SVG bytes, with glyphs as paths.
+
+    The PNG is shown at 96 px per inch, so it takes dpi/96 times its point
+    size on the page. The SVG is sized in points, so font and padding are
+    scaled by the same factor to keep the latex-inline / latex-block CSS
+    producing the same layout.
+    """
+    scale = dpi_val / 96
+    plt = renderers.mathtext().plt
+    fig = plt.figure(figsize=(0.1, 0.1))
+    plt.rcParams['font.family'] = 'serif'
+    plt.rcParams['mathtext.fontset'] = LATEX_FONTSET
+
+    fig.text(0.5, 0.5, f"${clean_content}$", fontsize=font_size * scale, ha='center', va='center')
 
-    return html_content
+    buf = io.BytesIO()
+    try:
+        # Fixed salt and no date keep the output byte-identical between runs
+        with plt.rc_context({'svg.fonttype': 'path', 'svg.hashsalt': 'latex'}):
+            fig.savefig(buf, format='svg', bbox_inches='tight', pad_inches=LATEX_PAD_INCHES * scale,
+                        transparent=True, metadata={'Date': None})
+    finally:
+        plt.close(fig)
+    return buf.getvalue()
 
-def latex_to_base64(latex_content, style='inline'):
+def render_latex_image(clean_content, font_size, dpi_val, fmt='png'):
+    if fmt == 'svg':
+        return render_latex_svg(clean_content, font_size, dpi_val)
+    return render_latex_png(clean_content, font_size, dpi_val)
+
+def latex_to_base64(latex_content, style='inline', fmt=None, embed=True):
     """
-    Renders LaTeX to a base64 image.
+    Renders LaTeX to a base64 image (PNG, or SVG with LATEX_OUTPUT_FORMAT='svg').
+    Results are cached by (cleaned formula, style, font size, DPI, fontset, format).
+    With embed=False the img points to latex://<cache key> instead of a data: URI.
     """
     try:
         # 2. CONFIGURATION
-        if style == 'block':
-            # --- FIX IS HERE ---
-            # Reduced font to 13 (closer to document text)
-            # Reduced DPI to 110 (prevents image from being physically huge)
-            font_size = 13  
-            dpi_val = 110   
-            css_class = "latex-block"
-        else:
-            # Inline relies on CSS height, so high quality is fine here
-            font_size = 16  
-            dpi_val = 150
-            css_class = "latex-inline"
+        style = 'block' if style == 'block' else 'inline'
+        font_size, dpi_val, css_class = LATEX_STYLES[style]
+        fmt = fmt or get_latex_format()
 
         # 3. CLEANING
-        clean_content = html.unescape(latex_content) 
-        clean_content = clean_content.replace('\xa0', ' ')
+        clean_content = clean_latex(latex_content)
 
-        # 4. SETUP MATPLOTLIB
-        fig = plt.figure(figsize=(0.1, 0.1))
-        plt.rcParams['font.family'] = 'serif'
-        plt.rcParams['mathtext.fontset'] = 'dejavuserif'
+        # 4. CACHE LOOKUP
+        cache = get_latex_cache()
+        key = latex_cache_key(clean_content, style, fmt)
+        img_bytes = cache.get(key)
 
-        # 5. RENDER
-        fig.text(0.5, 0.5, f"${clean_content}$", fontsize=font_size, ha='center', va='center')
+        # 5. RENDER (only on a miss)
+        if img_bytes is None:
+            start = time.perf_counter()
+            img_bytes = render_latex_image(clean_content, font_size, dpi_val, fmt)
+            record_formula_render(fmt, time.perf_counter() - start)
+            cache.set(key, img_bytes)
         
-        buf = io.BytesIO()
-        # Keep pad_inches small to avoid extra whitespace
-        fig.savefig(buf, format='png', bbox_inches='tight', pad_inches=0.02, transparent=True, dpi=dpi_val)
-        plt.close(fig)
-        
-        buf.seek(0)
-        img_str = base64.b64encode(buf.read()).decode('utf-8')
+        if not embed:
+            return f'<img src="{html.escape(latex_url(key, clean_content, style, fmt))}" class="{css_class}" />'
+
+        img_str = base64.b64encode(img_bytes).decode('utf-8')
         
-        return f'<img src="data:image/png;base64,{img_str}" class="{css_class}" />'
+        return f'<img src="data:{LATEX_FORMATS[fmt]};base64,{img_str}" class="{css_class}" />'
         
     except Exception as e:
         print(f"LATEX ERROR: {e} | Content: {latex_content}")
+        metrics.inc('qrepo_formula_errors_total')
         return f'<span style="color:red; font-weight:bold;">[Math Error]</span>'
 
+def latex_url(key, clean_content, style, fmt):
+    return f'{LATEX_URL_SCHEME}{key}#' + urlencode({'style': style, 'fmt': fmt, 'tex': clean_content})
+
+def latex_image_for_url(url):
+    """
+    Image bytes of a latex:// URL: from the cache, or rendered again (and
+    cached) from the formula in its fragment. None if neither is possible.
+    """
+    key, _, fragment = url[len(LATEX_URL_SCHEME):].partition('#')
+    cache = get_latex_cache()
+    img_bytes = cache.get(key)
+    if img_bytes is not None or not fragment:
+        return img_bytes
+
+    params = {name: values[0] for name, values in parse_qs(fragment, keep_blank_values=True).items()}
+    style, fmt, clean_content = params.get('style'), params.get('fmt'), params.get('tex')
+    # Only the formula the key was made from (the URL comes from stored HTML)
+    if style not in LATEX_STYLES or fmt not in LATEX_FORMATS or clean_content is None \
+            or latex_cache_key(clean_content, style, fmt) != key:
+        return None
+    font_size, dpi_val, _ = LATEX_STYLES[style]
+    start = time.perf_counter()
+    img_bytes = render_latex_image(clean_content, font_size, dpi_val, fmt)
+    record_formula_render(fmt, time.perf_counter() - start)
+    cache.set(key, img_bytes)
+    return img_bytes
+
 def process_content_for_pdf(html_content):
+    """
+    Print-ready HTML for the PDF exports. Formulas become latex:// images and
+    /media/ URLs are left as they are: both are resolved by core.pdf.PdfUrlFetcher.
+    """
     if not html_content: return ""
-    
-    html_content = fix_image_paths(html_content)
-    
-    pattern_block = r'\\\[(.*?)\\\]'
-    def replacer_block(match):
-        return latex_to_base64(match.group(1), style='block')
-    html_content = re.sub(pattern_block, replacer_block, html_content, flags=re.DOTALL)
-
-    pattern_inline = r'\#\#(.*?)\#\#'
-    def replacer_inline(match):
-        return latex_to_base64(match.group(1), style='inline')
-    html_content = re.sub(pattern_inline, replacer_inline, html_content, flags=re.DOTALL)
-    
-    return html_content
\ No newline at end of file
+
+    tokens = list(tokenize_content(html_content))
+
+    # Block formulas are rendered first: an inline span may contain one
+    block_sources = [value for kind, value in _walk_tokens(tokens) if kind == TOKEN_BLOCK]
+    block_tags = iter(_render_batch(block_sources, 'block'))
+
+    parts, inline_sources = [], []
+    for kind, value in tokens:
+        if kind == TOKEN_BLOCK:
+            parts.append(next(block_tags))
+        elif kind == TOKEN_INLINE:
+            parts.append(None)  # Filled in once the inline batch is rendered
+            inline_sources.append(''.join(
+                next(block_tags) if sub_kind == TOKEN_BLOCK else sub_value for sub_kind, sub_value in value
+            ))
+        else:
+            parts.append(value)
+
+    inline_tags = iter(_render_batch(inline_sources, 'inline'))
+    return ''.join(next(inline_tags) if part is None else part for part in parts)
+
+def _render_batch(sources, style):
+    if not sources:
+        return []
+    return latex_to_base64_batch([(source, style) for source in sources], embed=False)
+
+
+# --- TOKENIZER ---
+# One scan over the content finds the math delimiters and the media images.
+# The rules are those of the former two regex passes (\[...\] first, then
+# ##...## over the result):
+# - a \[ opens a block formula only if a \] follows somewhere; it ends at the next \]
+# - inside a block nothing else is a token
+# - ## opens an inline formula, which ends at the next ## outside a block; an
+#   inline formula may contain block formulas and media images
+# - a ## that is never closed is plain text
+
+TOKEN_TEXT = 'text'
+TOKEN_BLOCK = 'block'
+TOKEN_INLINE = 'inline'
+TOKEN_MEDIA = 'media'
+
+@functools.lru_cache(maxsize=None)
+def _content_token_re(media_url):
+    return re.compile(r'\\\[|\\\]|##|src=(["\'])' + re.escape(media_url) + r'[^"\'#\\]*\1')
+
+def tokenize_content(html_content):
+    """
+    Yields (kind, value) tokens covering the whole content, in order:
+
+    - TOKEN_TEXT / TOKEN_MEDIA: raw text (media is a src="/media/..." attribute)
+    - TOKEN_BLOCK: source of a \\[...\\] formula
+    - TOKEN_INLINE: list of TEXT/BLOCK/MEDIA tokens inside a ##...## formula
+    """
+    if not html_content: return
+
+    last_close = html_content.rfind('\\]')
+    top_level = []
+    inline_parts = None  # Tokens of the open ## span, if any
+    block_at = None      # Start of the open block's source, if any
+    pos = 0              # Start of the text not yet emitted
+
+    for match in _content_token_re(settings.MEDIA_URL).finditer(html_content):
+        token = match.group(0)
+        start, end = match.span()
+        target = top_level if inline_parts is None else inline_parts
+
+        if block_at is not None:
+            if token == '\\]':
+                target.append((TOKEN_BLOCK, html_content[block_at:start]))
+                block_at, pos = None, end
+            continue
+
+        if token == '\\[':
+            if last_close >= end:
+                if start > pos:
+                    target.append((TOKEN_TEXT, html_content[pos:start]))
+                block_at = end
+        elif token == '##':
+            if start > pos:
+                target.append((TOKEN_TEXT, html_content[pos:start]))
+            if inline_parts is None:
+                inline_parts = []
+            else:
+                top_level.append((TOKEN_INLINE, inline_parts))
+                inline_parts = None
+            pos = end
+        elif token != '\\]':
+            if start > pos:
+                target.append((TOKEN_TEXT, html_content[pos:start]))
+            target.append((TOKEN_MEDIA, token))
+            pos = end
+
+        # Everything before an open block or inline span is final
+        if inline_parts is None and block_at is None:
+            yield from top_level
+            top_level.clear()
+
+    if inline_parts is not None:
+        # Unclosed ##: the delimiter is text, its contents stay as they were
+        top_level.append((TOKEN_TEXT, '##'))
+        top_level.extend(inline_parts)
+    if pos < len(html_content):
+        top_level.append((TOKEN_TEXT, html_content[pos:]))
+    yield from top_level
+
+def _walk_tokens(tokens):
+    """ Flattens TOKEN_INLINE contents, keeping document order. """
+    for kind, value in tokens:
+        if kind == TOKEN_INLINE:
+            yield from value
+        else:
+            yield kind, value
+
+
+# --- BATCH MODE ---
+# Exports collect every formula of the whole queryset up front and render the
+# missing ones in a pool of warm worker processes. The per-post substitution in
+# process_content_for_pdf then only hits the cache.
+#
+# The pool is only used by code run through uses_render_pool (management
+# commands, export jobs): web requests, e.g. a question being saved, render
+# serially and never fork workers from the server process.
+
+_render_pool = None
+# Export threads may need the pool at the same time: only one of them starts it
+_render_pool_lock = threading.Lock()
+_render_pool_allowed = contextvars.ContextVar('render_pool_allowed', default=False)
+
+def uses_render_pool(func):
+    """ Lets `func` render formulas in the worker pool (see LATEX_RENDER_WORKERS). """
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        token = _render_pool_allowed.set(True)
+        try:
+            return func(*args, **kwargs)
+        finally:
+            _render_pool_allowed.reset(token)
+    return wrapper
+
+def extract_formulas(html_content):
+    """ Returns the set of (cleaned formula, style) pairs used in the content. """
+    formulas = set()
+    for kind, value in tokenize_content(html_content):
+        if kind == TOKEN_BLOCK:
+            formulas.add((clean_latex(value), 'block'))
+        elif kind == TOKEN_INLINE:
+            formulas.update((clean_latex(v), 'block') for k, v in value if k == TOKEN_BLOCK)
+            # A block inside an inline span only counts as a space here: the
+            # exact source depends on its rendered tag, process_content_for_pdf handles it
+            formulas.add((clean_latex(''.join(' ' if k == TOKEN_BLOCK else v for k, v in value)), 'inline'))
+    return formulas
+
+def _init_render_worker():
+    """ Runs once per worker: loads matplotlib, fonts and the mathtext parser. """
+    renderers.warm_up(pdf_exports=False)
+
+def record_formula_render(fmt, seconds):
+    metrics.inc('qrepo_formula_renders_total', format=fmt)
+    metrics.observe('qrepo_formula_render_seconds', seconds, format=fmt)
+
+def _render_formula_job(job):
+    """ Returns (key, image bytes or None, render time); the time is recorded by the parent process. """
+    key, clean_content, style, fmt = job
+    font_size, dpi_val, _ = LATEX_STYLES[style]
+    start = time.perf_counter()
+    try:
+        return key, render_latex_image(clean_content, font_size, dpi_val, fmt), time.perf_counter() - start
+    except Exception:
+        # latex_to_base64 will hit the same error and produce the fallback
+        return key, None, None
+
+def get_render_pool_size():
+    return getattr(settings, 'LATEX_RENDER_WORKERS', None) or os.cpu_count() or 1
+
+def get_render_pool():
+    """
+    Lazily starts the shared pool. Returns None when parallelism is disabled,
+    or outside uses_render_pool.
+    """
+    global _render_pool
+    workers = get_render_pool_size()
+    if workers <= 1 or not _render_pool_allowed.get():
+        return None
+    with _render_pool_lock:
+        if _render_pool is None:
+            _render_pool = ProcessPoolExecutor(max_workers=workers, initializer=_init_render_worker)
+        return _render_pool
+
+def _discard_render_pool(pool):
+    """ Drops a broken pool (unless another thread already replaced it). """
+    global _render_pool
+    with _render_pool_lock:
+        if _render_pool is pool:
+            _render_pool = None
+    pool.shutdown(wait=False)
+
+def render_missing_formulas(formulas, fmt=None):
+    """
+    Renders the (cleaned formula, style) pairs that are not cached yet into
+    the LaTeX cache, in the worker pool when there is more than one.
+    Returns how many formulas were rendered.
+    """
+    cache = get_latex_cache()
+    fmt = fmt or get_latex_format()
+
+    jobs = {}
+    for clean_content, style in formulas:
+        key = latex_cache_key(clean_content, style, fmt)
+        if key not in jobs and not cache.contains(key):
+            jobs[key] = (key, clean_content, style, fmt)
+    if not jobs:
+        return 0
+
+    pool = get_render_pool() if len(jobs) > 1 else None
+    results = None
+    if pool is not None:
+        try:
+            chunksize = max(1, len(jobs) // (get_render_pool_size() * 4))
+            results = list(pool.map(_render_formula_job, jobs.values(), chunksize=chunksize))
+        except BrokenProcessPool as e:
+            logger.warning("Render pool broken: %s | Falling back to serial rendering", e)
+            _discard_render_pool(pool)
+    if results is None:
+        results = [_render_formula_job(job) for job in jobs.values()]
+
+    rendered = 0
+    for key, img_bytes, seconds in results:
+        if img_bytes is not None:
+            record_formula_render(fmt, seconds)
+            cache.set(key, img_bytes)
+            rendered += 1
+    return rendered
+
+def prerender_formulas(contents):
+    """
+    Renders every unique, not yet cached formula found in `contents` (an
+    iterable of HTML strings) into the LaTeX cache. Returns how many formulas
+    were rendered.
+    """
+    formulas = set()
+    for html_content in contents:
+        formulas.update(extract_formulas(html_content))
+    return render_missing_formulas(formulas)
+
+def warm_latex_cache(contents, fmt=None, chunk_size=256, progress=None):
+    """
+    Fills the LaTeX cache with every unique formula of `contents` (an iterable
+    of HTML strings, read once), in both styles as the content uses them.
+    Formulas already cached are skipped; the others are rendered in chunks of
+    `chunk_size`, each in the worker pool, and `progress(done, missing, rendered)`
+    is called after each chunk. Returns the counts.
+    """
+    cache = get_latex_cache()
+    fmt = fmt or get_latex_format()
+
+    formulas = set()
+    for html_content in contents:
+        formulas.update(extract_formulas(html_content))
+    missing = sorted(
+        (clean_content, style) for clean_content, style in formulas
+        if not cache.contains(latex_cache_key(clean_content, style, fmt))
+    )
+
+    rendered = 0
+    chunk_size = max(1, chunk_size)
+    for start in range(0, len(missing), chunk_size):
+        chunk = missing[start:start + chunk_size]
+        rendered += render_missing_formulas(chunk, fmt)
+        if progress is not None:
+            progress(start + len(chunk), len(missing), rendered)
+
+    return {
+        'formulas': len(formulas),
+        'cached': len(formulas) - len(missing),
+        'rendered': rendered,
+        # Formulas mathtext cannot parse: the exports show the [Math Error] fallback
+        'failed': len(missing) - rendered,
+    }
+
+def latex_to_base64_batch(items, fmt=None, embed=True):
+    """
+    Batch version of latex_to_base64 for a whole question or export: takes
+    (formula, style) pairs and returns the img tags in the same order.
+    Missing formulas are rendered together (in parallel), each distinct
+    one only once.
+    """
+    formulas = set()
+    for latex_content, style in items:
+        style = 'block' if style == 'block' else 'inline'
+        formulas.add((clean_latex(latex_content), style))
+    render_missing_formulas(formulas, fmt)
+
+    tags = {}
+    for item in items:
+        if item not in tags:
+            tags[item] = latex_to_base64(item[0], style=item[1], fmt=fmt, embed=embed)
+    return [tags[item] for item in items]
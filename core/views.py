@@ -1,360 +1,247 @@
 from django.views.generic import ListView, CreateView
-from django.urls import reverse_lazy
-from .models import Post, AreaDoConhecimento
+from django.http import (
+    FileResponse, Http404, HttpResponse, HttpResponseBadRequest, HttpResponseForbidden, JsonResponse,
+)
+from django.shortcuts import get_object_or_404, redirect
+from django.urls import reverse, reverse_lazy
+from django.template.defaultfilters import date as date_format
+from django.template.loader import render_to_string
+from django.utils.timezone import localtime
+from .models import Post
+from .facets import facet_counts, parse_facet_id
 from .forms import PostForm
+from .pagination import KEYSET_ORDERING, RANKED_ORDERING, decode_cursor, keyset_page
+from .search import fts_query, search_available, search_posts
+
+# Columns the question cards read (templates/partials/post_cards.html)
+CARD_FIELDS = (
+    'title', 'excerpt', 'created_at',
+    'area_do_conhecimento__name', 'area_do_conhecimento__color',
+    'dificuldade__name', 'dificuldade__color',
+)
+
+def card_queryset():
+    """ Questions with everything a card shows, areas and difficulties joined in (no query per card). """
+    return Post.objects.select_related('area_do_conhecimento', 'dificuldade').only(*CARD_FIELDS)
+
+def filter_posts(queryset, params):
+    """
+    Applies the list filters (search, area, difficulty) from the query string.
+    Returns the queryset and its page ordering: search results come best match first.
+    """
+    ordering = KEYSET_ORDERING
+
+    # Full-text search over title and content
+    search_query = params.get('search', '').strip()
+    if search_query:
+        queryset = search_posts(queryset, search_query)
+        # Only actual FTS matches have a rank; a query without words matches nothing
+        if search_available() and fts_query(search_query):
+            ordering = RANKED_ORDERING
+
+    # Filter by AreaDoConhecimento and Dificuldade (malformed ids are ignored)
+    area_id = parse_facet_id(params.get('area'))
+    if area_id is not None:
+        queryset = queryset.filter(area_do_conhecimento_id=area_id)
+    dificuldade_id = parse_facet_id(params.get('dificuldade'))
+    if dificuldade_id is not None:
+        queryset = queryset.filter(dificuldade_id=dificuldade_id)
+
+    return queryset, ordering
 
 class PostListView(ListView):
     model = Post
     template_name = 'index.html'
     context_object_name = 'posts'
-    ordering = ['-created_at']
+    page_size = 20
 
     def get_queryset(self):
-        queryset = super().get_queryset()
-        
-        # Filter by search query (name/title)
-        search_query = self.request.GET.get('search', '')
-        if search_query:
-            queryset = queryset.filter(title__icontains=search_query)
-        
-        # Filter by AreaDoConhecimento
-        area_id = self.request.GET.get('area', '')
-        if area_id:
-            queryset = queryset.filter(area_do_conhecimento_id=area_id)
-        
-        return queryset
+        queryset, self.page_ordering = filter_posts(card_queryset(), self.request.GET)
+        return queryset.order_by(*self.page_ordering)
 
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
+        # Only the first page is rendered here, the rest comes from post_list_page
+        context['posts'], context['next_cursor'] = keyset_page(
+            self.object_list, size=self.page_size, ordering=self.page_ordering,
+        )
         context['form'] = PostForm()
-        context['areas'] = AreaDoConhecimento.objects.all().order_by('name')
+        area_id = parse_facet_id(self.request.GET.get('area'))
+        dificuldade_id = parse_facet_id(self.request.GET.get('dificuldade'))
+        context['areas'], context['dificuldades'], context['area_total'], context['dificuldade_total'] = facet_counts(
+            area_id, dificuldade_id,
+        )
         context['current_search'] = self.request.GET.get('search', '')
-        context['current_area'] = self.request.GET.get('area', '')
+        context['current_area'] = area_id
+        context['current_dificuldade'] = dificuldade_id
         return context
 
+def post_list_page(request):
+    """ Infinite scroll: the cards after ?cursor=..., with the same filters as the list. """
+    queryset, ordering = filter_posts(card_queryset(), request.GET)
+    # A cursor from another ordering (e.g. the search changed) is rejected too
+    position = decode_cursor(request.GET.get('cursor', ''), ordering)
+    if position is None:
+        return JsonResponse({'error': 'Invalid cursor.'}, status=400)
+
+    posts, next_cursor = keyset_page(queryset, position, size=PostListView.page_size, ordering=ordering)
+    return JsonResponse({
+        'html': render_to_string('partials/post_cards.html', {'posts': posts}, request=request),
+        'next_cursor': next_cursor,
+    })
+
+def post_content(request, pk):
+    """ Full question for the "Ver mais" modal (the cards only carry an excerpt). """
+    post = get_object_or_404(Post.objects.only('title', 'content', 'created_at'), pk=pk)
+    return JsonResponse({
+        'id': post.pk,
+        'title': post.title,
+        'date': date_format(localtime(post.created_at), 'd M Y'),
+        'content': post.content,
+    })
+
 class PostCreateView(CreateView):
     model = Post
     form_class = PostForm
     template_name = 'index.html'
     success_url = reverse_lazy('index')
 
+    def form_valid(self, form):
+        response = super().form_valid(form)
+        self.object.refresh_rendered_content()
+        return response
+
     def form_invalid(self, form):
         return super().form_invalid(form)
 
-from django.http import HttpResponse
-from weasyprint import HTML
-from .utils import process_content_for_pdf
+import hmac
+
+from django.conf import settings
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.http import quote_etag
+from .jobs import recover_job, submit_export_job
+from .models import ExportJob
+from .pdf_cache import export_cache_key, open_or_build_pdf
+from .metrics import render_prometheus
+from .timing import export_timing, profile_path_for, stage
+
+# Largest id SQLite (a signed 64-bit integer) can compare against
+MAX_POST_ID = 2 ** 63 - 1
+
+def parse_post_ids(values):
+    """ Question ids from the request, or None when one of them is not a valid id. """
+    try:
+        post_ids = [int(value) for value in values]
+    except (TypeError, ValueError):
+        return None
+    if not all(0 < pk <= MAX_POST_ID for pk in post_ids):
+        return None
+    return post_ids
+
+def _invalid_post_ids():
+    return HttpResponseBadRequest("Invalid question id.")
+
+def _pdf_response(kind, pdf_file):
+    """ Streams the PDF file (closed once sent); FileResponse sets Content-Length from its size. """
+    return FileResponse(pdf_file, as_attachment=True, filename=ExportJob.FILENAMES[kind], content_type='application/pdf')
+
+def _cached_pdf_response(request, kind, post_ids):
+    """ Serves the export from the PDF cache; GET requests may revalidate with If-None-Match. """
+    post_ids = parse_post_ids(post_ids)
+    if post_ids is None:
+        return _invalid_post_ids()
+    endpoint = request.resolver_match.url_name if request.resolver_match else kind
+    with export_timing(kind, profile_path_for(request, kind), endpoint) as timer:
+        response = _build_cached_pdf_response(request, kind, post_ids)
+    response['Server-Timing'] = timer.server_timing()
+    return response
+
+def _build_cached_pdf_response(request, kind, post_ids):
+    with stage('db'):
+        key = export_cache_key(kind, post_ids)
+    etag = quote_etag(key)
+    if request.method in ('GET', 'HEAD'):
+        not_modified = get_conditional_response(request, etag=etag)
+        if not_modified is not None:
+            return not_modified
+
+    queryset = Post.objects.filter(id__in=post_ids)
+    response = _pdf_response(kind, open_or_build_pdf(kind, queryset, key))
+    response['ETag'] = etag
+    # The browser may keep the file but must ask again (a question may have been edited)
+    patch_cache_control(response, private=True, no_cache=True)
+    return response
+
+def _start_export_job(kind, post_ids):
+    """ Queues the export and answers with the URLs to poll and to download. """
+    post_ids = parse_post_ids(post_ids)
+    if post_ids is None:
+        return _invalid_post_ids()
+    job = submit_export_job(kind, post_ids)
+    return JsonResponse(_job_payload(job), status=202)
+
+def _job_payload(job):
+    payload = {
+        'id': job.pk,
+        'kind': job.kind,
+        'status': job.status,
+        'status_url': reverse('export_job_status', args=[job.pk]),
+        'download_url': None,
+        'error': job.error,
+    }
+    if job.status == ExportJob.STATUS_DONE:
+        payload['download_url'] = reverse('export_job_download', args=[job.pk])
+    return payload
 
 def export_selected_pdf(request):
     if request.method == 'POST':
         post_ids = request.POST.getlist('post_ids')
-        queryset = Post.objects.filter(id__in=post_ids)
-        
-        html_string = """
-        <!DOCTYPE html>
-        <html>
-        <head>
-            <meta charset="utf-8">
-            <style>
-                @page { 
-                    size: A4; 
-                    margin: 3cm 2cm 2cm 3cm; 
-                }
-
-                body { 
-                    font-family: "Times New Roman", Times, serif; 
-                    font-size: 12pt; 
-                    line-height: 1.5;
-                    color: #000;
-                }
-                
-                h1 { 
-                    font-size: 14pt; 
-                    font-weight: bold; 
-                    text-align: center;
-                    text-transform: uppercase;
-                    margin-bottom: 1cm;
-                }
-
-                img { max-width: 100%; height: auto; }
-
-                /* --- INLINE LATEX ($$) --- */
-                img.latex-inline {
-                    height: 1.3em; 
-                    vertical-align: -0.3em;
-                    margin: 0 2px;
-                    display: inline-block;
-                }
-
-                /* --- BLOCK LATEX (\[ \]) --- */
-                img.latex-block {
-                    display: block;
-                    margin: 12px auto; 
-                    height: auto;      
-                    width: auto;       
-                }
-                
-                p { text-indent: 1.25cm; margin: 0 0 10px 0; text-align: justify; }
-                
-                /* Preserve align attribute (Summernote uses this) */
-                *[align="right"] { text-align: right !important; text-indent: 0 !important; }
-                *[align="left"] { text-align: left !important; text-indent: 0 !important; }
-                *[align="center"] { text-align: center !important; text-indent: 0 !important; }
-                
-                /* Preserve inline text-align styles (for compatibility) */
-                *[style*="text-align: right"] { text-align: right !important; text-indent: 0 !important; }
-                *[style*="text-align: left"] { text-align: left !important; text-indent: 0 !important; }
-                *[style*="text-align: center"] { text-align: center !important; text-indent: 0 !important; }
-                *[style*="text-align:right"] { text-align: right !important; text-indent: 0 !important; }
-                *[style*="text-align:left"] { text-align: left !important; text-indent: 0 !important; }
-                *[style*="text-align:center"] { text-align: center !important; text-indent: 0 !important; }
-                
-                .page-break { page-break-after: always; }
-            </style>
-        </head>
-        <body>
-        """
-
-        total = queryset.count()
-        for index, post in enumerate(queryset):
-            processed_content = process_content_for_pdf(post.content)
-            
-            html_string += f"""
-            <div class="post-wrapper">
-                <h1>{post.title}</h1>
-                <div style="text-align: right; font-size: 10pt; margin-bottom: 1cm;">
-                    {post.created_at.strftime('%d de %B de %Y')}
-                </div>
-                <div class="content">
-                    {processed_content}
-                </div>
-            </div>
-            """
-            if index < total - 1:
-                html_string += '<div class="page-break"></div>'
-
-        html_string += "</body></html>"
-
-        pdf_file = HTML(string=html_string).write_pdf()
-        response = HttpResponse(pdf_file, content_type='application/pdf')
-        response['Content-Disposition'] = 'attachment; filename="questoes_selecionadas.pdf"'
-        return response
-    
+        if request.POST.get('async'):
+            return _start_export_job('selected', post_ids)
+        return _cached_pdf_response(request, 'selected', post_ids)
+
+    # GET ?post_ids=1&post_ids=2 is a bookmarkable, revalidatable export
+    post_ids = request.GET.getlist('post_ids')
+    if post_ids:
+        return _cached_pdf_response(request, 'selected', post_ids)
     return redirect('index')
 
 def generate_exam_pdf(request):
     if request.method == 'POST':
         post_ids = request.POST.getlist('post_ids')
-        queryset = Post.objects.filter(id__in=post_ids)
-        
-        html_string = """
-        <!DOCTYPE html>
-        <html>
-        <head>
-            <meta charset="utf-8">
-            <style>
-                @page { 
-                    size: A4; 
-                    /* MARGINS ADJUSTED: 
-                       Top/Bottom: 1cm (Requested reduction)
-                       Left/Right: 1cm 
-                    */
-                    margin: 1cm 1cm 1cm 1cm; 
-
-                    @top-center {
-                        content: element(header);
-                        vertical-align: bottom; /* Sit at the line */
-                        width: 100%;
-                    }
-                    @bottom-center {
-                        content: element(footer);
-                        vertical-align: top; /* Sit at the line */
-                        width: 100%;
-                    }
-                }
-
-                body { 
-                    font-family: Arial, Helvetica, sans-serif; 
-                    font-size: 9pt; 
-                    line-height: 1.4;
-                    color: #000;
-                    margin: 0; 
-                }
-
-                /* --- 1. VERTICAL LINE (Fixed Position) --- */
-                .vertical-line {
-                    position: fixed;
-                    left: 50%;
-                    
-                    /* Extend to absolute edges (0) to guarantee connection */
-                    top: 0; 
-                    bottom: 0; 
-                    
-                    border-left: 1px solid #000; 
-                    z-index: -10; 
-                }
-
-                /* --- 2. HEADER & FOOTER --- */
-                div.header {
-                    position: running(header);
-                    width: 100%;
-                    border-bottom: 1px solid #000;
-                    
-                    /* Padding creates the white space that masks the vertical line.
-                       Since margin is now 1cm, we use ~0.4cm padding so the 
-                       text + padding fits nicely in that 1cm space. */
-                    padding-top: 0.4cm; 
-                    padding-bottom: 5px; 
-                    
-                    margin-bottom: 0;
-                    font-family: Arial, Helvetica, sans-serif;
-                    font-size: 9pt;
-                    background-color: white; 
-                }
-
-                div.footer {
-                    position: running(footer);
-                    width: 100%;
-                    border-top: 1px solid #000;
-                    
-                    /* Padding creates the white space that masks the vertical line. */
-                    padding-bottom: 0.4cm;
-                    padding-top: 5px; 
-                    
-                    margin-top: 0;
-                    font-family: Arial, Helvetica, sans-serif;
-                    font-size: 9pt;
-                    background-color: white;
-                }
-                
-                table.layout-table {
-                    width: 100%;
-                    border-collapse: collapse;
-                    border: none;
-                }
-                td.left { text-align: left; width: 50%; }
-                td.right { text-align: right; width: 50%; }
-
-                .pageNumber::after {
-                    content: counter(page);
-                }
-
-                /* Columns */
-                .content-columns {
-                    column-count: 2;
-                    column-gap: 1cm;
-                    column-fill: auto; 
-                    width: 100%;
-                    padding-top: 10px; /* Reduced slightly to match tighter layout */
-                }
-
-                /* Question Styling */
-                .question-item {
-                    margin-bottom: 20px;
-                }
-
-                h1 { 
-                    font-family: Arial, Helvetica, sans-serif;
-                    font-size: 10pt; 
-                    font-weight: bold; 
-                    margin: 0 0 10px 0;
-                    text-transform: uppercase;
-                    color: #000;
-                    break-after: avoid; 
-                }
-                
-                .area-header {
-                    break-after: avoid;
-                }
-
-                img { max-width: 100%; height: auto; display: block; margin: 10px auto; }
-                
-                img.latex-inline {
-                    height: 1.2em; 
-                    vertical-align: -0.3em;
-                    display: inline-block;
-                    margin: 0 2px;
-                }
-                img.latex-block {
-                    display: block;
-                    margin: 10px auto;
-                    transform: scale(0.6);
-                    transform-origin: center;
-                }
-                
-                p { margin: 0 0 8px 0; text-align: justify; }
-                
-                /* Preserve align attribute (Summernote uses this) */
-                *[align="right"] { text-align: right !important; }
-                *[align="left"] { text-align: left !important; }
-                *[align="center"] { text-align: center !important; }
-                
-                /* Preserve inline text-align styles (for compatibility) */
-                *[style*="text-align: right"] { text-align: right !important; }
-                *[style*="text-align: left"] { text-align: left !important; }
-                *[style*="text-align: center"] { text-align: center !important; }
-                *[style*="text-align:right"] { text-align: right !important; }
-                *[style*="text-align:left"] { text-align: left !important; }
-                *[style*="text-align:center"] { text-align: center !important; }
-            </style>
-        </head>
-        <body>
-            <div class="vertical-line"></div>
-
-            <div class="header">
-                <table class="layout-table">
-                    <tr>
-                        <td class="left">Exame de Acesso ao Ensino Superior do Tocantins</td>
-                        <td class="right">EXATO 2025 – 2ª Edição</td>
-                    </tr>
-                </table>
-            </div>
-
-            <div class="footer">
-                <table class="layout-table">
-                    <tr>
-                        <td class="left">Prova de Conhecimentos | TARDE</td>
-                        <td class="right"><span class="pageNumber"></span></td>
-                    </tr>
-                </table>
-            </div>
-
-            <div class="content-columns">
-        """
-
-        queryset = queryset.order_by('area_do_conhecimento__name', 'id')
-
-        current_area = None
-        for index, post in enumerate(queryset):
-            processed_content = process_content_for_pdf(post.content)
-            
-            if post.area_do_conhecimento != current_area:
-                current_area = post.area_do_conhecimento
-                area_name = current_area.name if current_area else "Sem Área"
-                html_string += f"""
-                <div class="area-header" style="background-color: grey; color: white; padding: 5px; margin-top: 20px; margin-bottom: 10px; font-weight: bold; text-transform: uppercase;">
-                    {area_name}
-                </div>
-                """
-
-            html_string += f"""
-            <div class="question-item">
-                <h1 style="background-color:lightgrey;">QUESTÃO {index + 1:02d}</h1>
-                <div class="content">
-                    {processed_content}
-                </div>
-            </div>
-            """
-
-        html_string += """
-            </div>
-        </body>
-        </html>
-        """
-
-        pdf_file = HTML(string=html_string).write_pdf()
-        response = HttpResponse(pdf_file, content_type='application/pdf')
-        response['Content-Disposition'] = 'attachment; filename="prova_gerada.pdf"'
-        return response
-    
-    return redirect('index')
\ No newline at end of file
+        if request.POST.get('async'):
+            return _start_export_job('exam', post_ids)
+        return _cached_pdf_response(request, 'exam', post_ids)
+
+    # GET ?post_ids=1&post_ids=2 is a bookmarkable, revalidatable export
+    post_ids = request.GET.getlist('post_ids')
+    if post_ids:
+        return _cached_pdf_response(request, 'exam', post_ids)
+    return redirect('index')
+
+def export_job_status(request, pk):
+    job = recover_job(get_object_or_404(ExportJob, pk=pk))
+    return JsonResponse(_job_payload(job))
+
+def export_job_download(request, pk):
+    job = get_object_or_404(ExportJob, pk=pk)
+    if job.status != ExportJob.STATUS_DONE or not job.file:
+        raise Http404("Export is not ready.")
+    try:
+        pdf_file = job.file.open('rb')
+    except FileNotFoundError:
+        raise Http404("Export file was cleaned up.")
+    return FileResponse(pdf_file, as_attachment=True, filename=job.filename, content_type='application/pdf')
+
+def _metrics_allowed(request):
+    if request.user.is_staff:
+        return True
+    token = getattr(settings, 'METRICS_TOKEN', None)
+    header = request.headers.get('Authorization', '')
+    return bool(token) and header.startswith('Bearer ') and hmac.compare_digest(header[7:], token)
+
+def metrics(request):
+    """ Renderer and export metrics of every worker process, for Prometheus to scrape. """
+    if not _metrics_allowed(request):
+        return HttpResponseForbidden("Metrics require a staff login or the METRICS_TOKEN bearer token.")
+    return HttpResponse(render_prometheus(), content_type='text/plain; version=0.0.4; charset=utf-8')
@@ -123,4 +123,103 @@ SUMMERNOTE_CONFIG = {
 }
 
 # Allow iframe usage for Summernote
-X_FRAME_OPTIONS = 'SAMEORIGIN'
\ No newline at end of file
+X_FRAME_OPTIONS = 'SAMEORIGIN'
+
+# --- LaTeX render cache ---
+# Rendered formula images are cached in memory (per process) and on disk
+# (shared by all workers). Both levels are bounded by total size in bytes.
+LATEX_CACHE_DIR = BASE_DIR / 'cache' / 'latex'
+LATEX_CACHE_MEMORY_BYTES = 32 * 1024 * 1024
+LATEX_CACHE_DISK_BYTES = 512 * 1024 * 1024
+
+# Worker processes used to render formulas in parallel by the management
+# commands (imports, warm_latex_cache, benchmark) and the background export
+# jobs. Web requests always render serially. Set to 1 to disable the pool.
+LATEX_RENDER_WORKERS = os.cpu_count() or 1
+
+# Formula image format in PDF exports: 'png' (raster) or 'svg' (vector,
+# glyphs converted to paths; sharper in print and usually smaller).
+LATEX_OUTPUT_FORMAT = 'png'
+
+# matplotlib and WeasyPrint are imported on first use. Set to True to load
+# them when the WSGI application starts instead (e.g. with gunicorn --preload,
+# so the forked workers share them and the first export is not slower).
+PRELOAD_RENDERERS = False
+
+# --- Background PDF exports ---
+# 'thread': jobs run in a small thread pool inside the web process.
+# 'worker': jobs wait for `python manage.py run_export_worker`.
+EXPORT_JOBS_MODE = 'thread'
+EXPORT_JOBS_WORKERS = 2
+EXPORT_JOBS_DIR = BASE_DIR / 'exports'
+# Finished exports older than this (seconds) are deleted by the cleanup
+EXPORT_JOBS_MAX_AGE = 24 * 3600
+# A job still running after this many seconds is marked as failed (its
+# thread or worker died); the page stops polling a little later
+EXPORT_JOBS_TIMEOUT = 30 * 60
+# How often (seconds) the cleanup runs: in the worker loop, or after a job
+# finishes in 'thread' mode
+EXPORT_JOBS_CLEANUP_INTERVAL = 3600
+
+# --- PDF export cache ---
+# Finished exam/selection PDFs, keyed by the questions they contain and when
+# they (and their areas/difficulties) were last edited.
+PDF_CACHE_DIR = BASE_DIR / 'cache' / 'pdf'
+PDF_CACHE_MEMORY_BYTES = 16 * 1024 * 1024
+PDF_CACHE_DISK_BYTES = 256 * 1024 * 1024
+# Laid-out questions kept in memory (per process) by the one-question-per-page
+# exports, so unchanged questions are not laid out again. Bounded by count and
+# by estimated size (see core.pdf.document_size).
+PDF_PAGE_CACHE_ENTRIES = 300
+PDF_PAGE_CACHE_BYTES = 32 * 1024 * 1024
+# Decoded images (formulas, pictures) shared by all exports of a process
+PDF_IMAGE_CACHE_ENTRIES = 2000
+# Exports are built into a temporary file kept in memory up to this size
+# (then moved to disk) and streamed to the client from there.
+PDF_SPOOL_MEMORY_BYTES = 1024 * 1024
+
+# --- Print copies of uploaded images ---
+# Images in PDF exports are downscaled to the width they take in each layout
+# at this resolution, and recompressed. Cached on disk by source path + mtime.
+PDF_IMAGE_DPI = 200
+PDF_IMAGE_JPEG_QUALITY = 85
+PDF_IMAGE_DERIVATIVES_DIR = BASE_DIR / 'cache' / 'images'
+PDF_IMAGE_DERIVATIVES_MEMORY_BYTES = 16 * 1024 * 1024
+PDF_IMAGE_DERIVATIVES_DISK_BYTES = 512 * 1024 * 1024
+
+# --- Question list filters ---
+# Area x difficulty counts of the filter bar are cached (default cache) and
+# dropped whenever a question, area or difficulty changes. With a per-process
+# cache backend, other processes may show stale counts for up to this long.
+FACET_COUNTS_TIMEOUT = 300
+
+# --- Export timings ---
+# Every PDF export logs its stage timings (database, PDF cache, formulas,
+# HTML, layout, write_pdf) to the core.exports logger and returns them in a
+# Server-Timing header. When this is set, an export requested with
+# ?profile=1 also dumps a cProfile stats file of that request here.
+PDF_EXPORT_PROFILE_DIR = None
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'handlers': {
+        'console': {'class': 'logging.StreamHandler'},
+    },
+    'loggers': {
+        # Render, cache and export failures
+        'core': {'handlers': ['console'], 'level': 'WARNING'},
+        # Export timings (propagated to the 'core' handler)
+        'core.exports': {'level': 'INFO'},
+    },
+}
+
+# --- Metrics ---
+# Formula, cache and export metrics are served at /metrics/ (Prometheus text
+# format) to staff users, or to a scraper sending "Authorization: Bearer <METRICS_TOKEN>".
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN')
+# With a directory (one per host), each process writes its counters there so
+# that any worker reports the whole deployment. None keeps them per process.
+METRICS_DIR = None
+# Seconds between two writes of a process's counters
+METRICS_FLUSH_INTERVAL = 5.0
@@ -9,8 +9,15 @@ https://docs.djangoproject.com/en/5.2/howto/deployment/wsgi/
 
 import os
 
+from django.conf import settings
 from django.core.wsgi import get_wsgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'latex_project.settings')
 
 application = get_wsgi_application()
+
+# Loads matplotlib and WeasyPrint now rather than on the first export
+if getattr(settings, 'PRELOAD_RENDERERS', False):
+    from core.renderers import warm_up
+
+    warm_up()